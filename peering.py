@@ -1,21 +1,38 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import collections
+import contextlib
 import dataclasses
 import enum
+import errno
+import fcntl
+import functools
+import hashlib
 import ipaddress
 import json
 import logging
+import math
+import os
 import pathlib
 import re
+import shutil
+import socket
+import struct
 import subprocess
 import sys
+import threading
+import time
+from collections.abc import Callable, Hashable, Iterable, Iterator
 from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+from typing import TYPE_CHECKING, Any, TypeVar
 
-import dataclasses_json
-import jinja2
-import jsonschema
-import requests
+if TYPE_CHECKING:
+    import jinja2
+
+# jinja2, jsonschema and requests are imported by the code paths that use
+# them, so scripts importing this module for its dataclasses start quickly.
 
 AUTO_BASE_DIR = pathlib.Path(__file__).absolute().parent
 
@@ -27,6 +44,27 @@ DEFAULT_BIRD6_SOCK_PATH = pathlib.Path(AUTO_BASE_DIR, "var/bird6.ctl")
 _DEF_ANNOUNCEMENT_SCHEMA_REL = "configs/announcement_schema.json"
 DEFAULT_ANNOUNCEMENT_SCHEMA = pathlib.Path(AUTO_BASE_DIR, _DEF_ANNOUNCEMENT_SCHEMA_REL)
 DEFAULT_MUX2TAP_PATH = pathlib.Path(AUTO_BASE_DIR, "var/mux2dev.txt")
+DEFAULT_TEMPLATE_CACHE_DIR = pathlib.Path(AUTO_BASE_DIR, "var/jinja2-cache")
+FILTER_STATE_FN = "prefix-filters.json"
+FILTER_GENERATIONS_DN = "prefix-filters.d"
+FILTER_LOCK_FN = "prefix-filters.lock"
+RELOAD_STATE_FN = "bird-reload.json"
+RELOAD_WINDOW = 0.25
+CONFIRM_TIMEOUT = 120.0
+CONFIRM_INTERVAL = 1.0
+CONFIRM_CONNECTIONS = 8
+PEERING_ASN = 47065
+FLAP_LEDGER_FN = "flap-ledger.json"
+FLAP_MAX_EVENTS = 3
+FLAP_WINDOW = 3600.0
+FLAP_RETENTION = 86400.0
+# Dampening penalty per route change and its half-life (Cisco and Juniper)
+FLAP_PENALTY = 1000.0
+FLAP_HALF_LIFE = 900.0
+# Highest penalty a change may leave, 10% under Cisco's suppress threshold of 2000
+FLAP_MAX_PENALTY = 1800.0
+BIRD_CTL_TIMEOUT = 60.0
+RENDER_CACHE_SIZE = 4096
 
 
 class MuxName(enum.StrEnum):
@@ -148,33 +186,120 @@ MUX_SETS: dict[str, list[MuxName]] = {
 }
 
 
-@dataclasses_json.dataclass_json
-@dataclasses.dataclass
+def _mux(name: str) -> MuxName | str:
+    """Convert name to a MuxName, keeping "all" and unknown names as strings"""
+    try:
+        return MuxName(name)
+    except ValueError:
+        return name
+
+
+# The models below are serialized by hand into the JSON shape produced by
+# dataclasses_json, which they replaced; to_dict/from_dict are on the hot
+# path of every render, round log and phase list load.
+
+
+@dataclasses.dataclass(slots=True)
 class Announcement:
     muxes: list[MuxName]
     peer_ids: list[int] = dataclasses.field(default_factory=list)
     """Peer IDs to announce to (communities will be computed automatically)"""
     communities: list[tuple[int, int]] = dataclasses.field(default_factory=list)
     """List of communities to attach to announcement"""
-    large_communities: list[tuple[int, int, int]] = dataclasses.field(default_factory=list)
+    large_communities: list[tuple[int, int, int]] = dataclasses.field(
+        default_factory=list
+    )
     """List of BGP large communities to attach to announcement"""
     prepend: list[int] = dataclasses.field(default_factory=list)
     """List of ASNs to prepend to AS-path"""
 
+    def to_dict(self) -> dict:
+        return {
+            "muxes": list(self.muxes),
+            "peer_ids": list(self.peer_ids),
+            "communities": [list(c) for c in self.communities],
+            "large_communities": [list(c) for c in self.large_communities],
+            "prepend": list(self.prepend),
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Announcement":
+        return cls(
+            [_mux(m) for m in d["muxes"]],
+            list(d.get("peer_ids", ())),
+            [tuple(c) for c in d.get("communities", ())],
+            [tuple(c) for c in d.get("large_communities", ())],
+            list(d.get("prepend", ())),
+        )
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
 
-@dataclasses_json.dataclass_json
-@dataclasses.dataclass
+    @classmethod
+    def from_json(cls, data: str | bytes) -> "Announcement":
+        return cls.from_dict(json.loads(data))
+
+
+@dataclasses.dataclass(slots=True)
 class Update:
     withdraw: list[MuxName] = dataclasses.field(default_factory=list)
     announce: list[Announcement] = dataclasses.field(default_factory=list)
     description: str | None = None
 
+    def to_dict(self) -> dict:
+        return {
+            "withdraw": list(self.withdraw),
+            "announce": [ann.to_dict() for ann in self.announce],
+            "description": self.description,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Update":
+        return cls(
+            [_mux(m) for m in d.get("withdraw", ())],
+            [Announcement.from_dict(a) for a in d.get("announce", ())],
+            d.get("description"),
+        )
 
-@dataclasses_json.dataclass_json
-@dataclasses.dataclass
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    @classmethod
+    def from_json(cls, data: str | bytes) -> "Update":
+        return cls.from_dict(json.loads(data))
+
+
+@dataclasses.dataclass(slots=True)
 class UpdateSet:
     prefix2update: dict[str, Update]
 
+    def to_dict(self) -> dict:
+        return {
+            "prefix2update": {p: u.to_dict() for p, u in self.prefix2update.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "UpdateSet":
+        p2u = d["prefix2update"]
+        return cls({p: Update.from_dict(u) for p, u in p2u.items()})
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    @classmethod
+    def from_json(cls, data: str | bytes) -> "UpdateSet":
+        return cls.from_dict(json.loads(data))
+
+
+def announcement_key(ann: Announcement) -> tuple:
+    """Canonical hashable form of the export policy of ann, ignoring its muxes"""
+    return (
+        tuple(ann.peer_ids),
+        tuple(tuple(c) for c in ann.communities),
+        tuple(tuple(c) for c in ann.large_communities),
+        tuple(ann.prepend),
+    )
+
 
 class Vultr:
     @staticmethod
@@ -202,6 +327,563 @@ class PeeringCommunities:
         return (47065, peer_id)
 
 
+@dataclasses.dataclass
+class BirdReply:
+    """Reply to a command sent over the BIRD control socket"""
+
+    code: int
+    """Numeric code of the final reply line (e.g., 3 for 0003 Reconfigured)"""
+    message: str
+    """Text of the final reply line"""
+    lines: list[tuple[int, str]] = dataclasses.field(default_factory=list)
+    """All reply lines as (code, text); continuation lines repeat the code"""
+    elapsed: float = 0.0
+    """Seconds between sending the command and receiving the final line"""
+
+    @property
+    def ok(self) -> bool:
+        return self.code < 8000
+
+    def text(self, code: int | None = None) -> str:
+        """Join reply lines (optionally only those with code) into a string"""
+        return "\n".join(t for c, t in self.lines if code is None or c == code)
+
+
+class BirdControl:
+    """Long-lived client for the BIRD control socket
+
+    Talks the protocol birdc uses: every reply line starts with a four-digit
+    code followed by "-" (more lines follow) or " " (last line), and lines
+    starting with a space continue the previous code.  Codes 0xxx are final
+    success replies, 1xxx/2xxx carry table output, and 8xxx/9xxx are errors.
+    The connection is opened lazily and reopened once if BIRD closed it.
+    """
+
+    def __init__(self, sockpath: pathlib.Path, timeout: float = BIRD_CTL_TIMEOUT):
+        self.sockpath = pathlib.Path(sockpath)
+        self.timeout = timeout
+        self.__sock: socket.socket | None = None
+        self.__rfile = None
+        self.welcome: BirdReply | None = None
+
+    def connect(self) -> None:
+        if self.__sock is not None:
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(str(self.sockpath))
+        except OSError:
+            sock.close()
+            raise
+        self.__sock = sock
+        self.__rfile = sock.makefile("r", encoding="utf8", newline="\n")
+        self.welcome = self.__read_reply(time.monotonic())
+        logging.debug("connected to %s: %s", self.sockpath, self.welcome.message)
+
+    def close(self) -> None:
+        if self.__sock is None:
+            return
+        self.__rfile.close()
+        self.__sock.close()
+        self.__sock = None
+        self.__rfile = None
+
+    def command(self, cmd: str) -> BirdReply:
+        for attempt in (0, 1):
+            self.connect()
+            assert self.__sock is not None
+            start = time.monotonic()
+            try:
+                self.__sock.sendall(f"{cmd}\n".encode("utf8"))
+            except (BrokenPipeError, ConnectionResetError):
+                # BIRD closed an idle connection (e.g., restart); retry once
+                self.close()
+                if attempt:
+                    raise
+                continue
+            try:
+                return self.__read_reply(start)
+            except (OSError, EOFError):
+                self.close()
+                raise
+        raise AssertionError("unreachable")
+
+    def configure(self) -> BirdReply:
+        return self.command("configure")
+
+    def __read_reply(self, start: float) -> BirdReply:
+        lines: list[tuple[int, str]] = []
+        while True:
+            line = self.__rfile.readline()
+            if not line:
+                raise EOFError(f"{self.sockpath} closed while reading reply")
+            if _bird_line(line, lines):
+                code, message = lines[-1]
+                return BirdReply(code, message, lines, time.monotonic() - start)
+
+
+class AsyncBirdControl:
+    """asyncio version of BirdControl
+
+    Commands on one connection are serialized; use one instance per socket.
+    """
+
+    def __init__(self, sockpath: pathlib.Path, timeout: float = BIRD_CTL_TIMEOUT):
+        import asyncio  # noqa: PLC0415
+
+        self.sockpath = pathlib.Path(sockpath)
+        self.timeout = timeout
+        self.__reader: "asyncio.StreamReader | None" = None
+        self.__writer: "asyncio.StreamWriter | None" = None
+        self.__lock = asyncio.Lock()
+        self.welcome: BirdReply | None = None
+
+    async def connect(self) -> None:
+        import asyncio  # noqa: PLC0415
+
+        if self.__writer is not None:
+            return
+        self.__reader, self.__writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(str(self.sockpath)), self.timeout
+        )
+        try:
+            self.welcome = await asyncio.wait_for(
+                self.__read_reply(time.monotonic()), self.timeout
+            )
+        except (OSError, EOFError):
+            await self.close()
+            raise
+        logging.debug("connected to %s: %s", self.sockpath, self.welcome.message)
+
+    async def close(self) -> None:
+        if self.__writer is None:
+            return
+        writer = self.__writer
+        self.__reader = None
+        self.__writer = None
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def command(self, cmd: str) -> BirdReply:
+        import asyncio  # noqa: PLC0415
+
+        async with self.__lock:
+            for attempt in (0, 1):
+                await self.connect()
+                assert self.__writer is not None
+                start = time.monotonic()
+                try:
+                    self.__writer.write(f"{cmd}\n".encode("utf8"))
+                    await self.__writer.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    # BIRD closed an idle connection (e.g., restart); retry once
+                    await self.close()
+                    if attempt:
+                        raise
+                    continue
+                try:
+                    reply = self.__read_reply(start)
+                    return await asyncio.wait_for(reply, self.timeout)
+                except (OSError, EOFError):
+                    await self.close()
+                    raise
+        raise AssertionError("unreachable")
+
+    async def configure(self) -> BirdReply:
+        return await self.command("configure")
+
+    async def __read_reply(self, start: float) -> BirdReply:
+        assert self.__reader is not None
+        lines: list[tuple[int, str]] = []
+        while True:
+            line = await self.__reader.readline()
+            if not line:
+                raise EOFError(f"{self.sockpath} closed while reading reply")
+            if _bird_line(line.decode("utf8"), lines):
+                code, message = lines[-1]
+                return BirdReply(code, message, lines, time.monotonic() - start)
+
+
+def _bird_line(line: str, lines: list[tuple[int, str]]) -> bool:
+    """Append a control socket line to lines, return whether it ends the reply"""
+    line = line.rstrip("\n")
+    if line.startswith((" ", "+")):
+        lines.append((lines[-1][0] if lines else 0, line[1:]))
+        return False
+    code = int(line[:4])
+    lines.append((code, line[5:]))
+    return line[4:5] != "-" and code < 1000 or code >= 8000
+
+
+class FilterLayout(enum.StrEnum):
+    """How export filters are split into files under prefix-filters/"""
+
+    PER_PREFIX = "per-prefix"
+    """One export_<mux>_<prefix>.conf file for each (mux, prefix)"""
+    PER_MUX = "per-mux"
+    """One export_<mux>_v<4|6>.conf file per mux holding clauses for all prefixes"""
+
+
+@dataclasses.dataclass
+class FilterDiff:
+    """Changes needed to bring prefix-filters/ to the requested state"""
+
+    write: dict[str, str] = dataclasses.field(default_factory=dict)
+    """Filter file names to (re)write, mapped to their new contents"""
+    remove: set[str] = dataclasses.field(default_factory=set)
+    """Filter file names to remove"""
+    versions: set[int] = dataclasses.field(default_factory=set)
+    """IP versions (4 or 6) whose BIRD daemon needs reconfiguring"""
+    prefixes: set[str] = dataclasses.field(default_factory=set)
+    """Prefixes whose export filter changes for at least one mux"""
+
+    def __bool__(self) -> bool:
+        return bool(self.write or self.remove)
+
+
+class FlapPolicy(enum.StrEnum):
+    """What deploy() does with changes exceeding the flap budget of a prefix"""
+
+    RECORD = "record"
+    """Deploy anyway, only recording the events"""
+    REFUSE = "refuse"
+    """Raise FlapBudgetError with the earliest time the changes fit"""
+    DELAY = "delay"
+    """Wait until the changes fit in the budget, then deploy"""
+
+
+class FlapBudgetError(RuntimeError):
+    """Deploying would exceed the flap budget of some prefixes"""
+
+    def __init__(self, prefix2earliest: dict[str, float]) -> None:
+        self.prefix2earliest = prefix2earliest
+        """Maps prefixes over budget to the earliest Unix time they fit"""
+        self.earliest = max(prefix2earliest.values())
+        """Earliest Unix time all changes fit in the budget"""
+        prefixes = ", ".join(sorted(prefix2earliest))
+        super().__init__(
+            f"flap budget exceeded for {prefixes}, earliest safe time "
+            f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.earliest))}"
+        )
+
+
+class FlapLedger:
+    """Persistent record of route changes per prefix, with a budget against dampening
+
+    A prefix may change at most max_events times in any window seconds, and
+    only while the decayed penalty a neighbor assigns it (FLAP_PENALTY per
+    change, halved every FLAP_HALF_LIFE seconds) stays at most max_penalty,
+    below common suppress thresholds.  Events are Unix timestamps kept in a
+    JSON file; callers hold the filter lock while using it.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        max_events: int = FLAP_MAX_EVENTS,
+        window: float = FLAP_WINDOW,
+        max_penalty: float = FLAP_MAX_PENALTY,
+    ) -> None:
+        assert max_events > 0
+        assert max_penalty > FLAP_PENALTY
+        self.path = pathlib.Path(path)
+        self.max_events = max_events
+        self.window = window
+        self.max_penalty = max_penalty
+        self.prefix2events: dict[str, list[float]] = {}
+
+    def load(self) -> None:
+        self.prefix2events = {}
+        try:
+            with open(self.path, encoding="utf8") as fd:
+                self.prefix2events = json.load(fd)
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError:
+            logging.warning("ignoring corrupt flap ledger %s", self.path)
+
+    def save(self, now: float) -> None:
+        horizon = now - max(self.window, FLAP_RETENTION)
+        state = {}
+        for prefix, events in self.prefix2events.items():
+            if events := [t for t in events if t > horizon]:
+                state[prefix] = events
+        tmpfile = self.path.with_suffix(".tmp")
+        with open(tmpfile, "w", encoding="utf8") as fd:
+            fd.write(json.dumps(state))
+        tmpfile.replace(self.path)
+        self.prefix2events = state
+
+    def events(self, prefix: str, now: float) -> list[float]:
+        """Timestamps of events for prefix in the window ending at now"""
+        start = now - self.window
+        return sorted(t for t in self.prefix2events.get(prefix, []) if t > start)
+
+    def penalty(self, prefix: str, now: float) -> float:
+        """Decayed dampening penalty of the events for prefix up to now"""
+        return sum(
+            FLAP_PENALTY * 0.5 ** ((now - t) / FLAP_HALF_LIFE)
+            for t in self.prefix2events.get(prefix, [])
+            if t <= now
+        )
+
+    def earliest(self, prefix: str, now: float) -> float:
+        """Earliest time another event for prefix fits in the budget"""
+        events = self.events(prefix, now)
+        earliest = now
+        if len(events) >= self.max_events:
+            earliest = events[len(events) - self.max_events] + self.window
+        penalty = self.penalty(prefix, earliest)
+        allowance = self.max_penalty - FLAP_PENALTY
+        # The tolerance keeps rounding from pushing back a time already waited for
+        if penalty > allowance + 1e-6:
+            earliest += FLAP_HALF_LIFE * math.log2(penalty / allowance)
+        return earliest
+
+    def record(self, prefixes: Iterable[str], now: float) -> None:
+        self.load()
+        for prefix in prefixes:
+            self.prefix2events.setdefault(prefix, []).append(now)
+        self.save(now)
+
+
+@dataclasses.dataclass(frozen=True)
+class ExportedRoute:
+    """Attributes of a route as BIRD exports it to a mux"""
+
+    communities: frozenset[tuple[int, int]] = frozenset()
+    large_communities: frozenset[tuple[int, int, int]] = frozenset()
+
+    @classmethod
+    def from_announcement(cls, ann: Announcement) -> "ExportedRoute":
+        """Attributes the export filter rendered for ann adds to the route"""
+        communities = {(PEERING_ASN, peerid) for peerid in ann.peer_ids}
+        communities.update(tuple(c) for c in ann.communities)
+        large = frozenset(tuple(c) for c in ann.large_communities)
+        return cls(frozenset(communities), large)
+
+
+@dataclasses.dataclass(frozen=True)
+class ExportPolicy:
+    """What the export filter of a prefix does at one mux, however it is spelled
+
+    Peer IDs become the communities the filter adds for them, and community
+    lists become sets, so announcements that render equivalent filters
+    compare (and hash) equal.
+    """
+
+    prepend: tuple[int, ...] = ()
+    communities: frozenset[tuple[int, int]] = frozenset()
+    large_communities: frozenset[tuple[int, int, int]] = frozenset()
+
+    @classmethod
+    def from_announcement(cls, ann: Announcement) -> "ExportPolicy":
+        route = ExportedRoute.from_announcement(ann)
+        return cls(tuple(ann.prepend), route.communities, route.large_communities)
+
+
+def export_policy(update: Update) -> dict[str, ExportPolicy]:
+    """Map the muxes update announces from to their effective export policy
+
+    Follows AnnouncementController.diff(): withdrawals apply first and later
+    announcements for a mux replace earlier ones.  Muxes left out do not
+    announce, as when update is deployed on a withdrawn prefix.
+    """
+    mux2policy = {}
+    for ann in update.announce:
+        policy = ExportPolicy.from_announcement(ann)
+        for mux in ann.muxes:
+            mux2policy[str(mux)] = policy
+    return mux2policy
+
+
+def update_key(update: Update) -> frozenset[tuple[str, ExportPolicy]]:
+    """Hashable canonical form of update, equal for updates with the same effect"""
+    return frozenset(export_policy(update).items())
+
+
+class ExportConfirmationError(RuntimeError):
+    """BIRD did not export the expected routes to some muxes in time"""
+
+    def __init__(self, mux2diff: dict[str, list[str]], elapsed: float) -> None:
+        self.mux2diff = mux2diff
+        """Maps muxes to differences between expected and exported routes"""
+        self.elapsed = elapsed
+        lines = [f"{mux}: {'; '.join(diff)}" for mux, diff in sorted(mux2diff.items())]
+        super().__init__(
+            f"exports not confirmed after {elapsed:.1f}s\n" + "\n".join(lines)
+        )
+
+
+class FilterLock:
+    """Exclusive flock serializing filter changes and reconfigures across processes
+
+    Reentrant: only the outermost acquire() and release() touch the lock.
+    The lock file is created on first use.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = pathlib.Path(path)
+        self.depth = 0
+        self.__fd: int | None = None
+
+    def acquire(self) -> None:
+        if self.depth == 0:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                os.close(fd)
+                raise
+            self.__fd = fd
+        self.depth += 1
+
+    def release(self) -> None:
+        assert self.depth > 0 and self.__fd is not None
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.__fd, fcntl.LOCK_UN)
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __enter__(self) -> "FilterLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class AnnouncementValidationError(ValueError):
+    def __init__(self, errors: list[str]) -> None:
+        super().__init__(f"{len(errors)} errors: " + "; ".join(errors))
+        self.errors = errors
+
+
+class UpdateSetValidator:
+    """Validator for UpdateSets compiled from the announcement JSON schema
+
+    Checks the dataclasses directly instead of converting them to dicts and
+    running a generic JSON schema validator.  Mux names, the prefix pattern,
+    ASN ranges and array limits are read from the schema; communities must
+    have two 16-bit values and large communities three 32-bit values.  All
+    errors are collected and raised together.  Use from_file() to share
+    compiled validators among controllers.
+    """
+
+    def __init__(self, schema: dict) -> None:
+        self.schema = schema
+        defs = schema["definitions"]
+        self.muxes = frozenset(defs["peeringMux"]["enum"])
+        self.prefix_regex = re.compile(defs["prefix"]["pattern"])
+        self.asn_min = defs["ASN"].get("minimum", 0)
+        self.asn_max = defs["ASN"].get("maximum", 2**32 - 1)
+        props = defs["announcement"]["properties"]
+        self.muxes_min = props["muxes"].get("minItems", 0)
+        self.muxes_unique = props["muxes"].get("uniqueItems", False)
+        self.communities_unique = props["communities"].get("uniqueItems", False)
+        self.prepend_max = props["prepend"].get("maxItems")
+        self.checked: set[tuple] = set()
+        """announcement_key()s of announcements that passed validation"""
+
+    @classmethod
+    def from_file(cls, schema_file: pathlib.Path) -> "UpdateSetValidator":
+        """Return the validator for schema_file, compiling it if it changed"""
+        return _load_cached(schema_file, cls.__load)
+
+    @classmethod
+    def __load(cls, path: pathlib.Path) -> "UpdateSetValidator":
+        with open(path, encoding="utf8") as fd:
+            return cls(json.load(fd))
+
+    def validate(
+        self,
+        updates: UpdateSet,
+        networks: list[IPv4Network | IPv6Network] | None = None,
+    ) -> None:
+        """Raise AnnouncementValidationError listing every problem in updates
+
+        If networks is given, prefixes must be inside one of them.
+        """
+        errors: list[str] = []
+        if not updates.prefix2update:
+            errors.append("no prefixes in UpdateSet")
+        for prefix, update in updates.prefix2update.items():
+            errors.extend(self.__check_prefix(prefix, networks))
+            errors.extend(f"{prefix}: {e}" for e in self.check_update(update))
+        if errors:
+            raise AnnouncementValidationError(errors)
+
+    def validate_updates(self, updates: Iterable[Update]) -> None:
+        """Validate a list of Updates (e.g., a phase) before assigning prefixes"""
+        errors: list[str] = []
+        for i, update in enumerate(updates):
+            name = update.description or f"update {i}"
+            errors.extend(f"{name}: {e}" for e in self.check_update(update))
+        if errors:
+            raise AnnouncementValidationError(errors)
+
+    def check_update(self, update: Update) -> list[str]:
+        errors = [
+            f"unknown mux {m!r} in withdraw"
+            for m in update.withdraw
+            if m not in self.muxes
+        ]
+        for ann in update.announce:
+            errors.extend(self.check_announcement(ann))
+        return errors
+
+    def check_announcement(self, ann: Announcement) -> list[str]:
+        errors = []
+        if len(ann.muxes) < self.muxes_min:
+            errors.append(f"announcement needs at least {self.muxes_min} muxes")
+        if self.muxes_unique and len(set(ann.muxes)) != len(ann.muxes):
+            errors.append("repeated muxes in announcement")
+        errors.extend(f"unknown mux {m!r}" for m in ann.muxes if m not in self.muxes)
+        key = announcement_key(ann)
+        if key in self.checked:
+            return errors
+        peer_ids, communities, large_communities, prepend = key
+        for peerid in peer_ids:
+            if not isinstance(peerid, int) or not 0 <= peerid <= 0xFFFF:
+                errors.append(f"invalid peer ID {peerid!r}")
+        if self.communities_unique and len(set(communities)) != len(communities):
+            errors.append("repeated communities")
+        for c in communities:
+            if len(c) != 2 or not all(_is_uint(v, 0xFFFF) for v in c):
+                errors.append(f"invalid community {c!r}")
+        for c in large_communities:
+            if len(c) != 3 or not all(_is_uint(v, 0xFFFFFFFF) for v in c):
+                errors.append(f"invalid large community {c!r}")
+        if self.prepend_max is not None and len(prepend) > self.prepend_max:
+            errors.append(f"more than {self.prepend_max} prepended ASNs")
+        for asn in prepend:
+            if not isinstance(asn, int) or not self.asn_min <= asn <= self.asn_max:
+                errors.append(f"invalid prepended ASN {asn!r}")
+        if not errors:
+            self.checked.add(key)
+        return errors
+
+    def __check_prefix(
+        self, prefix: str, networks: list[IPv4Network | IPv6Network] | None
+    ) -> list[str]:
+        if not isinstance(prefix, str) or not self.prefix_regex.match(prefix):
+            return [f"invalid prefix {prefix!r}"]
+        try:
+            net = ipaddress.ip_network(prefix)
+        except ValueError as e:
+            return [f"invalid prefix {prefix!r}: {e}"]
+        if networks and not any(
+            net.version == n.version and net.subnet_of(n) for n in networks
+        ):
+            return [f"prefix {prefix} is not allocated to this client"]
+        return []
+
+
 class AnnouncementController:
     def __init__(
         self,
@@ -211,99 +893,1136 @@ class AnnouncementController:
         bird6_sock: pathlib.Path = DEFAULT_BIRD6_SOCK_PATH,
         schema_file: pathlib.Path = DEFAULT_ANNOUNCEMENT_SCHEMA,
         mux2tap_file: pathlib.Path = DEFAULT_MUX2TAP_PATH,
+        use_birdc: bool = False,
+        staged: bool = False,
+        use_iproute2: bool = False,
+        filter_layout: FilterLayout = FilterLayout.PER_PREFIX,
+        template_cache_dir: pathlib.Path | None = DEFAULT_TEMPLATE_CACHE_DIR,
+        reload_window: float = RELOAD_WINDOW,
+        flap_max_events: int = FLAP_MAX_EVENTS,
+        flap_window: float = FLAP_WINDOW,
+        flap_max_penalty: float = FLAP_MAX_PENALTY,
+        flap_policy: FlapPolicy = FlapPolicy.RECORD,
     ) -> None:
         assert bird_cfg_dir.exists(), str(bird_cfg_dir)
         self.bird_cfg_dir = pathlib.Path(bird_cfg_dir)
         assert bird4_sock.exists() or bird6_sock.exists()
         self.bird4_sock = bird4_sock
         self.bird6_sock = bird6_sock
-        with open(schema_file, encoding="utf8") as fd:
-            self.schema = json.load(fd)
-        self.mux2id: dict[str, int] = {}
-        with open(mux2tap_file, encoding="utf8") as fd:
-            for line in fd:
-                mux, tapdev = line.strip().split()
-                assert tapdev.startswith("tap")
-                self.mux2id[mux] = int(tapdev.removeprefix("tap"))
-        self.config_template = self.__load_config_template()
+        self.use_birdc = use_birdc
+        """Reconfigure by running birdc instead of talking to the socket"""
+        self.birdctl: dict[int, BirdControl] = {}
+        self.reload_latency: dict[int, float] = {}
+        """Seconds taken by the last reconfigure of each IP version"""
+        self.use_iproute2 = use_iproute2
+        self.__egress: NetlinkEgress | IpRouteEgress | None = None
+        self.validator = UpdateSetValidator.from_file(schema_file)
+        self.schema = self.validator.schema
+        self.mux2id: dict[str, int] = dict(_load_cached(mux2tap_file, _read_mux2id))
+        self.template_cache_dir = template_cache_dir
+        self.__config_template: "jinja2.Template | None" = None
+        self.render_cache: collections.OrderedDict[tuple, str] = (
+            collections.OrderedDict()
+        )
+        """LRU cache of rendered filters keyed by (prefix, announcement_key(ann))"""
+        self.render_hits = 0
+        self.render_misses = 0
         self.prefixes = prefixes
+        self.networks = [ipaddress.ip_network(p) for p in prefixes]
         self.__create_routes()
+        self.filters_dir = self.bird_cfg_dir / "prefix-filters"
+        self.generations_dir = self.bird_cfg_dir / FILTER_GENERATIONS_DN
+        self.staged = staged
+        """Stage filter changes in a new directory and swap it in atomically"""
+        if staged:
+            self.__init_generations()
+        self.filters_dir.mkdir(parents=True, exist_ok=True)
+        self.filter_layout = FilterLayout(filter_layout)
+        self.state_file = self.bird_cfg_dir / FILTER_STATE_FN
+        self.__state_stat: tuple[int, int, int] | None = None
+        self.__filter_stats: dict[str, list[int]] = {}
+        self.deployed: dict[str, str] = self.__load_deployed()
+        """Mirror of prefix-filters/, maps file names to SHA-256 of their contents"""
+        self.mux_clauses: dict[str, dict[str, str]] = {}
+        """Parsed per-mux filter files, maps file names to {prefix: clause}"""
+        self.pending_versions: set[int] = set()
+        """IP versions with filter changes not yet pushed to BIRD"""
+        self.lock = FilterLock(self.bird_cfg_dir / FILTER_LOCK_FN)
+        """Held while changing prefix-filters/ and reconfiguring BIRD"""
+        self.reload_state_file = self.bird_cfg_dir / RELOAD_STATE_FN
+        self.reload_window = reload_window
+        """Seconds reload_pending() waits for other processes' changes to merge"""
+        self.reload_stats: collections.Counter[str] = collections.Counter()
+        """Reconfigures this process ran ("configures") and skipped because
+        one by any process had covered its changes ("coalesced")"""
+        self.__changes: dict[int, int] = {}
+        """Change number of this process' last unreloaded change per IP version"""
+        self.confirm_latency: float | None = None
+        """Seconds the last confirm_exports() waited for BIRD's exports"""
+        self.flap_ledger = FlapLedger(
+            self.bird_cfg_dir / FLAP_LEDGER_FN,
+            flap_max_events,
+            flap_window,
+            flap_max_penalty,
+        )
+        self.flap_policy = FlapPolicy(flap_policy)
+        self.__show_pool: dict[int, list[BirdControl]] = {}
+        self.__show_lock = threading.Lock()
+
+    @property
+    def egress(self) -> "NetlinkEgress | IpRouteEgress":
+        """Egress backend, opened (with its rtnetlink socket) on first use"""
+        if self.__egress is None:
+            self.__egress = _egress_backend(self.use_iproute2)
+        return self.__egress
+
+    @egress.setter
+    def egress(self, backend: "NetlinkEgress | IpRouteEgress") -> None:
+        self.__egress = backend
+
+    @property
+    def config_template(self) -> "jinja2.Template":
+        if self.__config_template is None:
+            self.__config_template = self.__load_config_template(
+                self.template_cache_dir
+            )
+        return self.__config_template
+
+    def __load_config_template(
+        self, cache_dir: pathlib.Path | None
+    ) -> "jinja2.Template":
+        path = self.bird_cfg_dir / "templates/export_mux_pfx.jinja2"
+        return _load_cached(path, _read_template, cache_dir)
+
+    def render(self, prefix: str, ann: Announcement) -> str:
+        """Render the export filter of ann for prefix, reusing cached renders
+
+        The template does not depend on the muxes of an announcement, so every
+        mux (and every Update) sharing an announcement spec shares the render.
+        """
+        key = (prefix, announcement_key(ann))
+        data = self.render_cache.get(key)
+        if data is not None:
+            self.render_hits += 1
+            self.render_cache.move_to_end(key)
+            return data
+        self.render_misses += 1
+        data = self.config_template.render(prefix=prefix, spec=ann.to_dict())
+        self.render_cache[key] = data
+        if len(self.render_cache) > RENDER_CACHE_SIZE:
+            self.render_cache.popitem(last=False)
+        return data
 
-    def __load_config_template(self) -> jinja2.Template:
-        path = self.bird_cfg_dir / "templates"
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(path), autoescape=True)
-        return env.get_template("export_mux_pfx.jinja2")
+    @staticmethod
+    def __prefix_key(prefix: str) -> str:
+        prefix = prefix.replace("/", "-")
+        return prefix.replace(":", "i")  # removing colon from v6 prefixes
+
+    def __config_fn(self, prefix: str, mux: MuxName) -> str:
+        assert _prefix_version(prefix)
+        return f"export_{mux}_{self.__prefix_key(prefix)}.conf"
 
     def __config_file(self, prefix: str, mux: MuxName) -> pathlib.Path:
-        assert ipaddress.ip_network(prefix) is not None
-        prefix = prefix.replace("/", "-")
-        prefix = prefix.replace(":", "i")  # removing colon from v6 prefixes
-        fn = f"export_{mux}_{prefix}.conf"
-        return self.bird_cfg_dir / "prefix-filters" / fn
+        return self.filters_dir / self.__config_fn(prefix, mux)
 
     def __create_routes(self) -> None:
+        """Write the static route of each prefix, skipping up-to-date files"""
         path = self.bird_cfg_dir / "route-announcements"
         path.mkdir(parents=True, exist_ok=True)
         for pfx in self.prefixes:
             fpath = path / str(pfx).replace("/", "-")
-            fd = open(fpath, "w", encoding="utf8")
-            fd.write(f"route {pfx} unreachable;\n")
-            fd.close()
+            data = f"route {pfx} unreachable;\n"
+            try:
+                with open(fpath, encoding="utf8") as fd:
+                    if fd.read() == data:
+                        continue
+            except FileNotFoundError:
+                pass
+            with open(fpath, "w", encoding="utf8") as fd:
+                fd.write(data)
+
+    def __init_generations(self) -> None:
+        """Turn prefix-filters/ into a symlink to prefix-filters.d/<generation>"""
+        if self.filters_dir.is_symlink():
+            return
+        self.generations_dir.mkdir(parents=True, exist_ok=True)
+        gendir = self.generations_dir / "0"
+        if self.filters_dir.exists():
+            logging.info("moving %s into %s", self.filters_dir, gendir)
+            self.filters_dir.rename(gendir)
+        else:
+            gendir.mkdir()
+        self.__flip(gendir)
+
+    def __live_generation(self) -> pathlib.Path:
+        return self.generations_dir / os.readlink(self.filters_dir).rsplit("/", 1)[1]
+
+    def __flip(self, gendir: pathlib.Path) -> None:
+        """Atomically point prefix-filters at gendir"""
+        tmplink = self.bird_cfg_dir / "prefix-filters.tmp"
+        tmplink.unlink(missing_ok=True)
+        tmplink.symlink_to(gendir.relative_to(self.bird_cfg_dir))
+        tmplink.replace(self.filters_dir)
+
+    def __stage(self, diff: FilterDiff) -> pathlib.Path:
+        """Build a new generation with diff applied on top of the live one"""
+        live = self.__live_generation()
+        gens = [int(p.name) for p in self.generations_dir.iterdir() if p.name.isdigit()]
+        gendir = self.generations_dir / str(max(gens) + 1)
+        gendir.mkdir()
+        with os.scandir(live) as it:
+            for entry in it:
+                if entry.name in diff.remove or entry.name in diff.write:
+                    continue
+                # Files are never modified in place, so generations can share them
+                os.link(entry.path, gendir / entry.name)
+        for fn, data in diff.write.items():
+            with open(gendir / fn, "w", encoding="utf8") as fd:
+                fd.write(data)
+        return gendir
+
+    def prune_generations(self) -> None:
+        """Remove generations other than the live and the previous one"""
+        gens = sorted(
+            int(p.name) for p in self.generations_dir.iterdir() if p.name.isdigit()
+        )
+        for gen in gens[:-2]:
+            shutil.rmtree(self.generations_dir / str(gen))
+
+    def __load_deployed(self) -> dict[str, str]:
+        """Load the filter mirror, reconciling it with prefix-filters/
+
+        The state file stores the digest, size and mtime of each filter file.
+        Files whose size or mtime changed since the state file was written
+        (e.g., edited by ./peering prefix) are rehashed; missing files are
+        dropped from the mirror.
+        """
+        saved: dict[str, list] = {}
+        self.__state_stat = _stat_key(self.state_file)
+        try:
+            with open(self.state_file, encoding="utf8") as fd:
+                saved = json.load(fd)
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError:
+            logging.warning("ignoring corrupt filter state %s", self.state_file)
+        deployed: dict[str, str] = {}
+        self.__filter_stats = {}
+        with os.scandir(self.filters_dir) as it:
+            for entry in it:
+                if not entry.name.startswith("export_") or not entry.is_file():
+                    continue
+                st = entry.stat()
+                self.__filter_stats[entry.name] = [st.st_size, st.st_mtime_ns]
+                entry_state = saved.get(entry.name)
+                if entry_state and entry_state[1:] == [st.st_size, st.st_mtime_ns]:
+                    deployed[entry.name] = entry_state[0]
+                else:
+                    with open(entry.path, encoding="utf8") as fd:
+                        deployed[entry.name] = _digest(fd.read())
+        return deployed
+
+    def __save_deployed(self) -> None:
+        """Write the state file, statting only files changed since the last save"""
+        state: dict[str, list] = {}
+        for fn, digest in self.deployed.items():
+            if fn not in self.__filter_stats:
+                st = os.stat(os.path.join(self.filters_dir, fn))
+                self.__filter_stats[fn] = [st.st_size, st.st_mtime_ns]
+            state[fn] = [digest, *self.__filter_stats[fn]]
+        tmpfile = self.state_file.with_suffix(".tmp")
+        with open(tmpfile, "w", encoding="utf8") as fd:
+            fd.write(json.dumps(state))
+        tmpfile.replace(self.state_file)
+        self.__state_stat = _stat_key(self.state_file)
+
+    def acquire(self) -> None:
+        """Take the filter lock, reloading the mirror if another process changed it"""
+        self.lock.acquire()
+        if self.lock.depth > 1:
+            return
+        try:
+            if _stat_key(self.state_file) != self.__state_stat:
+                logging.info("filters changed by another process, reloading state")
+                self.deployed = self.__load_deployed()
+                self.mux_clauses.clear()
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def release(self) -> None:
+        self.lock.release()
+
+    @contextlib.contextmanager
+    def locked(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def covered_reloads(
+        self, versions: Iterable[int]
+    ) -> tuple[dict[int, BirdReply], list[int]]:
+        """Split versions by whether a reconfigure already covered our changes
+
+        Returns the replies of reconfigures (run by any process sharing
+        bird_cfg_dir) that loaded this process' latest changes, and the
+        versions that still need a reconfigure.  Call with the lock held.
+        """
+        state = self.__load_reload_state()
+        replies: dict[int, BirdReply] = {}
+        todo = []
+        for version in sorted(set(versions)):
+            reload = state["reloads"].get(str(version))
+            change = self.__changes.get(version)
+            if change is None or reload is None or reload["covers"] < change:
+                todo.append(version)
+                continue
+            reply = BirdReply(**reload["reply"])
+            replies[version] = reply
+            del self.__changes[version]
+            if reply.ok:
+                self.pending_versions.discard(version)
+            self.reload_stats["coalesced"] += 1
+            state["coalesced"] += 1
+            logging.info(
+                "BIRD%d reconfigure by another deploy covered our changes: %04d %s",
+                version,
+                reply.code,
+                reply.message,
+            )
+        if replies:
+            self.__save_reload_state(state)
+        return replies, todo
+
+    def record_reloads(self, replies: dict[int, BirdReply]) -> None:
+        """Record reconfigures run with the lock held for other processes"""
+        if not replies:
+            return
+        state = self.__load_reload_state()
+        for version, reply in replies.items():
+            state["reloads"][str(version)] = {
+                "covers": state["changes"].get(str(version), 0),
+                "reply": dataclasses.asdict(reply),
+            }
+            self.__changes.pop(version, None)
+            self.reload_stats["configures"] += 1
+            state["configures"] += 1
+        self.__save_reload_state(state)
+
+    def __record_changes(self, versions: Iterable[int]) -> None:
+        state = self.__load_reload_state()
+        for version in versions:
+            change = state["changes"].get(str(version), 0) + 1
+            state["changes"][str(version)] = change
+            self.__changes[version] = change
+        self.__save_reload_state(state)
+
+    def __load_reload_state(self) -> dict:
+        """Load the record of filter changes and reconfigures shared by processes
+
+        changes maps IP versions to the number of filter changes made so far,
+        reloads maps them to the latest reconfigure and the number of changes
+        it covered, and configures and coalesced count reconfigures run and
+        skipped by all processes.
+        """
+        state: dict = {"changes": {}, "reloads": {}, "configures": 0, "coalesced": 0}
+        try:
+            with open(self.reload_state_file, encoding="utf8") as fd:
+                state.update(json.load(fd))
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError:
+            logging.warning("ignoring corrupt reload state %s", self.reload_state_file)
+        return state
+
+    def __save_reload_state(self, state: dict) -> None:
+        tmpfile = self.reload_state_file.with_suffix(".tmp")
+        with open(tmpfile, "w", encoding="utf8") as fd:
+            fd.write(json.dumps(state))
+        tmpfile.replace(self.reload_state_file)
 
     def validate(self, updates: UpdateSet) -> None:
-        d = {pfx: upd.to_dict() for pfx, upd in updates.prefix2update.items()}
-        jsonschema.validate(d, self.schema)
+        self.validator.validate(updates, self.networks)
 
-    def deploy(self, updates: UpdateSet) -> None:
-        self.validate(updates)
+    def diff(self, updates: UpdateSet) -> FilterDiff:
+        """Compute the filter file changes needed to deploy updates
+
+        Muxes not mentioned in an update keep their current configuration.
+        Files whose rendered contents match the mirror are left out.  Filters
+        deployed under the other layout for the (prefix, mux) pairs touched
+        by updates are removed, so switching layouts never leaves duplicates.
+        """
+        changes: dict[tuple[str, str], str | None] = {}
         for prefix, update in updates.prefix2update.items():
             for mux in update.withdraw:
-                self.withdraw(prefix, mux)
-            for announcement in update.announce:
-                self.announce(prefix, announcement)
-        self.reload_config()
+                if mux == "all":
+                    changes.update(((prefix, m), None) for m in self.__muxes(prefix))
+                else:
+                    changes[(prefix, mux)] = None
+            for ann in update.announce:
+                data = self.render(prefix, ann)
+                for mux in ann.muxes:
+                    changes[(prefix, mux)] = data
+        diff = FilterDiff()
+        per_mux = self.filter_layout == FilterLayout.PER_MUX
+        self.__diff_prefix_files(changes, diff, not per_mux)
+        self.__diff_mux_files(changes, diff, per_mux)
+        return diff
+
+    def __diff_prefix_files(
+        self,
+        changes: dict[tuple[str, str], str | None],
+        diff: FilterDiff,
+        active: bool,
+    ) -> None:
+        for (prefix, mux), data in changes.items():
+            fn = self.__config_fn(prefix, mux)
+            if data is None or not active:
+                if fn not in self.deployed:
+                    continue
+                diff.remove.add(fn)
+            elif self.deployed.get(fn) != _digest(data):
+                diff.write[fn] = data
+            else:
+                continue
+            diff.versions.add(_prefix_version(prefix))
+            if active:
+                diff.prefixes.add(prefix)
 
-    def withdraw(self, prefix: str, mux: MuxName | None = None) -> None:
-        if mux is None or mux == "all":
-            for emux in MuxName:
-                self.withdraw(prefix, emux)
+    def __diff_mux_files(
+        self,
+        changes: dict[tuple[str, str], str | None],
+        diff: FilterDiff,
+        active: bool,
+    ) -> None:
+        fn2changes: dict[str, list[tuple[str, str | None]]] = {}
+        for (prefix, mux), data in changes.items():
+            version = _prefix_version(prefix)
+            fn = _mux_config_fn(mux, version)
+            if fn not in self.deployed and (data is None or not active):
+                continue
+            fn2changes.setdefault(fn, []).append((prefix, data if active else None))
+        for fn, fnchanges in fn2changes.items():
+            clauses = dict(self.__clauses(fn))
+            for prefix, data in fnchanges:
+                old = clauses.get(prefix)
+                if active and (old or "").rstrip() != (data or "").rstrip():
+                    diff.prefixes.add(prefix)
+                if data is None:
+                    clauses.pop(prefix, None)
+                else:
+                    clauses[prefix] = data
+            if not clauses:
+                if fn not in self.deployed:
+                    continue
+                diff.remove.add(fn)
+            else:
+                data = _join_clauses(clauses)
+                if self.deployed.get(fn) == _digest(data):
+                    continue
+                diff.write[fn] = data
+            diff.versions.add(int(MUX_FILTER_REGEX.match(fn).group("version")))
+
+    def __clauses(self, fn: str) -> dict[str, str]:
+        """Map prefixes to their clauses in the per-mux filter file fn"""
+        if fn not in self.deployed:
+            return {}
+        if fn not in self.mux_clauses:
+            with open(self.filters_dir / fn, encoding="utf8") as fd:
+                self.mux_clauses[fn] = _split_clauses(fd.read())
+        return self.mux_clauses[fn]
+
+    def __muxes(self, prefix: str) -> set[str]:
+        """Muxes with a filter for prefix under either layout"""
+        muxes = set()
+        suffix = f"_{self.__prefix_key(prefix)}.conf"
+        for fn in list(self.deployed):
+            if fn.endswith(suffix):
+                muxes.add(fn.removeprefix("export_").removesuffix(suffix))
+            elif (m := MUX_FILTER_REGEX.match(fn)) and prefix in self.__clauses(fn):
+                muxes.add(m.group("mux"))
+        return muxes
+
+    def apply(self, diff: FilterDiff) -> None:
+        """Write and remove filter files in diff, without reconfiguring BIRD
+
+        diff must have been computed with the lock held (see locked()) to
+        account for changes by other processes.
+        """
+        if not diff:
             return
+        with self.locked():
+            self.__apply(diff)
+            self.__record_changes(diff.versions)
+            if diff.prefixes:
+                self.flap_ledger.record(diff.prefixes, time.time())
+
+    def __apply(self, diff: FilterDiff) -> None:
+        if self.staged:
+            self.__flip(self.__stage(diff))
+        for fn in diff.remove:
+            if not self.staged:
+                (self.filters_dir / fn).unlink(missing_ok=True)
+            self.deployed.pop(fn, None)
+            self.__filter_stats.pop(fn, None)
+            self.mux_clauses.pop(fn, None)
+        for fn, data in diff.write.items():
+            if not self.staged:
+                with open(self.filters_dir / fn, "w", encoding="utf8") as fd:
+                    fd.write(data)
+            self.deployed[fn] = _digest(data)
+            self.__filter_stats.pop(fn, None)
+            self.mux_clauses.pop(fn, None)
+        self.pending_versions.update(diff.versions)
+        self.__save_deployed()
+
+    def deploy(
+        self,
+        updates: UpdateSet,
+        confirm: bool = False,
+        confirm_timeout: float = CONFIRM_TIMEOUT,
+        flap_policy: FlapPolicy | None = None,
+    ) -> float | None:
+        """Deploy updates and reconfigure BIRD
+
+        With confirm, also wait until BIRD exports the announced routes (with
+        their communities) to each mux and no longer exports the withdrawn
+        ones, and return the seconds that took; see confirm_exports().
+        Changes exceeding the flap budget of a prefix are handled according
+        to flap_policy (by default, the controller's flap_policy).
+        """
+        self.validate(updates)
+        while True:
+            with self.locked():
+                expected = self.export_expectations(updates) if confirm else {}
+                diff = self.diff(updates)
+                wait = self.flap_wait(diff, flap_policy or self.flap_policy)
+                if wait <= 0:
+                    logging.info(
+                        "deploy writes %d and removes %d filter files",
+                        len(diff.write),
+                        len(diff.remove),
+                    )
+                    staged = self.staged and bool(diff)
+                    if staged:
+                        self.__deploy_staged(diff)
+                    else:
+                        self.apply(diff)
+                    break
+            logging.info("delaying deploy %.0fs to stay within flap budget", wait)
+            time.sleep(wait)
+        if not staged:
+            self.reload_pending()
+        if not confirm:
+            return None
+        return self.confirm_exports(expected, confirm_timeout)
+
+    def earliest_safe_time(self, updates: UpdateSet) -> float:
+        """Return the earliest Unix time deploying updates fits the flap budget"""
+        with self.locked():
+            diff = self.diff(updates)
+            now = time.time()
+            self.flap_ledger.load()
+            return max(
+                (self.flap_ledger.earliest(p, now) for p in diff.prefixes), default=now
+            )
+
+    def flap_wait(self, diff: FilterDiff, policy: FlapPolicy) -> float:
+        """Apply policy to prefixes in diff over their flap budget
+
+        Returns how many seconds to wait before applying diff (0 to apply
+        it now); call with the lock held.  Raises FlapBudgetError under
+        FlapPolicy.REFUSE.
+        """
+        now = time.time()
+        self.flap_ledger.load()
+        over = {}
+        for prefix in diff.prefixes:
+            earliest = self.flap_ledger.earliest(prefix, now)
+            if earliest > now:
+                over[prefix] = earliest
+        if not over:
+            return 0.0
+        if policy == FlapPolicy.REFUSE:
+            raise FlapBudgetError(over)
+        if policy == FlapPolicy.DELAY:
+            return max(over.values()) - now
+        logging.warning(
+            "deploy exceeds flap budget of %d events in %.0fs, penalty %.0f, for %s",
+            self.flap_ledger.max_events,
+            self.flap_ledger.window,
+            self.flap_ledger.max_penalty,
+            ", ".join(sorted(over)),
+        )
+        return 0.0
+
+    def export_expectations(
+        self, updates: UpdateSet
+    ) -> dict[tuple[int, str], dict[str, ExportedRoute | None]]:
+        """Return the routes each mux should export once updates are deployed
+
+        Maps (IP version, mux) to {prefix: attributes}, where None means the
+        prefix must not be exported.  Call before applying updates, as
+        withdrawals from "all" muxes expand to the muxes currently announcing.
+        """
+        expected: dict[tuple[int, str], dict[str, ExportedRoute | None]] = {}
+        for prefix, update in updates.prefix2update.items():
+            network = ipaddress.ip_network(prefix)
+            withdraw = update.withdraw
+            if "all" in withdraw:
+                withdraw = sorted(self.__muxes(prefix))
+            prefix = str(network)
+            for mux in withdraw:
+                expected.setdefault((network.version, str(mux)), {})[prefix] = None
+            for ann in update.announce:
+                route = ExportedRoute.from_announcement(ann)
+                for mux in ann.muxes:
+                    expected.setdefault((network.version, str(mux)), {})[prefix] = route
+        return expected
+
+    def confirm_exports(
+        self,
+        expected: dict[tuple[int, str], dict[str, ExportedRoute | None]],
+        timeout: float = CONFIRM_TIMEOUT,
+    ) -> float:
+        """Wait until BIRD's export view of every mux matches expected
+
+        Queries `show route export <mux> all` for all muxes concurrently,
+        every CONFIRM_INTERVAL seconds, until each mux exports the expected
+        prefixes with at least the expected communities and none of the
+        withdrawn ones.  Muxes whose BGP session is down are skipped, as
+        BIRD exports nothing to them.  Returns the seconds taken (also kept
+        in confirm_latency) or raises ExportConfirmationError with the
+        remaining differences per mux after timeout seconds.
+        """
+        import concurrent.futures  # noqa: PLC0415
+
+        start = time.monotonic()
+        versions = {key[0] for key in expected if self.has_socket(key[0])}
+        down = {version: self.down_muxes(version) for version in versions}
+        pending = _confirmable(expected, down)
+        nworkers = max(1, min(CONFIRM_CONNECTIONS, len(pending)))
+        with concurrent.futures.ThreadPoolExecutor(nworkers) as executor:
+            while True:
+                key2future = {
+                    key: executor.submit(self.__export_diff, key, prefix2route)
+                    for key, prefix2route in pending.items()
+                }
+                mux2diff = {}
+                for key, future in key2future.items():
+                    if diff := future.result():
+                        mux2diff[f"{key[1]} (BIRD{key[0]})"] = diff
+                    else:
+                        del pending[key]
+                elapsed = time.monotonic() - start
+                if not pending:
+                    break
+                if elapsed > timeout:
+                    raise ExportConfirmationError(mux2diff, elapsed)
+                time.sleep(CONFIRM_INTERVAL)
+        self.confirm_latency = elapsed
+        logging.info(
+            "BIRD exports confirmed for %d muxes in %.3fs", len(expected), elapsed
+        )
+        return elapsed
+
+    def down_muxes(self, version: int) -> set[str]:
+        """Muxes whose BGP session in BIRD (of IP version) is not established
+
+        Returns an empty set if BIRD cannot be queried.
+        """
+        sockpath = self.bird_sock(version)
+        with self.__show_lock:
+            pool = self.__show_pool.setdefault(version, [])
+            ctl = pool.pop() if pool else BirdControl(sockpath)
         try:
-            self.__config_file(prefix, mux).unlink()
-        except FileNotFoundError:
-            pass
+            reply = ctl.command("show protocols")
+        except (OSError, EOFError) as e:
+            ctl.close()
+            logging.warning("querying protocols on %s failed: %s", sockpath, e)
+            return set()
+        with self.__show_lock:
+            self.__show_pool[version].append(ctl)
+        return _down_protocols(reply)
+
+    def bird_sock(self, version: int) -> pathlib.Path:
+        return self.bird4_sock if version == 4 else self.bird6_sock
+
+    def has_socket(self, version: int) -> bool:
+        sockpath = self.bird_sock(version)
+        if sockpath.exists() and sockpath.is_socket():
+            return True
+        logging.info("%s is not a unix socket, not confirming exports", sockpath)
+        return False
+
+    def __export_diff(
+        self, key: tuple[int, str], prefix2route: dict[str, ExportedRoute | None]
+    ) -> list[str]:
+        version, mux = key
+        sockpath = self.bird_sock(version)
+        with self.__show_lock:
+            pool = self.__show_pool.setdefault(version, [])
+            ctl = pool.pop() if pool else BirdControl(sockpath)
+        try:
+            reply = ctl.command(f"show route export {mux} all")
+        except (OSError, EOFError) as e:
+            ctl.close()
+            return [f"querying {sockpath} failed: {e}"]
+        with self.__show_lock:
+            self.__show_pool[version].append(ctl)
+        return _export_diff(prefix2route, reply)
+
+    def __deploy_staged(self, diff: FilterDiff) -> None:
+        """Swap in the new filter set and reconfigure v4 and v6 concurrently
+
+        If either daemon rejects the new configuration, prefix-filters is
+        pointed back at the previous generation and both daemons reload it.
+        """
+        checkpoint = self.checkpoint()
+        self.apply(diff)
+        replies = self.__reconfigure(self.pending_versions)
+        self.record_reloads(replies)
+        if all(r.ok for r in replies.values()):
+            self.prune_generations()
+            return
+        self.rollback(checkpoint, replies)
+        self.__reconfigure(replies)
+        raise RuntimeError("Reconfiguring BIRD failed")
 
-    def announce(self, prefix: str, ann: Announcement) -> None:
-        for mux in ann.muxes:
-            with open(self.__config_file(prefix, mux), "w", encoding="utf8") as fd:
-                data = self.config_template.render(prefix=prefix, spec=ann.to_dict())
-                fd.write(data)
+    def checkpoint(self) -> tuple[pathlib.Path, dict[str, str]]:
+        """Return the live generation and filter mirror, for rollback()"""
+        return self.__live_generation(), dict(self.deployed)
 
-    def reload_config(self) -> None:
-        for execname, sockpath in [
-            ("birdc", self.bird4_sock),
-            ("birdc6", self.bird6_sock),
+    def rollback(
+        self,
+        checkpoint: tuple[pathlib.Path, dict[str, str]],
+        replies: dict[int, BirdReply],
+    ) -> None:
+        """Point prefix-filters back at a checkpoint after BIRD rejected filters
+
+        The daemons in replies still need reconfiguring to load it again.
+        """
+        previous, deployed = checkpoint
+        for version, reply in replies.items():
+            if not reply.ok:
+                logging.warning("BIRD%d rejected filters: %s", version, reply.text())
+        logging.warning("rolling back %s to %s", self.filters_dir, previous)
+        failed = self.__live_generation()
+        self.__flip(previous)
+        shutil.rmtree(failed)
+        self.deployed = deployed
+        self.__filter_stats.clear()
+        self.mux_clauses.clear()
+        self.__save_deployed()
+
+    def withdraw(self, prefix: str, mux: MuxName | None = None) -> None:
+        with self.locked():
+            self.apply(self.diff(UpdateSet({prefix: Update([mux or "all"])})))
+
+    def announce(self, prefix: str, ann: Announcement) -> None:
+        with self.locked():
+            self.apply(self.diff(UpdateSet({prefix: Update([], [ann])})))
+
+    def reload_pending(self) -> dict[int, BirdReply]:
+        """Reconfigure only the BIRD daemons with undeployed filter changes
+
+        Waits reload_window seconds first so changes by other processes
+        sharing bird_cfg_dir can be loaded by the same reconfigure.  Daemons
+        whose reconfigure by another process already covered our changes are
+        not reconfigured again; their reply is returned instead.
+        """
+        if not self.pending_versions:
+            logging.info("no filter changes, skipping BIRD reconfigure")
+            return {}
+        if self.reload_window > 0:
+            time.sleep(self.reload_window)
+        with self.locked():
+            replies, todo = self.covered_reloads(self.pending_versions)
+            configured = self.__reconfigure(todo)
+            self.record_reloads(configured)
+        replies.update(configured)
+        _check_replies(replies)
+        return replies
+
+    def reload_config(self, versions: Iterable[int] = (4, 6)) -> dict[int, BirdReply]:
+        with self.locked():
+            replies = self.__reconfigure(versions)
+            self.record_reloads(replies)
+        _check_replies(replies)
+        return replies
+
+    def bird_sockets(
+        self, versions: Iterable[int]
+    ) -> list[tuple[int, str, pathlib.Path]]:
+        """Return (version, birdc executable, socket) of daemons to reconfigure
+
+        Versions without a BIRD socket are skipped and no longer pending.
+        """
+        versions = set(versions)
+        jobs = []
+        for version, execname, sockpath in [
+            (4, "birdc", self.bird4_sock),
+            (6, "birdc6", self.bird6_sock),
         ]:
+            if version not in versions:
+                continue
             if not sockpath.exists() or not sockpath.is_socket():
                 logging.info("%s is not a unix socket, skipping", sockpath)
+                self.pending_versions.discard(version)
                 continue
+            jobs.append((version, execname, sockpath))
+        return jobs
+
+    def record_reconfigure(self, version: int, execname: str, reply: BirdReply) -> None:
+        self.reload_latency[version] = reply.elapsed
+        logging.info(
+            "%s reconfigure: %04d %s (%.3fs)",
+            execname,
+            reply.code,
+            reply.message,
+            reply.elapsed,
+        )
+        if reply.ok:
+            self.pending_versions.discard(version)
+
+    def __reconfigure(self, versions: Iterable[int]) -> dict[int, BirdReply]:
+        """Reconfigure the BIRD daemons for versions concurrently"""
+        jobs = self.bird_sockets(versions)
+        replies: dict[int, BirdReply] = {}
+        if len(jobs) == 1:
+            version, execname, sockpath = jobs[0]
+            replies[version] = self.__configure(version, execname, sockpath)
+            self.record_reconfigure(version, execname, replies[version])
+            return replies
+        import concurrent.futures  # noqa: PLC0415
+
+        with concurrent.futures.ThreadPoolExecutor(max(1, len(jobs))) as executor:
+            version2future = {
+                version: executor.submit(self.__configure, version, execname, sockpath)
+                for version, execname, sockpath in jobs
+            }
+        for version, execname, _sockpath in jobs:
+            replies[version] = version2future[version].result()
+            self.record_reconfigure(version, execname, replies[version])
+        return replies
+
+    def __configure(
+        self, version: int, execname: str, sockpath: pathlib.Path
+    ) -> BirdReply:
+        if not self.use_birdc:
+            if version not in self.birdctl:
+                self.birdctl[version] = BirdControl(sockpath)
+            try:
+                return self.birdctl[version].configure()
+            except (OSError, EOFError) as e:
+                logging.warning("%s failed (%s), using %s", sockpath, e, execname)
+        return _birdc_configure(execname, sockpath)
+
+    def close(self) -> None:
+        for ctl in self.birdctl.values():
+            ctl.close()
+        self.birdctl.clear()
+        with self.__show_lock:
+            for pool in self.__show_pool.values():
+                for ctl in pool:
+                    ctl.close()
+            self.__show_pool.clear()
+        if self.__egress is not None:
+            self.__egress.close()
+            self.__egress = None
+
+    def gateway(self, mux: str, peerid: int | None) -> str:
+        muxid = self.mux2id[mux]
+        if peerid is None:
+            return f"100.{64 + muxid}.128.1"
+        return f"100.{64 + muxid}.{peerid // 256}.{peerid % 256}"
+
+    def set_egress(
+        self,
+        prio: int,
+        srcip: str | IPv4Address | IPv6Address,
+        mux: str,
+        peerid: int | None,
+    ) -> None:
+        assert ipaddress.ip_address(srcip)
+        self.egress.set(prio, str(srcip), self.gateway(mux, peerid))
+
+    def unset_egress(self, prio: int) -> None:
+        self.egress.unset(prio)
+
+    def reconcile_egress(
+        self,
+        prio2egress: dict[int, tuple[str, str, int | None]],
+        prios: Iterable[int],
+    ) -> None:
+        """Make egress rules for prios match prio2egress in one batch
+
+        prio2egress maps rule priorities (which double as routing table IDs)
+        to (srcip, mux, peerid).  Priorities in prios missing from prio2egress
+        have their rules and routes removed.
+        """
+        prio2route = {}
+        for prio, (srcip, mux, peerid) in prio2egress.items():
+            assert ipaddress.ip_address(srcip)
+            prio2route[prio] = (str(srcip), self.gateway(mux, peerid))
+        self.egress.reconcile(prio2route, prios)
+
+
+class AsyncAnnouncementController:
+    """asyncio front end for AnnouncementController
+
+    Takes the same arguments as AnnouncementController, which it wraps (see
+    the controller attribute).  Filter files, the flap ledger and the reload
+    state are read and written in a worker thread, one change at a time,
+    while BIRD is reconfigured over non-blocking control sockets (or birdc
+    run as an asyncio subprocess) and egress rules are changed over a
+    non-blocking rtnetlink socket.  Callers can then drive many prefixes and
+    measurements from one event loop, waiting with asyncio.sleep() instead of
+    time.sleep().
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        import asyncio  # noqa: PLC0415
+
+        self.controller = AnnouncementController(*args, **kwargs)
+        self.birdctl: dict[int, AsyncBirdControl] = {}
+        self.showctl: dict[int, list[AsyncBirdControl]] = {}
+        """Connections used to confirm exports, per IP version"""
+        self.__egress: AsyncNetlinkEgress | AsyncIpRouteEgress | None = None
+        self.__lock = asyncio.Lock()
+        """Serializes changes to prefix-filters/"""
+
+    @property
+    def egress(self) -> "AsyncNetlinkEgress | AsyncIpRouteEgress":
+        """Egress backend, opened (with its rtnetlink socket) on first use"""
+        if self.__egress is None:
+            self.__egress = _async_egress_backend(self.controller.use_iproute2)
+        return self.__egress
+
+    def validate(self, updates: UpdateSet) -> None:
+        self.controller.validate(updates)
 
-            cmd = f"{execname} -s {sockpath}"
-            proc = subprocess.Popen(  # noqa: S603
-                cmd.split(),
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+    async def deploy(
+        self,
+        updates: UpdateSet,
+        confirm: bool = False,
+        confirm_timeout: float = CONFIRM_TIMEOUT,
+        flap_policy: FlapPolicy | None = None,
+    ) -> float | None:
+        """Deploy updates, see AnnouncementController.deploy()"""
+        import asyncio  # noqa: PLC0415
+
+        ctl = self.controller
+        while True:
+            async with self.__lock:
+                await asyncio.to_thread(ctl.acquire)
+                try:
+                    expected, diff = await asyncio.to_thread(
+                        self.__diff, updates, confirm
+                    )
+                    wait = await asyncio.to_thread(
+                        ctl.flap_wait, diff, flap_policy or ctl.flap_policy
+                    )
+                    if wait <= 0:
+                        logging.info(
+                            "deploy writes %d and removes %d filter files",
+                            len(diff.write),
+                            len(diff.remove),
+                        )
+                        staged = ctl.staged and bool(diff)
+                        if staged:
+                            await self.__deploy_staged(diff)
+                        else:
+                            await asyncio.to_thread(ctl.apply, diff)
+                        break
+                finally:
+                    ctl.release()
+            logging.info("delaying deploy %.0fs to stay within flap budget", wait)
+            await asyncio.sleep(wait)
+        if not staged:
+            await self.reload_pending()
+        if not confirm:
+            return None
+        return await self.confirm_exports(expected, confirm_timeout)
+
+    def __diff(self, updates: UpdateSet, confirm: bool) -> tuple[dict, FilterDiff]:
+        self.controller.validate(updates)
+        expected = self.controller.export_expectations(updates) if confirm else {}
+        return expected, self.controller.diff(updates)
+
+    async def confirm_exports(
+        self,
+        expected: dict[tuple[int, str], dict[str, ExportedRoute | None]],
+        timeout: float = CONFIRM_TIMEOUT,
+    ) -> float:
+        """Wait for BIRD's exports, see AnnouncementController.confirm_exports()"""
+        import asyncio  # noqa: PLC0415
+
+        ctl = self.controller
+        start = time.monotonic()
+        versions = {key[0] for key in expected if ctl.has_socket(key[0])}
+        down = {v: await asyncio.to_thread(ctl.down_muxes, v) for v in versions}
+        pending = _confirmable(expected, down)
+        while True:
+            keys = list(pending)
+            diffs = await asyncio.gather(
+                *(self.__export_diff(i, k, pending[k]) for i, k in enumerate(keys))
             )
-            stdout, stderr = proc.communicate(b"configure\n")
-            r = proc.wait()
-            if r != 0:
-                logging.warning("%s reconfigure exited with status %d", execname, r)
-                logging.warning("%s", stdout)
-                logging.warning("%s", stderr)
-                raise RuntimeError("Reconfiguring BIRD failed")
+            mux2diff = {}
+            for key, diff in zip(keys, diffs, strict=True):
+                if diff:
+                    mux2diff[f"{key[1]} (BIRD{key[0]})"] = diff
+                else:
+                    del pending[key]
+            elapsed = time.monotonic() - start
+            if not pending:
+                break
+            if elapsed > timeout:
+                raise ExportConfirmationError(mux2diff, elapsed)
+            await asyncio.sleep(CONFIRM_INTERVAL)
+        ctl.confirm_latency = elapsed
+        logging.info(
+            "BIRD exports confirmed for %d muxes in %.3fs", len(expected), elapsed
+        )
+        return elapsed
 
-    def set_egress(
+    async def __export_diff(
+        self,
+        i: int,
+        key: tuple[int, str],
+        prefix2route: dict[str, ExportedRoute | None],
+    ) -> list[str]:
+        """Query a mux's exports over one of CONFIRM_CONNECTIONS connections"""
+        version, mux = key
+        sockpath = self.controller.bird_sock(version)
+        pool = self.showctl.setdefault(version, [])
+        if len(pool) < CONFIRM_CONNECTIONS:
+            pool.append(AsyncBirdControl(sockpath))
+        ctl = pool[i % len(pool)]
+        try:
+            reply = await ctl.command(f"show route export {mux} all")
+        except (OSError, EOFError) as e:
+            await ctl.close()
+            return [f"querying {sockpath} failed: {e}"]
+        return _export_diff(prefix2route, reply)
+
+    async def __deploy_staged(self, diff: FilterDiff) -> None:
+        import asyncio  # noqa: PLC0415
+
+        ctl = self.controller
+        checkpoint = ctl.checkpoint()
+        await asyncio.to_thread(ctl.apply, diff)
+        replies = await self.__reconfigure(ctl.pending_versions)
+        await asyncio.to_thread(ctl.record_reloads, replies)
+        if all(r.ok for r in replies.values()):
+            await asyncio.to_thread(ctl.prune_generations)
+            return
+        await asyncio.to_thread(ctl.rollback, checkpoint, replies)
+        await self.__reconfigure(replies)
+        raise RuntimeError("Reconfiguring BIRD failed")
+
+    async def withdraw(self, prefix: str, mux: MuxName | None = None) -> None:
+        await self.__apply(UpdateSet({prefix: Update([mux or "all"])}))
+
+    async def announce(self, prefix: str, ann: Announcement) -> None:
+        await self.__apply(UpdateSet({prefix: Update([], [ann])}))
+
+    async def __apply(self, updates: UpdateSet) -> None:
+        import asyncio  # noqa: PLC0415
+
+        ctl = self.controller
+        async with self.__lock:
+            await asyncio.to_thread(ctl.acquire)
+            try:
+                diff = await asyncio.to_thread(ctl.diff, updates)
+                await asyncio.to_thread(ctl.apply, diff)
+            finally:
+                ctl.release()
+
+    async def reload_pending(self) -> dict[int, BirdReply]:
+        """Reconfigure only the BIRD daemons with undeployed filter changes
+
+        Coalesces reconfigures with other deploys like
+        AnnouncementController.reload_pending().
+        """
+        import asyncio  # noqa: PLC0415
+
+        ctl = self.controller
+        if not ctl.pending_versions:
+            logging.info("no filter changes, skipping BIRD reconfigure")
+            return {}
+        if ctl.reload_window > 0:
+            await asyncio.sleep(ctl.reload_window)
+        async with self.__lock:
+            await asyncio.to_thread(ctl.acquire)
+            try:
+                replies, todo = await asyncio.to_thread(
+                    ctl.covered_reloads, ctl.pending_versions
+                )
+                configured = await self.__reconfigure(todo)
+                await asyncio.to_thread(ctl.record_reloads, configured)
+            finally:
+                ctl.release()
+        replies.update(configured)
+        _check_replies(replies)
+        return replies
+
+    async def reload_config(
+        self, versions: Iterable[int] = (4, 6)
+    ) -> dict[int, BirdReply]:
+        import asyncio  # noqa: PLC0415
+
+        ctl = self.controller
+        async with self.__lock:
+            await asyncio.to_thread(ctl.acquire)
+            try:
+                replies = await self.__reconfigure(versions)
+                await asyncio.to_thread(ctl.record_reloads, replies)
+            finally:
+                ctl.release()
+        _check_replies(replies)
+        return replies
+
+    async def __reconfigure(self, versions: Iterable[int]) -> dict[int, BirdReply]:
+        """Reconfigure the BIRD daemons for versions concurrently"""
+        import asyncio  # noqa: PLC0415
+
+        jobs = self.controller.bird_sockets(versions)
+        results = await asyncio.gather(*(self.__configure(*job) for job in jobs))
+        replies: dict[int, BirdReply] = {}
+        for (version, execname, _sockpath), reply in zip(jobs, results, strict=True):
+            replies[version] = reply
+            self.controller.record_reconfigure(version, execname, reply)
+        return replies
+
+    async def __configure(
+        self, version: int, execname: str, sockpath: pathlib.Path
+    ) -> BirdReply:
+        if not self.controller.use_birdc:
+            if version not in self.birdctl:
+                self.birdctl[version] = AsyncBirdControl(sockpath)
+            try:
+                return await self.birdctl[version].configure()
+            except (OSError, EOFError) as e:
+                logging.warning("%s failed (%s), using %s", sockpath, e, execname)
+        return await _async_birdc_configure(execname, sockpath)
+
+    async def close(self) -> None:
+        for ctl in self.birdctl.values():
+            await ctl.close()
+        self.birdctl.clear()
+        for pool in self.showctl.values():
+            for ctl in pool:
+                await ctl.close()
+        self.showctl.clear()
+        if self.__egress is not None:
+            self.__egress.close()
+            self.__egress = None
+        self.controller.close()
+
+    async def set_egress(
         self,
         prio: int,
         srcip: str | IPv4Address | IPv6Address,
@@ -311,12 +2030,150 @@ class AnnouncementController:
         peerid: int | None,
     ) -> None:
         assert ipaddress.ip_address(srcip)
-        muxid = self.mux2id[mux]
-        if peerid is None:
-            gateway = f"100.{64 + muxid}.128.1"
-        else:
-            gateway = f"100.{64 + muxid}.{peerid // 256}.{peerid % 256}"
+        await self.egress.set(prio, str(srcip), self.controller.gateway(mux, peerid))
+
+    async def unset_egress(self, prio: int) -> None:
+        await self.egress.unset(prio)
+
+    async def reconcile_egress(
+        self,
+        prio2egress: dict[int, tuple[str, str, int | None]],
+        prios: Iterable[int],
+    ) -> None:
+        """Make egress rules for prios match prio2egress, see AnnouncementController"""
+        prio2route = {}
+        for prio, (srcip, mux, peerid) in prio2egress.items():
+            assert ipaddress.ip_address(srcip)
+            prio2route[prio] = (str(srcip), self.controller.gateway(mux, peerid))
+        await self.egress.reconcile(prio2route, prios)
+
+
+class PrefixPlan:
+    """Per-prefix facts measurement scripts need, computed once
+
+    For each prefix: the source IP its probes are sent from (last host),
+    the IP of the vantage point announcing it (first host), the ID used
+    as iproute2 rule and table priority and as ICMP ID (IPv4 prefixes get
+    id_base plus their third octet, IPv6 ones id_base + 256 plus their
+    rank; sequential_ids gives id_base plus the prefix's index instead),
+    the key naming its output directories and timestamps (third octet for
+    IPv4, last 16-bit group within the prefix length for IPv6) and its
+    address family.  Columns are tuples and arrays indexed like prefixes.
+    """
+
+    def __init__(
+        self, prefixes: Iterable[str], id_base: int = 0, sequential_ids: bool = False
+    ):
+        networks = [ipaddress.ip_network(p) for p in prefixes]
+        self.prefixes: tuple[str, ...] = tuple(str(net) for net in networks)
+        self.index = {prefix: i for i, prefix in enumerate(self.prefixes)}
+        if len(self.index) != len(self.prefixes):
+            raise ValueError("PrefixPlan prefixes are not unique")
+        self.families = array.array("B", (net.version for net in networks))
+        self.srcips = tuple(str(_last_host(net)) for net in networks)
+        self.vpips = tuple(str(_first_host(net)) for net in networks)
+        self.keys = tuple(_prefix_dir_key(net) for net in networks)
+        if len(set(self.keys)) != len(self.keys):
+            raise ValueError(f"PrefixPlan prefixes share keys: {self.keys}")
+        ids = []
+        rank6 = 0
+        for i, net in enumerate(networks):
+            if sequential_ids:
+                ids.append(id_base + i)
+            elif net.version == 4:
+                ids.append(id_base + net.network_address.packed[2])
+            else:
+                ids.append(id_base + 256 + rank6)
+                rank6 += 1
+        if ids and not 0 <= min(ids) <= max(ids) <= 0xFFFF:
+            raise ValueError(f"PrefixPlan IDs {min(ids)}-{max(ids)} exceed 16 bits")
+        self.ids = array.array("H", ids)
+
+    @classmethod
+    def from_files(
+        cls,
+        id_base: int = 0,
+        prefixes4_file: pathlib.Path = DEFAULT_PREFIXES4_FILE,
+        prefixes6_file: pathlib.Path | None = DEFAULT_PREFIXES6_FILE,
+    ) -> "PrefixPlan":
+        """Build a plan from prefix files, skipping blank and # lines"""
+        prefixes = []
+        for path in (prefixes4_file, prefixes6_file):
+            if path is None:
+                continue
+            with open(path, encoding="utf8") as fd:
+                for line in fd:
+                    line = line.split("#", 1)[0].strip()
+                    if line:
+                        prefixes.append(line)
+        return cls(prefixes, id_base)
+
+    def __len__(self) -> int:
+        return len(self.prefixes)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.prefixes)
+
+    def __contains__(self, prefix: object) -> bool:
+        return prefix in self.index
+
+    def position(self, prefix: str) -> int:
+        """Index of prefix in the plan's columns; raises KeyError if absent"""
+        i = self.index.get(prefix)
+        if i is None:
+            i = self.index[str(ipaddress.ip_network(prefix))]
+        return i
+
+    def srcip(self, prefix: str) -> str:
+        return self.srcips[self.position(prefix)]
+
+    def vpip(self, prefix: str) -> str:
+        return self.vpips[self.position(prefix)]
 
+    def prio(self, prefix: str) -> int:
+        return self.ids[self.position(prefix)]
+
+    def icmpid(self, prefix: str) -> int:
+        return self.ids[self.position(prefix)]
+
+    def key(self, prefix: str) -> str:
+        return self.keys[self.position(prefix)]
+
+    def family(self, prefix: str) -> int:
+        return self.families[self.position(prefix)]
+
+    def prios(self) -> list[int]:
+        return self.ids.tolist()
+
+
+def _first_host(net: IPv4Network | IPv6Network) -> IPv4Address | IPv6Address:
+    """next(net.hosts()), without generating them"""
+    if net.num_addresses <= 2:
+        return net.network_address
+    return net.network_address + 1
+
+
+def _last_host(net: IPv4Network | IPv6Network) -> IPv4Address | IPv6Address:
+    """list(net.hosts())[-1], without generating them"""
+    if net.version == 4 and net.num_addresses > 2:
+        return net.broadcast_address - 1
+    return net.broadcast_address
+
+
+def _prefix_dir_key(net: IPv4Network | IPv6Network) -> str:
+    if net.version == 4:
+        return str(net.network_address.packed[2])
+    group = max(net.prefixlen - 1, 0) // 16
+    return net.network_address.exploded.split(":")[group]
+
+
+class IpRouteEgress:
+    """Egress backend that runs iproute2 commands"""
+
+    def close(self) -> None:
+        pass
+
+    def set(self, prio: int, srcip: str, gateway: str) -> None:
         cmd = f"ip rule add from {srcip} lookup {prio} prio {prio}"
         _run_check_log(cmd, True)
 
@@ -326,7 +2183,7 @@ class AnnouncementController:
         cmd = f"ip route add default via {gateway} table {prio}"
         _run_check_log(cmd, True)
 
-    def unset_egress(self, prio: int) -> None:
+    def unset(self, prio: int) -> None:
         cmd = f"ip route flush table {prio}"
         _run_check_log(cmd, False)
         try:
@@ -337,6 +2194,479 @@ class AnnouncementController:
         except subprocess.CalledProcessError:
             pass
 
+    def reconcile(
+        self, prio2route: dict[int, tuple[str, str]], prios: Iterable[int]
+    ) -> None:
+        for prio in set(prios) | set(prio2route):
+            self.unset(prio)
+        for prio, (srcip, gateway) in prio2route.items():
+            self.set(prio, srcip, gateway)
+
+
+class AsyncIpRouteEgress:
+    """asyncio version of IpRouteEgress"""
+
+    def close(self) -> None:
+        pass
+
+    async def set(self, prio: int, srcip: str, gateway: str) -> None:
+        cmd = f"ip rule add from {srcip} lookup {prio} prio {prio}"
+        await _async_run_check_log(cmd, True)
+
+        cmd = f"ip route flush table {prio}"
+        await _async_run_check_log(cmd, False)
+
+        cmd = f"ip route add default via {gateway} table {prio}"
+        await _async_run_check_log(cmd, True)
+
+    async def unset(self, prio: int) -> None:
+        cmd = f"ip route flush table {prio}"
+        await _async_run_check_log(cmd, False)
+        try:
+            cmd = f"ip rule del prio {prio}"
+            while True:
+                # Remove rules until none are left and CalledProcessError is raised
+                await _async_run_check_log(cmd, True, False)
+        except subprocess.CalledProcessError:
+            pass
+
+    async def reconcile(
+        self, prio2route: dict[int, tuple[str, str]], prios: Iterable[int]
+    ) -> None:
+        for prio in set(prios) | set(prio2route):
+            await self.unset(prio)
+        for prio, (srcip, gateway) in prio2route.items():
+            await self.set(prio, srcip, gateway)
+
+
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_DUMP = 0x300
+NLM_F_CREATE_EXCL = NLM_F_CREATE | NLM_F_EXCL
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWRULE = 32
+RTM_DELRULE = 33
+RTM_GETRULE = 34
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+FRA_SRC = 2
+FRA_PRIORITY = 6
+FRA_TABLE = 15
+RT_TABLE_UNSPEC = 0
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+FR_ACT_TO_TBL = 1
+_NLMSGHDR = struct.Struct("=LHHLL")
+_RTMSG = struct.Struct("=BBBBBBBBL")  # also the layout of fib_rule_hdr
+
+
+@dataclasses.dataclass(frozen=True)
+class _Rule:
+    family: int
+    prio: int
+    table: int
+    src: str | None
+    src_len: int
+
+
+@dataclasses.dataclass(frozen=True)
+class _Route:
+    family: int
+    table: int
+    dst: str | None
+    dst_len: int
+    gateway: str | None
+    oif: int | None
+    rtype: int
+
+
+class NetlinkEgress:
+    """Egress backend that talks rtnetlink directly
+
+    reconcile() dumps all rules and routes once, computes the changes needed
+    for the managed priorities, and sends every change in a single netlink
+    datagram, reading back one acknowledgement per change.
+    """
+
+    def __init__(self) -> None:
+        self.__sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.__sock.bind((0, 0))
+        self.__seq = 0
+
+    def close(self) -> None:
+        self.__sock.close()
+
+    def set(self, prio: int, srcip: str, gateway: str) -> None:
+        self.reconcile({prio: (srcip, gateway)}, [prio])
+
+    def unset(self, prio: int) -> None:
+        self.reconcile({}, [prio])
+
+    def reconcile(
+        self, prio2route: dict[int, tuple[str, str]], prios: Iterable[int]
+    ) -> None:
+        msgs = _egress_changes(prio2route, prios, self.rules(), self.routes())
+        self.__transact(msgs)
+
+    def rules(self) -> list[_Rule]:
+        rules = []
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for hdr, attrs in self.__dump(RTM_GETRULE, family):
+                rules.append(_parse_rule(family, hdr, attrs))
+        return rules
+
+    def routes(self) -> list[_Route]:
+        routes = []
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for hdr, attrs in self.__dump(RTM_GETROUTE, family):
+                routes.append(_parse_route(family, hdr, attrs))
+        return routes
+
+    def __next_seq(self) -> int:
+        self.__seq += 1
+        return self.__seq
+
+    def __dump(self, msgtype: int, family: int) -> list[tuple[tuple, dict[int, bytes]]]:
+        seq = self.__next_seq()
+        self.__sock.sendall(_dump_request(msgtype, family, seq))
+        entries: list[tuple[tuple, dict[int, bytes]]] = []
+        while not _dump_reply(self.__sock.recv(1 << 20), seq, entries):
+            pass
+        return entries
+
+    def __transact(self, msgs: list[tuple[int, int, bytes]]) -> None:
+        if not msgs:
+            return
+        seq2msg = {self.__next_seq(): msg[0] for msg in msgs}
+        self.__sock.sendall(_transact_request(msgs, seq2msg))
+        errors: list[int] = []
+        while seq2msg:
+            _transact_reply(self.__sock.recv(1 << 20), seq2msg, errors)
+        if errors:
+            raise OSError(errors[0], f"{len(errors)} egress changes failed")
+
+
+class AsyncNetlinkEgress:
+    """asyncio version of NetlinkEgress using a non-blocking netlink socket"""
+
+    def __init__(self) -> None:
+        self.__sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.__sock.bind((0, 0))
+        self.__sock.setblocking(False)
+        self.__seq = 0
+
+    def close(self) -> None:
+        self.__sock.close()
+
+    async def set(self, prio: int, srcip: str, gateway: str) -> None:
+        await self.reconcile({prio: (srcip, gateway)}, [prio])
+
+    async def unset(self, prio: int) -> None:
+        await self.reconcile({}, [prio])
+
+    async def reconcile(
+        self, prio2route: dict[int, tuple[str, str]], prios: Iterable[int]
+    ) -> None:
+        rules = [
+            _parse_rule(family, hdr, attrs)
+            for family in (socket.AF_INET, socket.AF_INET6)
+            for hdr, attrs in await self.__dump(RTM_GETRULE, family)
+        ]
+        routes = [
+            _parse_route(family, hdr, attrs)
+            for family in (socket.AF_INET, socket.AF_INET6)
+            for hdr, attrs in await self.__dump(RTM_GETROUTE, family)
+        ]
+        await self.__transact(_egress_changes(prio2route, prios, rules, routes))
+
+    def __next_seq(self) -> int:
+        self.__seq += 1
+        return self.__seq
+
+    async def __dump(
+        self, msgtype: int, family: int
+    ) -> list[tuple[tuple, dict[int, bytes]]]:
+        import asyncio  # noqa: PLC0415
+
+        loop = asyncio.get_running_loop()
+        seq = self.__next_seq()
+        await loop.sock_sendall(self.__sock, _dump_request(msgtype, family, seq))
+        entries: list[tuple[tuple, dict[int, bytes]]] = []
+        while not _dump_reply(await loop.sock_recv(self.__sock, 1 << 20), seq, entries):
+            pass
+        return entries
+
+    async def __transact(self, msgs: list[tuple[int, int, bytes]]) -> None:
+        import asyncio  # noqa: PLC0415
+
+        if not msgs:
+            return
+        loop = asyncio.get_running_loop()
+        seq2msg = {self.__next_seq(): msg[0] for msg in msgs}
+        await loop.sock_sendall(self.__sock, _transact_request(msgs, seq2msg))
+        errors: list[int] = []
+        while seq2msg:
+            _transact_reply(await loop.sock_recv(self.__sock, 1 << 20), seq2msg, errors)
+        if errors:
+            raise OSError(errors[0], f"{len(errors)} egress changes failed")
+
+
+def _egress_changes(
+    prio2route: dict[int, tuple[str, str]],
+    prios: Iterable[int],
+    rules: list[_Rule],
+    routes: list[_Route],
+) -> list[tuple[int, int, bytes]]:
+    """Return the netlink messages that make rules and routes match prio2route"""
+    prios = set(prios) | set(prio2route)
+    msgs: list[tuple[int, int, bytes]] = []
+    have_rule: set[int] = set()
+    have_route: set[int] = set()
+    for rule in rules:
+        if rule.prio not in prios:
+            continue
+        want = prio2route.get(rule.prio)
+        if (
+            want
+            and rule.table == rule.prio
+            and rule.src == want[0]
+            and rule.src_len == ipaddress.ip_address(want[0]).max_prefixlen
+        ):
+            have_rule.add(rule.prio)
+            continue
+        msgs.append((RTM_DELRULE, 0, _rule_msg(rule)))
+    for route in routes:
+        if route.table not in prios:
+            continue
+        want = prio2route.get(route.table)
+        if want and route.dst_len == 0 and route.gateway == want[1]:
+            have_route.add(route.table)
+            continue
+        msgs.append((RTM_DELROUTE, 0, _route_msg(route, delete=True)))
+    nremove = len(msgs)
+    for prio, (srcip, gateway) in prio2route.items():
+        if prio not in have_route:
+            family = _family(gateway)
+            route = _Route(family, prio, None, 0, gateway, None, RTN_UNICAST)
+            msgs.append((RTM_NEWROUTE, NLM_F_CREATE_EXCL, _route_msg(route)))
+        if prio not in have_rule:
+            host_len = ipaddress.ip_address(srcip).max_prefixlen
+            rule = _Rule(_family(srcip), prio, prio, srcip, host_len)
+            msgs.append((RTM_NEWRULE, NLM_F_CREATE_EXCL, _rule_msg(rule)))
+    logging.info(
+        "egress changes: %d removals, %d additions",
+        nremove,
+        len(msgs) - nremove,
+    )
+    return msgs
+
+
+def _parse_rule(family: int, hdr: tuple, attrs: dict[int, bytes]) -> _Rule:
+    table = _nlattr_u32(attrs, FRA_TABLE, hdr[4])
+    prio = _nlattr_u32(attrs, FRA_PRIORITY, 0)
+    src = _nlattr_addr(family, attrs, FRA_SRC)
+    return _Rule(family, prio, table, src, hdr[2])
+
+
+def _parse_route(family: int, hdr: tuple, attrs: dict[int, bytes]) -> _Route:
+    table = _nlattr_u32(attrs, RTA_TABLE, hdr[4])
+    dst = _nlattr_addr(family, attrs, RTA_DST)
+    gateway = _nlattr_addr(family, attrs, RTA_GATEWAY)
+    oif = _nlattr_u32(attrs, RTA_OIF, None)
+    return _Route(family, table, dst, hdr[1], gateway, oif, hdr[7])
+
+
+def _nlmsgs(data: bytes):
+    """Yield the (type, flags, seq, payload) of messages in a netlink datagram"""
+    off = 0
+    while off + _NLMSGHDR.size <= len(data):
+        mlen, mtype, flags, seq, _pid = _NLMSGHDR.unpack_from(data, off)
+        yield mtype, flags, seq, data[off + _NLMSGHDR.size : off + mlen]
+        off += (mlen + 3) & ~3
+
+
+def _dump_request(msgtype: int, family: int, seq: int) -> bytes:
+    payload = _RTMSG.pack(family, 0, 0, 0, 0, 0, 0, 0, 0)
+    flags = NLM_F_REQUEST | NLM_F_DUMP
+    hdr = _NLMSGHDR.pack(_NLMSGHDR.size + len(payload), msgtype, flags, seq, 0)
+    return hdr + payload
+
+
+def _dump_reply(
+    data: bytes, seq: int, entries: list[tuple[tuple, dict[int, bytes]]]
+) -> bool:
+    """Add the entries in a dump reply datagram, return whether the dump is done"""
+    for mtype, _flags, mseq, payload in _nlmsgs(data):
+        if mseq != seq:
+            continue
+        if mtype == NLMSG_DONE:
+            return True
+        if mtype == NLMSG_ERROR:
+            err = -struct.unpack_from("=i", payload)[0]
+            raise OSError(err, f"netlink dump failed: {os.strerror(err)}")
+        hdr = _RTMSG.unpack_from(payload)
+        entries.append((hdr, _nlattrs(payload[_RTMSG.size :])))
+    return False
+
+
+def _transact_request(
+    msgs: list[tuple[int, int, bytes]], seq2msg: dict[int, int]
+) -> bytes:
+    """Pack msgs into one datagram, numbering them with the keys of seq2msg"""
+    buf = []
+    for seq, (msgtype, flags, payload) in zip(seq2msg, msgs, strict=True):
+        flags |= NLM_F_REQUEST | NLM_F_ACK
+        msglen = _NLMSGHDR.size + len(payload)
+        buf.append(_NLMSGHDR.pack(msglen, msgtype, flags, seq, 0))
+        buf.append(payload)
+    return b"".join(buf)
+
+
+def _transact_reply(data: bytes, seq2msg: dict[int, int], errors: list[int]) -> None:
+    """Pop acknowledged messages from seq2msg, adding failures to errors"""
+    for mtype, _flags, seq, payload in _nlmsgs(data):
+        if mtype != NLMSG_ERROR or seq not in seq2msg:
+            continue
+        msgtype = seq2msg.pop(seq)
+        err = -struct.unpack_from("=i", payload)[0]
+        if err == 0:
+            continue
+        if msgtype in (RTM_DELRULE, RTM_DELROUTE) and err in _GONE_ERRNOS:
+            continue
+        if msgtype in (RTM_NEWRULE, RTM_NEWROUTE) and err == errno.EEXIST:
+            continue
+        logging.error("netlink message %d: %s", msgtype, os.strerror(err))
+        errors.append(err)
+
+
+_GONE_ERRNOS = (errno.ENOENT, errno.ESRCH)
+
+
+def _egress_backend(use_iproute2: bool) -> NetlinkEgress | IpRouteEgress:
+    if not use_iproute2:
+        try:
+            return NetlinkEgress()
+        except (OSError, AttributeError) as e:
+            logging.warning("cannot open rtnetlink socket (%s), using iproute2", e)
+    return IpRouteEgress()
+
+
+def _async_egress_backend(
+    use_iproute2: bool,
+) -> AsyncNetlinkEgress | AsyncIpRouteEgress:
+    if not use_iproute2:
+        try:
+            return AsyncNetlinkEgress()
+        except (OSError, AttributeError) as e:
+            logging.warning("cannot open rtnetlink socket (%s), using iproute2", e)
+    return AsyncIpRouteEgress()
+
+
+def _family(addr: str) -> int:
+    if ipaddress.ip_address(addr).version == 4:
+        return socket.AF_INET
+    return socket.AF_INET6
+
+
+def _nlattr(atype: int, payload: bytes) -> bytes:
+    hdr = struct.pack("=HH", 4 + len(payload), atype)
+    return hdr + payload + b"\0" * (-len(payload) % 4)
+
+
+def _nlattrs(data: bytes) -> dict[int, bytes]:
+    attrs = {}
+    off = 0
+    while off + 4 <= len(data):
+        alen, atype = struct.unpack_from("=HH", data, off)
+        if alen < 4:
+            break
+        attrs[atype & 0x3FFF] = data[off + 4 : off + alen]
+        off += (alen + 3) & ~3
+    return attrs
+
+
+def _nlattr_u32(attrs: dict[int, bytes], atype: int, default):
+    if atype not in attrs:
+        return default
+    return struct.unpack("=L", attrs[atype])[0]
+
+
+def _nlattr_addr(family: int, attrs: dict[int, bytes], atype: int) -> str | None:
+    if atype not in attrs:
+        return None
+    return socket.inet_ntop(family, attrs[atype])
+
+
+def _rule_msg(rule: _Rule) -> bytes:
+    attrs = [
+        _nlattr(FRA_PRIORITY, struct.pack("=L", rule.prio)),
+        _nlattr(FRA_TABLE, struct.pack("=L", rule.table)),
+    ]
+    if rule.src is not None:
+        attrs.append(_nlattr(FRA_SRC, socket.inet_pton(rule.family, rule.src)))
+    hdr = _RTMSG.pack(
+        rule.family, 0, rule.src_len, 0, RT_TABLE_UNSPEC, 0, 0, FR_ACT_TO_TBL, 0
+    )
+    return hdr + b"".join(attrs)
+
+
+def _route_msg(route: _Route, delete: bool = False) -> bytes:
+    attrs = [_nlattr(RTA_TABLE, struct.pack("=L", route.table))]
+    if route.dst is not None:
+        attrs.append(_nlattr(RTA_DST, socket.inet_pton(route.family, route.dst)))
+    if route.gateway is not None:
+        gwfamily = _family(route.gateway)
+        attrs.append(_nlattr(RTA_GATEWAY, socket.inet_pton(gwfamily, route.gateway)))
+    if route.oif is not None:
+        attrs.append(_nlattr(RTA_OIF, struct.pack("=L", route.oif)))
+    hdr = _RTMSG.pack(
+        route.family,
+        route.dst_len,
+        0,
+        0,
+        RT_TABLE_UNSPEC,
+        0 if delete else RTPROT_BOOT,
+        RT_SCOPE_NOWHERE if delete else RT_SCOPE_UNIVERSE,
+        route.rtype,
+        0,
+    )
+    return hdr + b"".join(attrs)
+
+
+MUX_FILTER_REGEX = re.compile(r"export_(?P<mux>[^_]+)_v(?P<version>[46])\.conf$")
+CLAUSE_MARKER = "# prefix "
+
+
+def _mux_config_fn(mux: str, version: int) -> str:
+    return f"export_{mux}_v{version}.conf"
+
+
+def _join_clauses(prefix2clause: dict[str, str]) -> str:
+    """Build a per-mux filter file, sorted by prefix so output is stable"""
+    parts = []
+    for prefix in sorted(prefix2clause):
+        parts.append(f"{CLAUSE_MARKER}{prefix}\n{prefix2clause[prefix].rstrip()}\n")
+    return "".join(parts)
+
+
+def _split_clauses(data: str) -> dict[str, str]:
+    prefix2clause: dict[str, str] = {}
+    for part in data.split(CLAUSE_MARKER)[1:]:
+        prefix, clause = part.split("\n", 1)
+        prefix2clause[prefix] = clause
+    return prefix2clause
+
 
 PROTOCOL_REGEX = re.compile(r"up(?P<peerid>\d+)_(?P<asn>\d+)")
 
@@ -350,6 +2680,235 @@ def protocol_to_peerid_asn(proto: str) -> tuple[int, int]:
     return (peerid, asn)
 
 
+def _birdc_configure(execname: str, sockpath: pathlib.Path) -> BirdReply:
+    cmd = f"{execname} -s {sockpath}"
+    start = time.monotonic()
+    proc = subprocess.Popen(  # noqa: S603
+        cmd.split(),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout, stderr = proc.communicate(b"configure\n")
+    r = proc.wait()
+    return _birdc_reply(execname, r, stdout, stderr, time.monotonic() - start)
+
+
+async def _async_birdc_configure(execname: str, sockpath: pathlib.Path) -> BirdReply:
+    import asyncio  # noqa: PLC0415
+
+    start = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        execname,
+        "-s",
+        str(sockpath),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate(b"configure\n")
+    r = await proc.wait()
+    return _birdc_reply(execname, r, stdout, stderr, time.monotonic() - start)
+
+
+def _birdc_reply(
+    execname: str, r: int, stdout: bytes, stderr: bytes, elapsed: float
+) -> BirdReply:
+    lines = [(0, line) for line in stdout.decode("utf8", "replace").splitlines()]
+    if r != 0:
+        logging.warning("%s reconfigure exited with status %d", execname, r)
+        logging.warning("%s", stdout)
+        logging.warning("%s", stderr)
+        return BirdReply(8002, f"{execname} exited with status {r}", lines, elapsed)
+    return BirdReply(3, "Reconfigured", lines, elapsed)
+
+
+_FILE_CACHE: dict[tuple, tuple[int, Any]] = {}
+"""Objects built from files, maps (loader, path, args) to (mtime_ns, object)"""
+
+_T = TypeVar("_T")
+
+
+def _load_cached(
+    path: pathlib.Path, loader: Callable[..., _T], *args: Hashable
+) -> _T:
+    """Return loader(path, *args), reusing it while path's mtime is unchanged
+
+    Lets controllers built repeatedly in a process (e.g., by the large-scale
+    scripts) skip re-reading the schema, the mux map and the template.
+    """
+    path = pathlib.Path(path).resolve()
+    mtime = path.stat().st_mtime_ns
+    key = (loader, path, args)
+    cached = _FILE_CACHE.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, loader(path, *args))
+        _FILE_CACHE[key] = cached
+    return cached[1]
+
+
+def _read_template(
+    path: pathlib.Path, cache_dir: pathlib.Path | None
+) -> "jinja2.Template":
+    import jinja2  # noqa: PLC0415
+
+    bytecode_cache = None
+    if cache_dir is not None:
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(str(cache_dir))
+        except OSError as e:
+            logging.info("not caching compiled templates in %s: %s", cache_dir, e)
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(path.parent),
+        autoescape=True,
+        bytecode_cache=bytecode_cache,
+    )
+    return env.get_template(path.name)
+
+
+def _read_mux2id(path: pathlib.Path) -> dict[str, int]:
+    mux2id: dict[str, int] = {}
+    with open(path, encoding="utf8") as fd:
+        for line in fd:
+            mux, tapdev = line.strip().split()
+            assert tapdev.startswith("tap")
+            mux2id[mux] = int(tapdev.removeprefix("tap"))
+    return mux2id
+
+
+def _exported_routes(reply: BirdReply) -> dict[str, ExportedRoute]:
+    """Parse the output of `show route ... all` into {prefix: attributes}
+
+    Only the first route listed for each prefix is kept.
+    """
+    prefix2route: dict[str, ExportedRoute] = {}
+    prefix = None
+    attrs: dict[str, list[str]] = {}
+    attr = None
+    for code, text in reply.lines:
+        if code == 1007 and text[:1] not in ("", " ", "\t"):
+            if prefix is not None and prefix not in prefix2route:
+                prefix2route[prefix] = _exported_route(attrs)
+            prefix = text.split()[0]
+            attrs = {}
+            attr = None
+        elif code == 1007 and text[:1] == " ":
+            # Another route for the same prefix, whose attributes are skipped
+            if prefix is not None and prefix not in prefix2route:
+                prefix2route[prefix] = _exported_route(attrs)
+            attr = None
+        elif code == 1007:
+            attr = None  # next hops of the route
+        elif code == 1012 and prefix is not None and prefix not in prefix2route:
+            name, sep, value = text.strip().partition(":")
+            if sep and name.startswith("BGP."):
+                attr = name
+                attrs[attr] = [value]
+            elif attr is not None:
+                attrs[attr].append(text)
+    if prefix is not None and prefix not in prefix2route:
+        prefix2route[prefix] = _exported_route(attrs)
+    return prefix2route
+
+
+def _exported_route(attrs: dict[str, list[str]]) -> ExportedRoute:
+    communities = " ".join(attrs.get("BGP.community", []))
+    large = " ".join(attrs.get("BGP.large_community", []))
+    return ExportedRoute(
+        frozenset(
+            (int(a), int(b)) for a, b in re.findall(r"\((\d+),\s*(\d+)\)", communities)
+        ),
+        frozenset(
+            (int(a), int(b), int(c))
+            for a, b, c in re.findall(r"\((\d+),\s*(\d+),\s*(\d+)\)", large)
+        ),
+    )
+
+
+def _down_protocols(reply: BirdReply) -> set[str]:
+    """Names of BGP protocols not Established in a `show protocols` reply"""
+    if not reply.ok:
+        logging.warning("show protocols failed: %s", reply.text())
+        return set()
+    down = set()
+    for code, text in reply.lines:
+        fields = text.split()
+        if code == 1002 and len(fields) >= 4 and fields[1] == "BGP":
+            if "Established" not in fields[4:]:
+                down.add(fields[0])
+    return down
+
+
+def _confirmable(
+    expected: dict[tuple[int, str], dict[str, ExportedRoute | None]],
+    down: dict[int, set[str]],
+) -> dict[tuple[int, str], dict[str, ExportedRoute | None]]:
+    """Expectations of muxes on BIRD daemons in down whose sessions are up"""
+    pending = {}
+    for key, prefix2route in expected.items():
+        version, mux = key
+        if version not in down:
+            continue
+        if mux in down[version]:
+            logging.info("BGP session to %s is down, not confirming exports", mux)
+            continue
+        pending[key] = prefix2route
+    return pending
+
+
+def _export_diff(
+    prefix2route: dict[str, ExportedRoute | None], reply: BirdReply
+) -> list[str]:
+    """Describe how exported routes in reply differ from prefix2route"""
+    if not reply.ok:
+        return [f"BIRD error {reply.code:04d}: {reply.message}"]
+    exported = _exported_routes(reply)
+    diff = []
+    for prefix, want in prefix2route.items():
+        have = exported.get(prefix)
+        if want is None:
+            if have is not None:
+                diff.append(f"{prefix} still exported")
+            continue
+        if have is None:
+            diff.append(f"{prefix} not exported")
+            continue
+        missing: list[tuple] = sorted(want.communities - have.communities)
+        missing.extend(sorted(want.large_communities - have.large_communities))
+        if missing:
+            diff.append(f"{prefix} missing communities {missing}")
+    return diff
+
+
+def _check_replies(replies: dict[int, BirdReply]) -> None:
+    for version, reply in replies.items():
+        if not reply.ok:
+            logging.warning("BIRD%d: %s", version, reply.text())
+            raise RuntimeError("Reconfiguring BIRD failed")
+
+
+def _stat_key(path: pathlib.Path) -> tuple[int, int, int] | None:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _is_uint(value, maximum: int) -> bool:
+    return isinstance(value, int) and 0 <= value <= maximum
+
+
+@functools.lru_cache(maxsize=4096)
+def _prefix_version(prefix: str) -> int:
+    return ipaddress.ip_network(prefix).version
+
+
+def _digest(data: str) -> str:
+    return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+
 def _run_check_log(cmd: str, check: bool, log_errors: bool = True) -> None:
     try:
         logging.info("running %s", cmd)
@@ -361,6 +2920,21 @@ def _run_check_log(cmd: str, check: bool, log_errors: bool = True) -> None:
         raise
 
 
+async def _async_run_check_log(cmd: str, check: bool, log_errors: bool = True) -> None:
+    import asyncio  # noqa: PLC0415
+
+    logging.info("running %s", cmd)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if check and proc.returncode != 0:
+        if log_errors:
+            logging.error("stdout: %s", stdout)
+            logging.error("stderr: %s", stderr)
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+
+
 class ExperimentController:
     def __init__(
         self,
@@ -379,9 +2953,13 @@ class ExperimentController:
             self.schema = json.load(fd)
 
     def validate(self, experiment):
+        import jsonschema  # noqa: PLC0415
+
         jsonschema.validate(experiment["experiment"], self.schema)
 
     def post_request(self, data, uri):
+        import requests  # noqa: PLC0415
+
         resp = requests.post(
             uri,
             json=data,
@@ -396,6 +2974,8 @@ class ExperimentController:
         return resp.json()
 
     def get_request(self, uri, detailed=""):
+        import requests  # noqa: PLC0415
+
         resp = requests.get(
             f"{uri}{detailed}",
             headers={
@@ -409,6 +2989,8 @@ class ExperimentController:
         return resp.json()
 
     def deploy(self, experiment):
+        import requests  # noqa: PLC0415
+
         self.validate(experiment)
         try:
             uri = f"{self.url}/api/"
@@ -418,6 +3000,8 @@ class ExperimentController:
             return http_err
 
     def retrieve(self, detailed=""):
+        import requests  # noqa: PLC0415
+
         try:
             uri = f"{self.url}/api/"
             response = self.get_request(uri, detailed)
@@ -476,7 +3060,7 @@ def main() -> int:
     if args.announcement:
         with open(args.announcement, encoding="utf8") as announcement_json_fd:
             announcement_dict = json.load(announcement_json_fd)
-            announcement = UpdateSet.from_dict({ "prefix2update": announcement_dict })
+            announcement = UpdateSet.from_dict({"prefix2update": announcement_dict})
         ctrl = AnnouncementController(prefixes)
         ctrl.deploy(announcement)
     elif args.experiment and args.url:
@@ -0,0 +1,1096 @@
+#!/usr/bin/env python3
+
+import asyncio
+import concurrent.futures
+import ipaddress
+import itertools
+import json
+import math
+import os
+import pathlib
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import jinja2
+
+PEERING_DIR = pathlib.Path(__file__).absolute().parent
+LARGE_SCALE_DIR = PEERING_DIR / "utils/large-scale"
+sys.path.insert(0, str(PEERING_DIR))
+sys.path.insert(1, str(LARGE_SCALE_DIR))
+
+import peering  # noqa: E402
+import catalog  # noqa: E402
+import controller  # noqa: E402
+import defs  # noqa: E402
+import phases  # noqa: E402
+import tracing  # noqa: E402
+
+# Budget for the cumulative time of `import peering`, in microseconds
+IMPORT_BUDGET_US = int(os.environ.get("PEERING_IMPORT_BUDGET_US", "150000"))
+IMPORT_RUNS = 3
+# Dependencies only the code paths that use them should load
+LAZY_MODULES = ["dataclasses_json", "jinja2", "jsonschema", "requests"]
+
+
+def import_times(module: str) -> list[tuple[str, int, int]]:
+    """Run `python -X importtime` and return (name, self_us, cumulative_us)"""
+    proc = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PEERING_DIR,
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        selftime, cumulative, name = line.removeprefix("import time:").split("|")
+        times.append((name.strip(), int(selftime), int(cumulative)))
+    return times
+
+
+def import_report(times: list[tuple[str, int, int]], count: int = 15) -> str:
+    lines = [f"{'self [us]':>10} {'cumul [us]':>10}  module"]
+    for name, selftime, cumulative in sorted(times, key=lambda t: -t[1])[:count]:
+        lines.append(f"{selftime:>10} {cumulative:>10}  {name}")
+    return "\n".join(lines)
+
+
+def bird_reply(text: str) -> "peering.BirdReply":
+    """Parse the text of a BIRD control socket reply"""
+    lines: list[tuple[int, str]] = []
+    for line in text.splitlines(keepends=True):
+        peering._bird_line(line, lines)
+    code, message = lines[-1]
+    return peering.BirdReply(code, message, lines)
+
+
+class TestImportTime(unittest.TestCase):
+    def test_heavy_dependencies_are_lazy(self):
+        imported = {name for name, _, _ in import_times("peering")}
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, imported)
+
+    def test_import_budget(self):
+        best = None
+        for _ in range(IMPORT_RUNS):
+            times = import_times("peering")
+            cumulative = next(c for name, _, c in times if name == "peering")
+            if best is None or cumulative < best[0]:
+                best = (cumulative, times)
+        assert best is not None
+        cumulative, times = best
+        self.assertLessEqual(
+            cumulative,
+            IMPORT_BUDGET_US,
+            f"import peering took {cumulative} us\n{import_report(times)}",
+        )
+
+
+class TestModels(unittest.TestCase):
+    def load_example(self) -> dict:
+        path = PEERING_DIR / "configs/announcement_example.json"
+        with open(path, encoding="utf8") as fd:
+            return json.load(fd)
+
+    def test_round_trip_example(self):
+        prefix2update = self.load_example()
+        updset = peering.UpdateSet.from_dict({"prefix2update": prefix2update})
+        update = updset.prefix2update["184.164.224.0/24"]
+        self.assertEqual(update.description, "Test Announcement")
+        (ann,) = update.announce
+        self.assertIs(ann.muxes[0], peering.MuxName.ufmg01)
+        # Fields missing from the file take their defaults
+        self.assertEqual((ann.peer_ids, ann.communities, ann.prepend), ([], [], []))
+        decoded = peering.UpdateSet.from_json(updset.to_json())
+        self.assertEqual(decoded, updset)
+        (decoded_ann,) = decoded.prefix2update["184.164.224.0/24"].announce
+        self.assertIs(decoded_ann.muxes[0], peering.MuxName.ufmg01)
+        # Serializing fills in the optional fields; the rest is unchanged
+        full = updset.to_dict()["prefix2update"]
+        self.assertEqual(full["184.164.224.0/24"]["withdraw"], [])
+        self.assertEqual(peering.UpdateSet.from_dict({"prefix2update": full}), updset)
+        self.assertEqual(json.loads(json.dumps(full)), full)
+
+    def test_round_trip_optional_fields(self):
+        d = {
+            "withdraw": ["amsterdam01"],
+            "announce": [
+                {
+                    "muxes": ["all"],
+                    "peer_ids": [1, 2],
+                    "communities": [[47065, 1]],
+                    "large_communities": [[47065, 1, 2]],
+                    "prepend": [47065],
+                }
+            ],
+            "description": None,
+        }
+        update = peering.Update.from_dict(d)
+        self.assertEqual(update.withdraw, [peering.MuxName.amsterdam01])
+        self.assertEqual(update.announce[0].muxes, ["all"])
+        self.assertEqual(update.announce[0].communities, [(47065, 1)])
+        self.assertEqual(update.announce[0].large_communities, [(47065, 1, 2)])
+        self.assertEqual(update.to_dict(), d)
+        self.assertEqual(peering.Update.from_json(update.to_json()), update)
+        self.assertEqual(peering.Update.from_dict({}), peering.Update())
+
+
+class TestBirdControl(unittest.TestCase):
+    STATUS = [
+        "1000-BIRD 2.0.8\n",
+        "1011-Router ID is 184.164.224.1\n",
+        " Current server time is 2024-01-01 00:00:00\n",
+        "1003-Hostname is peering\n",
+        "0013 Daemon is up and running\n",
+    ]
+
+    def parse(self, *text: str) -> tuple[list[bool], list[tuple[int, str]]]:
+        lines: list[tuple[int, str]] = []
+        return [peering._bird_line(t, lines) for t in text], lines
+
+    def test_bird_line(self):
+        ends, lines = self.parse(*self.STATUS)
+        self.assertEqual(ends, [False] * 4 + [True])
+        self.assertEqual(lines[2], (1011, "Current server time is 2024-01-01 00:00:00"))
+        self.assertEqual(lines[-1], (13, "Daemon is up and running"))
+        # 0xxx lines with "-" continue; the reply ends at the first without it
+        ends, lines = self.parse("0002-Reading configuration\n", "0003 Reconfigured\n")
+        self.assertEqual((ends, lines[-1]), ([False, True], (3, "Reconfigured")))
+        for error in ("8001 Command too long\n", "9001 syntax error\n"):
+            self.assertEqual(self.parse(error)[0], [True])
+        self.assertEqual(self.parse("9001-syntax error\n")[0], [True])
+
+    def serve(self, replies: list[list[str]]) -> pathlib.Path:
+        """Serve replies on a BIRD socket, sending each list item separately"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        sockpath = pathlib.Path(tmpdir.name) / "bird.ctl"
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(str(sockpath))
+        server.listen()
+
+        def run():
+            conn, _addr = server.accept()
+            with conn, conn.makefile("rb") as rfile:
+                conn.sendall(b"0001 BIRD 2.0.8 ready.\n")
+                for chunks in replies:
+                    rfile.readline()
+                    for chunk in chunks:
+                        conn.sendall(chunk.encode("utf8"))
+                        time.sleep(0.01)
+                rfile.readline()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+        return sockpath
+
+    def test_replies_over_socket(self):
+        status = "".join(self.STATUS)
+        # The status reply arrives in pieces that split its lines
+        split = [status[:5], status[5:40], status[40:-3], status[-3:]]
+        sockpath = self.serve([split, ["9001 syntax error, unexpected '('\n"]])
+        bird = peering.BirdControl(sockpath, timeout=5)
+        self.addCleanup(bird.close)
+        reply = bird.command("show status")
+        assert bird.welcome is not None
+        self.assertEqual(bird.welcome.message, "BIRD 2.0.8 ready.")
+        self.assertTrue(reply.ok)
+        self.assertEqual((reply.code, reply.message), (13, "Daemon is up and running"))
+        self.assertEqual(len(reply.lines), 5)
+        self.assertEqual(
+            reply.text(1011),
+            "Router ID is 184.164.224.1\nCurrent server time is 2024-01-01 00:00:00",
+        )
+        error = bird.command("show nonsense")
+        self.assertFalse(error.ok)
+        self.assertEqual(error.code, 9001)
+
+
+class TestExportCheck(unittest.TestCase):
+    ROUTES = bird_reply(
+        "1007-Table master4:\n"
+        "1007-184.164.224.0/24     unicast [static_224 00:00:00] * (200)\n"
+        " \tvia 100.65.128.1 on tap5\n"
+        "1008-\tType: static univ\n"
+        "1012-\tBGP.origin: IGP\n"
+        " \tBGP.community: (47065,1) (47065,2)\n"
+        " \t(65535,65281)\n"
+        " \tBGP.large_community: (47065, 1, 2)\n"
+        "1007-                     unicast [static_224b 00:00:00] (200)\n"
+        " \tvia 100.65.128.2 on tap5\n"
+        "1012-\tBGP.community: (47065,9)\n"
+        "1007-184.164.225.0/24     unicast [static_225 00:00:00] * (200)\n"
+        " \tvia 100.65.128.1 on tap5\n"
+        "1012-\tBGP.origin: IGP\n"
+        "0000 \n"
+    )
+    PROTOCOLS = bird_reply(
+        "2002-Name       Proto      Table      State  Since         Info\n"
+        "1002-device1    Device     ---        up     00:00:00\n"
+        " amsterdam01 BGP        ---        up     00:00:00      Established\n"
+        " clemson01  BGP        ---        start  00:00:00      Active\n"
+        " grnet01    BGP        ---        start  00:00:00      Connect\n"
+        "0000 \n"
+    )
+    ERROR = bird_reply("8003 No such protocol\n")
+
+    def test_exported_routes(self):
+        routes = peering._exported_routes(self.ROUTES)
+        self.assertEqual(set(routes), {"Table", "184.164.224.0/24", "184.164.225.0/24"})
+        # Only the first route for a prefix counts; wrapped lists are joined
+        route = routes["184.164.224.0/24"]
+        self.assertEqual(route.communities, {(47065, 1), (47065, 2), (65535, 65281)})
+        self.assertEqual(route.large_communities, {(47065, 1, 2)})
+        self.assertEqual(routes["184.164.225.0/24"], peering.ExportedRoute())
+
+    def test_export_diff(self):
+        ann = peering.Announcement(list(peering.MuxName)[:1], peer_ids=[1, 2])
+        confirmed = peering.ExportedRoute.from_announcement(ann)
+        missing = peering.ExportedRoute(frozenset({(47065, 3)}))
+        prefix2route = {
+            "184.164.224.0/24": confirmed,
+            "184.164.225.0/24": missing,
+            "184.164.226.0/24": confirmed,
+            "184.164.227.0/24": None,
+        }
+        diff = peering._export_diff(prefix2route, self.ROUTES)
+        self.assertEqual(
+            diff,
+            [
+                "184.164.225.0/24 missing communities [(47065, 3)]",
+                "184.164.226.0/24 not exported",
+            ],
+        )
+        withdrawn = {"184.164.225.0/24": None}
+        diff = peering._export_diff(withdrawn, self.ROUTES)
+        self.assertEqual(diff, ["184.164.225.0/24 still exported"])
+        diff = peering._export_diff(prefix2route, self.ERROR)
+        self.assertEqual(diff, ["BIRD error 8003: No such protocol"])
+
+    def test_down_protocols(self):
+        down = peering._down_protocols(self.PROTOCOLS)
+        self.assertEqual(down, {"clemson01", "grnet01"})
+        self.assertEqual(peering._down_protocols(self.ERROR), set())
+
+
+class ControllerTestCase(unittest.TestCase):
+    """Controllers sharing a temporary BIRD configuration directory"""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = pathlib.Path(tmpdir.name)
+        templates = PEERING_DIR / "configs/bird/templates"
+        shutil.copytree(templates, self.dir / "bird/templates")
+        (self.dir / "bird.ctl").touch()
+        with open(self.dir / "mux2dev.txt", "w", encoding="utf8") as fd:
+            fd.writelines(f"{mux} tap{i}\n" for i, mux in enumerate(peering.MuxName))
+
+    def controller(self, **kwargs) -> "peering.AnnouncementController":
+        return peering.AnnouncementController(
+            ["184.164.224.0/19"],
+            self.dir / "bird",
+            self.dir / "bird.ctl",
+            self.dir / "bird6.ctl",
+            mux2tap_file=self.dir / "mux2dev.txt",
+            template_cache_dir=None,
+            **kwargs,
+        )
+
+
+class TestWarmStart(ControllerTestCase):
+    def test_initialized_dir_is_not_rewritten(self):
+        first = self.controller()
+        files = {p: p.stat().st_mtime_ns for p in self.dir.rglob("*")}
+        second = self.controller()
+        self.assertEqual(files, {p: p.stat().st_mtime_ns for p in self.dir.rglob("*")})
+        self.assertIs(first.validator, second.validator)
+        self.assertIs(first.config_template, second.config_template)
+
+    def test_egress_backend_opens_lazily(self):
+        backend = mock.Mock()
+        with mock.patch.object(peering, "_egress_backend", return_value=backend) as f:
+            controller = self.controller()
+            f.assert_not_called()
+            controller.unset_egress(14224)
+            controller.reconcile_egress({}, [14225])
+            f.assert_called_once()
+            controller.close()
+        backend.close.assert_called_once()
+        backend.unset.assert_called_once_with(14224)
+
+
+class TestUpdateSetValidator(ControllerTestCase):
+    PREFIX = "184.164.224.0/24"
+
+    def updates(self, prefix: str = PREFIX, **kwargs) -> "peering.UpdateSet":
+        ann = peering.Announcement(list(peering.MuxName)[:1], **kwargs)
+        return peering.UpdateSet({prefix: peering.Update([], [ann])})
+
+    def errors(self, controller, updates: "peering.UpdateSet") -> list[str]:
+        with self.assertRaises(peering.AnnouncementValidationError) as cm:
+            controller.validate(updates)
+        return cm.exception.errors
+
+    def test_reports_every_error(self):
+        controller = self.controller()
+        mux = next(iter(peering.MuxName))
+        bad = peering.Announcement(
+            [mux, "nowhere01"],
+            communities=[(47065,), (47065, 1 << 16)],
+            large_communities=[(47065, 1)],
+        )
+        updates = peering.UpdateSet(
+            {
+                "138.185.228.0/24": peering.Update(["nowhere02"], [bad]),
+                "184.164.224.0/33": peering.Update([], [peering.Announcement([mux])]),
+            }
+        )
+        errors = self.errors(controller, updates)
+        self.assertEqual(len(errors), 7, errors)
+        joined = "\n".join(errors)
+        for fragment in (
+            "138.185.228.0/24 is not allocated",
+            "unknown mux 'nowhere02' in withdraw",
+            "unknown mux 'nowhere01'",
+            "invalid community (47065,)",
+            "invalid community (47065, 65536)",
+            "invalid large community (47065, 1)",
+            "invalid prefix '184.164.224.0/33'",
+        ):
+            self.assertIn(fragment, joined)
+        controller.validate(self.updates(communities=[(47065, 1)]))
+        empty = peering.UpdateSet({})
+        self.assertEqual(self.errors(controller, empty), ["no prefixes in UpdateSet"])
+
+    def test_checked_cache_does_not_hide_errors(self):
+        controller = self.controller()
+        updates = self.updates()
+        controller.validate(updates)
+        ann = updates.prefix2update[self.PREFIX].announce[0]
+        self.assertIn(peering.announcement_key(ann), controller.validator.checked)
+        # The cache covers the spec, not muxes or prefixes
+        ann = peering.Announcement(["nowhere01"])
+        with self.assertRaises(peering.AnnouncementValidationError):
+            controller.validator.validate(
+                peering.UpdateSet({self.PREFIX: peering.Update([], [ann])})
+            )
+        # Controllers share the validator, each with its own allocation
+        other = peering.AnnouncementController(
+            ["138.185.228.0/22"],
+            self.dir / "bird",
+            self.dir / "bird.ctl",
+            mux2tap_file=self.dir / "mux2dev.txt",
+            template_cache_dir=None,
+        )
+        self.assertIs(other.validator, controller.validator)
+        self.assertEqual(len(self.errors(other, self.updates())), 1)
+        other.validate(self.updates("138.185.229.0/24"))
+        controller.networks = other.networks
+        self.assertEqual(len(self.errors(controller, self.updates())), 1)
+
+
+class TestRenderCache(ControllerTestCase):
+    PREFIX = "184.164.224.0/24"
+
+    def test_hits_and_misses(self):
+        controller = self.controller()
+        mux1, mux2 = list(peering.MuxName)[:2]
+        data = controller.render(self.PREFIX, peering.Announcement([mux1]))
+        self.assertEqual((controller.render_misses, controller.render_hits), (1, 0))
+        again = controller.render(self.PREFIX, peering.Announcement([mux1]))
+        self.assertEqual(again, data)
+        self.assertEqual((controller.render_misses, controller.render_hits), (1, 1))
+        # Filters do not depend on the muxes, only on the announcement spec
+        controller.render(self.PREFIX, peering.Announcement([mux2]))
+        self.assertEqual(controller.render_hits, 2)
+        changed = peering.Announcement([mux1], communities=[(47065, 1)])
+        self.assertNotEqual(controller.render(self.PREFIX, changed), data)
+        controller.render("184.164.225.0/24", peering.Announcement([mux1]))
+        self.assertEqual((controller.render_misses, controller.render_hits), (3, 2))
+
+    def test_least_recently_used_render_is_evicted(self):
+        controller = self.controller()
+        mux = next(iter(peering.MuxName))
+        first = peering.Announcement([mux])
+        second = peering.Announcement([mux], communities=[(47065, 1)])
+        with mock.patch.object(peering, "RENDER_CACHE_SIZE", 1):
+            controller.render(self.PREFIX, first)
+            controller.render(self.PREFIX, second)
+            controller.render(self.PREFIX, first)
+        self.assertEqual((controller.render_misses, controller.render_hits), (3, 0))
+
+    def test_template_bytecode_cache(self):
+        path = self.dir / "bird/templates/export_mux_pfx.jinja2"
+        cache_dir = self.dir / "jinja2-cache"
+        template = peering._read_template(path, cache_dir)
+        self.assertEqual(len(list(cache_dir.iterdir())), 1)
+        with mock.patch.object(jinja2.Environment, "compile") as compile_:
+            cached = peering._read_template(path, cache_dir)
+        compile_.assert_not_called()
+        spec = peering.Announcement(list(peering.MuxName)[:1]).to_dict()
+        self.assertEqual(
+            cached.render(prefix=self.PREFIX, spec=spec),
+            template.render(prefix=self.PREFIX, spec=spec),
+        )
+        # An unusable cache directory only disables the cache
+        unusable = self.dir / "mux2dev.txt"
+        with self.assertLogs(level="INFO"):
+            peering._read_template(path, unusable)
+
+
+class TestFilterLayout(ControllerTestCase):
+    PREFIX = "184.164.224.0/24"
+
+    def updates(self, *muxes: "peering.MuxName", **kwargs) -> "peering.UpdateSet":
+        ann = peering.Announcement(list(muxes), **kwargs)
+        return peering.UpdateSet({self.PREFIX: peering.Update([], [ann])})
+
+    def test_clauses_round_trip(self):
+        prefix2clause = {
+            "184.164.225.0/24": "accept;\n\n",
+            "2804:269c:fe41::/48": "reject;",
+            "184.164.224.0/24": "accept;",
+        }
+        data = peering._join_clauses(prefix2clause)
+        reordered = dict(reversed(prefix2clause.items()))
+        self.assertEqual(data, peering._join_clauses(reordered))
+        self.assertLess(data.index("184.164.224.0/24"), data.index("184.164.225.0/24"))
+        self.assertEqual(
+            peering._split_clauses(data),
+            {p: c.rstrip() + "\n" for p, c in prefix2clause.items()},
+        )
+        self.assertEqual(peering._split_clauses(""), {})
+
+    def test_per_mux_diff(self):
+        mux1, mux2 = list(peering.MuxName)[:2]
+        controller = self.controller(filter_layout=peering.FilterLayout.PER_MUX)
+        diff = controller.diff(self.updates(mux1, mux2))
+        files = {peering._mux_config_fn(mux, 4) for mux in (mux1, mux2)}
+        self.assertEqual(set(diff.write), files)
+        self.assertEqual((diff.remove, diff.versions), (set(), {4}))
+        self.assertEqual(diff.prefixes, {self.PREFIX})
+        for data in diff.write.values():
+            self.assertEqual(list(peering._split_clauses(data)), [self.PREFIX])
+        controller.apply(diff)
+        self.assertFalse(controller.diff(self.updates(mux1, mux2)))
+
+        # Muxes an update does not mention keep their clauses
+        diff = controller.diff(self.updates(mux1, communities=[(47065, 1)]))
+        self.assertEqual(diff.remove, set())
+        self.assertEqual(set(diff.write), {peering._mux_config_fn(mux1, 4)})
+        withdraw = peering.UpdateSet({self.PREFIX: peering.Update(["all"])})
+        diff = controller.diff(withdraw)
+        self.assertEqual((diff.remove, diff.write), (files, {}))
+
+    def test_layout_switch_removes_other_layout(self):
+        mux = next(iter(peering.MuxName))
+        per_mux = self.controller(filter_layout=peering.FilterLayout.PER_MUX)
+        per_mux.apply(per_mux.diff(self.updates(mux)))
+        per_prefix = self.controller()
+        diff = per_prefix.diff(self.updates(mux))
+        self.assertEqual(diff.remove, {peering._mux_config_fn(mux, 4)})
+        self.assertEqual(len(diff.write), 1)
+        self.assertEqual(diff.prefixes, {self.PREFIX})
+
+
+class TestReloadCoalescing(ControllerTestCase):
+    def setUp(self):
+        super().setUp()
+        # bird_sockets() skips daemons without a unix socket
+        (self.dir / "bird.ctl").unlink()
+        sock = socket.socket(socket.AF_UNIX)
+        self.addCleanup(sock.close)
+        sock.bind(str(self.dir / "bird.ctl"))
+        self.reply = peering.BirdReply(3, "Reconfigured")
+        patcher = mock.patch.object(
+            peering, "_birdc_configure", return_value=self.reply
+        )
+        self.configure = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def change(self, controller: "peering.AnnouncementController", fn: str) -> None:
+        controller.apply(peering.FilterDiff({fn: f"{fn}\n"}, versions={4}))
+
+    def test_reconfigure_covers_changes_of_other_processes(self):
+        first = self.controller(use_birdc=True, reload_window=0)
+        second = self.controller(use_birdc=True, reload_window=0)
+        self.change(first, "export_a.conf")
+        self.change(second, "export_b.conf")
+        self.assertEqual(first.reload_pending(), {4: self.reply})
+        self.assertEqual(second.reload_pending(), {4: self.reply})
+        self.configure.assert_called_once()
+        self.assertEqual(second.reload_stats["coalesced"], 1)
+        self.assertEqual(second.pending_versions, set())
+
+    def test_later_changes_are_not_covered(self):
+        first = self.controller(use_birdc=True, reload_window=0)
+        second = self.controller(use_birdc=True, reload_window=0)
+        self.change(first, "export_a.conf")
+        first.reload_pending()
+        self.change(second, "export_b.conf")
+        with second.locked():
+            self.assertEqual(second.covered_reloads([4]), ({}, [4]))
+        second.reload_pending()
+        self.assertEqual(self.configure.call_count, 2)
+        self.assertEqual(first.reload_pending(), {})
+
+
+class TestStagedDeploy(ControllerTestCase):
+    PREFIX = "184.164.224.0/24"
+
+    def setUp(self):
+        super().setUp()
+        (self.dir / "bird.ctl").unlink()
+        sock = socket.socket(socket.AF_UNIX)
+        self.addCleanup(sock.close)
+        sock.bind(str(self.dir / "bird.ctl"))
+        patcher = mock.patch.object(
+            peering, "_birdc_configure", return_value=peering.BirdReply(3, "OK")
+        )
+        self.configure = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def deploy(self, controller: "peering.AnnouncementController", i: int) -> None:
+        ann = peering.Announcement([list(peering.MuxName)[i]])
+        updates = peering.UpdateSet({self.PREFIX: peering.Update([], [ann])})
+        controller.deploy(updates, flap_policy=peering.FlapPolicy.RECORD)
+
+    def live(self, controller: "peering.AnnouncementController") -> dict[str, str]:
+        files = controller.filters_dir.iterdir()
+        return {p.name: p.read_text(encoding="utf8") for p in files}
+
+    def test_rollback_restores_previous_generation(self):
+        controller = self.controller(use_birdc=True, reload_window=0, staged=True)
+        self.deploy(controller, 0)
+        first = (self.live(controller), dict(controller.deployed))
+        self.assertEqual(os.readlink(controller.filters_dir), "prefix-filters.d/1")
+        self.configure.return_value = peering.BirdReply(
+            8001, "Filter error", [(8001, "Filter error")]
+        )
+        with self.assertRaises(RuntimeError):
+            self.deploy(controller, 1)
+        # Both the rejected deploy and the reload of the previous generation
+        self.assertEqual(self.configure.call_count, 3)
+        self.assertEqual(os.readlink(controller.filters_dir), "prefix-filters.d/1")
+        self.assertFalse((controller.generations_dir / "2").exists())
+        self.assertEqual((self.live(controller), controller.deployed), first)
+        self.assertEqual(self.controller(staged=True).deployed, first[1])
+
+    def test_prune_keeps_live_and_previous(self):
+        controller = self.controller(use_birdc=True, reload_window=0, staged=True)
+        for i in range(3):
+            self.deploy(controller, i)
+        gens = {p.name for p in controller.generations_dir.iterdir()}
+        self.assertEqual(gens, {"2", "3"})
+        self.assertEqual(os.readlink(controller.filters_dir), "prefix-filters.d/3")
+        # Muxes not in an update keep their filters, so each deploy adds one
+        self.assertEqual(len(list((controller.generations_dir / "2").iterdir())), 2)
+        self.assertEqual(len(self.live(controller)), 3)
+        # Unchanged files are hard links shared with the previous generation
+        for path in (controller.generations_dir / "2").iterdir():
+            self.assertTrue(path.samefile(controller.filters_dir / path.name))
+
+
+class TestAsyncController(ControllerTestCase):
+    PREFIX = "184.164.224.0/24"
+    BLOCKING = ("flap_wait", "covered_reloads", "record_reloads")
+
+    def setUp(self):
+        super().setUp()
+        (self.dir / "bird.ctl").unlink()
+        sock = socket.socket(socket.AF_UNIX)
+        self.addCleanup(sock.close)
+        sock.bind(str(self.dir / "bird.ctl"))
+        reply = peering.BirdReply(3, "Reconfigured")
+        patcher = mock.patch.object(
+            peering, "_async_birdc_configure", mock.AsyncMock(return_value=reply)
+        )
+        self.configure = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Threads that ran each controller method doing file I/O
+        self.threads: dict[str, set[threading.Thread]] = {}
+        for name in self.BLOCKING:
+            method = getattr(peering.AnnouncementController, name)
+            patcher = mock.patch.object(
+                peering.AnnouncementController, name, self.spy(name, method)
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def spy(self, name: str, method):
+        def wrapper(controller, *args, **kwargs):
+            self.threads.setdefault(name, set()).add(threading.current_thread())
+            return method(controller, *args, **kwargs)
+
+        return wrapper
+
+    def deploy(self, **kwargs) -> "peering.AnnouncementController":
+        ctl = peering.AsyncAnnouncementController(
+            ["184.164.224.0/19"],
+            self.dir / "bird",
+            self.dir / "bird.ctl",
+            self.dir / "bird6.ctl",
+            mux2tap_file=self.dir / "mux2dev.txt",
+            template_cache_dir=None,
+            use_birdc=True,
+            reload_window=0,
+            **kwargs,
+        )
+        ann = peering.Announcement(list(peering.MuxName)[:1])
+        updates = peering.UpdateSet({self.PREFIX: peering.Update([], [ann])})
+        asyncio.run(ctl.deploy(updates))
+        self.configure.assert_awaited_once()
+        return ctl.controller
+
+    def assert_off_event_loop(self, names: tuple[str, ...]) -> None:
+        self.assertEqual(set(self.threads), set(names))
+        for name, threads in self.threads.items():
+            self.assertNotIn(threading.main_thread(), threads, name)
+
+    def test_deploy(self):
+        controller = self.deploy()
+        self.assertEqual(controller.reload_stats["configures"], 1)
+        self.assert_off_event_loop(self.BLOCKING)
+
+    def test_staged_deploy(self):
+        controller = self.deploy(staged=True)
+        self.assertEqual(controller.reload_stats["configures"], 1)
+        self.assert_off_event_loop(("flap_wait", "record_reloads"))
+
+
+class TestNetlinkEgress(unittest.TestCase):
+    def unpack(self, data: bytes) -> tuple[tuple, dict[int, bytes]]:
+        hdr = peering._RTMSG.unpack_from(data)
+        return hdr, peering._nlattrs(data[peering._RTMSG.size :])
+
+    def test_messages_round_trip(self):
+        for rule in (
+            peering._Rule(socket.AF_INET, 14224, 14224, "184.164.224.254", 32),
+            peering._Rule(socket.AF_INET6, 14256, 14256, "2804:269c:fe41::1", 128),
+            peering._Rule(socket.AF_INET, 14227, 14227, "184.164.227.0", 24),
+            peering._Rule(socket.AF_INET, 14225, 14225, None, 0),
+        ):
+            hdr, attrs = self.unpack(peering._rule_msg(rule))
+            self.assertEqual(peering._parse_rule(rule.family, hdr, attrs), rule)
+            self.assertEqual(hdr[2], rule.src_len)
+        for route in (
+            peering._Route(socket.AF_INET, 14224, None, 0, "100.65.128.1", 5, 1),
+            peering._Route(socket.AF_INET6, 14256, "2804:269c::", 32, None, None, 1),
+        ):
+            hdr, attrs = self.unpack(peering._route_msg(route))
+            self.assertEqual(peering._parse_route(route.family, hdr, attrs), route)
+            self.assertEqual(hdr[5:7], (peering.RTPROT_BOOT, peering.RT_SCOPE_UNIVERSE))
+            hdr, _attrs = self.unpack(peering._route_msg(route, delete=True))
+            self.assertEqual(hdr[5:7], (0, peering.RT_SCOPE_NOWHERE))
+
+    def test_egress_changes(self):
+        af = socket.AF_INET
+        rules = [
+            peering._Rule(af, 14224, 14224, "184.164.224.254", 32),
+            peering._Rule(af, 14225, 14225, "184.164.225.254", 32),
+            peering._Rule(af, 32766, 254, None, 0),
+        ]
+        routes = [
+            peering._Route(af, 14224, None, 0, "100.65.128.2", None, 1),
+            peering._Route(af, 254, None, 0, "10.0.0.1", 2, 1),
+        ]
+        prio2route = {
+            14224: ("184.164.224.254", "100.65.128.1"),
+            14226: ("184.164.226.254", "100.65.128.3"),
+        }
+        msgs = peering._egress_changes(prio2route, [14225], rules, routes)
+        self.assertEqual(
+            [msgtype for msgtype, _flags, _data in msgs],
+            [
+                peering.RTM_DELRULE,
+                peering.RTM_DELROUTE,
+                peering.RTM_NEWROUTE,
+                peering.RTM_NEWROUTE,
+                peering.RTM_NEWRULE,
+            ],
+        )
+        self.assertEqual(msgs[0][2], peering._rule_msg(rules[1]))
+        self.assertEqual(msgs[1][2], peering._route_msg(routes[0], delete=True))
+        hdr, attrs = self.unpack(msgs[2][2])
+        route = peering._parse_route(af, hdr, attrs)
+        self.assertEqual((route.table, route.gateway), (14224, "100.65.128.1"))
+        hdr, attrs = self.unpack(msgs[4][2])
+        rule = peering._Rule(af, 14226, 14226, "184.164.226.254", 32)
+        self.assertEqual(peering._parse_rule(af, hdr, attrs), rule)
+        flags = {flags for _msgtype, flags, _data in msgs[2:]}
+        self.assertEqual(flags, {peering.NLM_F_CREATE_EXCL})
+        self.assertEqual(peering._egress_changes({}, [], rules, routes), [])
+        # A rule for the whole source prefix is deleted with its own length
+        wide = peering._Rule(af, 14224, 14224, "184.164.224.254", 24)
+        msgs = peering._egress_changes(prio2route, [], [wide], routes)
+        self.assertEqual(msgs[0], (peering.RTM_DELRULE, 0, peering._rule_msg(wide)))
+        self.assertEqual(self.unpack(msgs[0][2])[0][2], 24)
+        added = [data for msgtype, _, data in msgs if msgtype == peering.RTM_NEWRULE]
+        hdr, attrs = self.unpack(added[0])
+        host = peering._Rule(af, 14224, 14224, "184.164.224.254", 32)
+        self.assertEqual(peering._parse_rule(af, hdr, attrs), host)
+
+
+class TestFlapLedger(unittest.TestCase):
+    PREFIX = "184.164.224.0/24"
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = pathlib.Path(tmpdir.name) / peering.FLAP_LEDGER_FN
+
+    def test_budget_and_window(self):
+        ledger = peering.FlapLedger(self.path, 2, 100, max_penalty=math.inf)
+        self.assertEqual(ledger.earliest(self.PREFIX, 1000), 1000)
+        ledger.record([self.PREFIX], 1000)
+        self.assertEqual(ledger.earliest(self.PREFIX, 1010), 1010)
+        ledger.record([self.PREFIX, "184.164.225.0/24"], 1030)
+        # The event at 1000 leaves the window at 1100
+        self.assertEqual(ledger.earliest(self.PREFIX, 1050), 1100)
+        self.assertEqual(ledger.events(self.PREFIX, 1100), [1030])
+        self.assertEqual(ledger.earliest(self.PREFIX, 1100), 1100)
+        self.assertEqual(ledger.earliest("184.164.225.0/24", 1050), 1050)
+        ledger.record([self.PREFIX], 1100)
+        self.assertEqual(ledger.earliest(self.PREFIX, 1100), 1130)
+
+    def test_penalty_stays_below_suppress_threshold(self):
+        ledger = peering.FlapLedger(self.path)
+        now = 0.0
+        for _ in range(20):
+            now = ledger.earliest(self.PREFIX, now)
+            ledger.prefix2events.setdefault(self.PREFIX, []).append(now)
+            self.assertLessEqual(ledger.penalty(self.PREFIX, now), 1800 + 1e-6)
+        # The event count budget applies as well
+        events = ledger.prefix2events[self.PREFIX]
+        for first, last in zip(events, events[3:]):
+            self.assertGreaterEqual(last - first, 3600)
+        # The second change waits for the first one's penalty to decay to 800
+        ledger.prefix2events = {self.PREFIX: [0.0]}
+        self.assertAlmostEqual(ledger.earliest(self.PREFIX, 0), 900 * math.log2(1.25))
+        self.assertEqual(ledger.earliest(self.PREFIX, 600), 600)
+
+    def test_persistence_and_retention(self):
+        ledger = peering.FlapLedger(self.path, window=100)
+        ledger.record([self.PREFIX], 0)
+        retention = peering.FLAP_RETENTION
+        ledger.record(["184.164.225.0/24"], retention)
+        reloaded = peering.FlapLedger(self.path, window=100)
+        reloaded.load()
+        self.assertEqual(reloaded.prefix2events, {"184.164.225.0/24": [retention]})
+        # Events are kept for the window if it exceeds FLAP_RETENTION
+        ledger = peering.FlapLedger(self.path, window=2 * retention)
+        ledger.record([self.PREFIX], 3 * retention - 1)
+        self.assertEqual(
+            ledger.prefix2events,
+            {"184.164.225.0/24": [retention], self.PREFIX: [3 * retention - 1]},
+        )
+        self.path.write_text("{", encoding="utf8")
+        with self.assertLogs(level="WARNING"):
+            ledger.load()
+        self.assertEqual(ledger.prefix2events, {})
+
+
+class TestPhaseSequence(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+        mux1, mux2 = list(peering.MuxName)[:2]
+        ann = peering.Announcement
+        self.phase1 = [
+            phases.baseline(),
+            peering.Update([], [ann([mux1])], "mux1"),
+            peering.Update([], [ann([mux1, mux2])], "both"),
+        ]
+        self.phase2 = [
+            phases.baseline(),
+            peering.Update([], [ann([mux2]), ann([mux1])], "both split"),
+            peering.Update([mux1], [ann([mux2])], "mux2"),
+            peering.Update([], [ann([mux1])], "mux1 again"),
+        ]
+
+    def phase(self, updates: list["peering.Update"]):
+        def generate():
+            self.calls += 1
+            return iter(updates)
+
+        return generate
+
+    def test_dedupe_by_update_key(self):
+        seq = phases.PhaseSequence(self.phase(self.phase1), self.phase(self.phase2))
+        kept = [update.description for update in seq]
+        self.assertEqual(kept, ["anycast", "mux1", "both", "mux2"])
+        self.assertEqual(
+            seq.collapsed,
+            {"anycast": ["anycast"], "both": ["both split"], "mux1": ["mux1 again"]},
+        )
+        self.assertEqual(len(seq), 4)
+        self.assertEqual(self.calls, 4)
+
+    def test_from_index(self):
+        seq = phases.PhaseSequence(self.phase(self.phase1), self.phase(self.phase2))
+        pairs = [(i, update.description) for i, update in seq.from_index(1, 2)]
+        self.assertEqual(pairs, [(1, "mux1"), (3, "mux2")])
+        self.assertEqual(list(seq.from_index(4)), [])
+        # Each pass regenerates the phases instead of storing updates
+        self.assertEqual([i for i, _ in seq.from_index(0)], [0, 1, 2, 3])
+        self.assertEqual(self.calls, 6)
+
+
+class TestRoundPlanning(unittest.TestCase):
+    def announce(self, *muxes: int, description: str = "") -> "peering.Update":
+        allmuxes = list(peering.MuxName)
+        ann = peering.Announcement([allmuxes[i] for i in muxes])
+        return peering.Update([], [ann], description)
+
+    def test_order_transitions(self):
+        first, second = defs.PREFIXES[:2]
+        near = self.announce(0, 1, description="near")
+        far = self.announce(3, 4, 5, description="far")
+        rounds = [
+            {first: ("a", self.announce(0, description="start")), second: ("a", far)},
+            {first: ("a", far)},
+            {second: ("b", near)},
+            {first: ("b", near), second: ("b", self.announce(0))},
+        ]
+        ordered = controller.order_transitions(phases.Manifest(rounds, 10.0, True))
+        self.assertEqual((ordered.duration, ordered.incremental), (10.0, True))
+        lane = [update.description for _index, update in ordered.lane(first)]
+        self.assertEqual(lane, ["start", "near", "far"])
+        self.assertEqual([set(r) for r in ordered.rounds], [set(r) for r in rounds])
+        # Updates move between a lane's rounds with their phase
+        self.assertEqual(ordered.rounds[1][first], ("b", near))
+        self.assertEqual(ordered.rounds[3][first], ("a", far))
+        self.assertEqual(ordered.rounds[3][second], ("b", near))
+        self.assertEqual(controller.transition_total(ordered), 1 + 5 + 4 + 1)
+
+    def test_plan_rounds(self):
+        reserved, busy = defs.PREFIXES[:2]
+        updates = {
+            "a": [self.announce(i % 3, description=f"a{i}") for i in range(26)],
+            "b": [self.announce(1, 2, description="b0")],
+        }
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        ledger = peering.FlapLedger(pathlib.Path(tmpdir.name) / peering.FLAP_LEDGER_FN)
+        ledger.prefix2events[busy] = [time.time()] * ledger.max_events
+        constraints = {reserved: controller.PrefixConstraint(phases={"b"})}
+        manifest = controller.plan_rounds(updates, constraints, ledger)
+        entries = [entry for _index, entry in manifest.entries()]
+        self.assertEqual(len(entries), 27)
+        self.assertEqual([e for e in entries if e[0] == "b"], [("b", updates["b"][0])])
+        lane = [r[reserved][0] for r in manifest.rounds if reserved in r]
+        self.assertEqual(lane, ["b"])
+        # The prefix over its flap budget starts after all the others
+        _phase, first = manifest.rounds[0][busy]
+        self.assertGreaterEqual(int(first.description[1:]), 12)
+        # Each prefix's k-th update is in round k, so later rounds have the gaps
+        self.assertEqual(len(manifest.rounds[0]), len(defs.PREFIXES))
+        for earlier, later in itertools.pairwise(manifest.rounds):
+            self.assertLessEqual(set(later), set(earlier))
+        self.assertGreater(manifest.duration, controller.lane_cycle())
+        with self.assertRaises(ValueError):
+            only_a = {p: controller.PrefixConstraint({"a"}) for p in defs.PREFIXES}
+            controller.plan_rounds({"c": [self.announce(0)]}, only_a)
+
+
+class TestRunJournal(unittest.TestCase):
+    PREFIX = defs.PREFIXES[0]
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = pathlib.Path(tmpdir.name)
+        muxes = list(peering.MuxName)[:2]
+        rounds = [
+            {self.PREFIX: ("a", peering.Update([], [peering.Announcement([mux])]))}
+            for mux in muxes
+        ]
+        self.manifest = phases.Manifest(rounds, 0.0, False)
+        self.digest = controller.updates_digest(self.manifest)
+
+    def written(self, basedir: pathlib.Path, lane: "controller.Lane") -> bool:
+        """Whether the lane's round has its announcement and egress on disk"""
+        if lane.current is None:
+            return False
+        outdir = lane.round_outdir(basedir)
+        try:
+            with open(outdir / "announcements.json", encoding="utf8") as fd:
+                announced = self.PREFIX in json.load(fd)
+            with open(outdir / "egresses.json", encoding="utf8") as fd:
+                return announced and lane.srcip in json.load(fd)
+        except FileNotFoundError:
+            return False
+
+    def run_lane(self, basedir: pathlib.Path) -> list[bool]:
+        """Run the lane to the end, returning written() after each journal line"""
+        ctrl = mock.Mock(reload_stats={"configures": 0}, reload_latency={})
+        ctrl.earliest_safe_time.return_value = 0.0
+        ctrl.deploy.return_value = 0.0
+        measured: concurrent.futures.Future = concurrent.futures.Future()
+        measured.set_result(True)
+        measurer = mock.Mock()
+        measurer.submit.return_value = measured
+        (lane,) = controller.make_lanes(self.manifest)
+        written = []
+        with controller.RunJournal(basedir, self.digest) as journal:
+            append = journal.append
+
+            def append_and_check(entry: dict) -> None:
+                append(entry)
+                written.append(self.written(basedir, lane))
+
+            journal.append = append_and_check  # type: ignore[method-assign]
+            tracer = tracing.Tracer(None)
+            while lane.state != controller.LaneState.DONE:
+                controller.step_lane(
+                    ctrl, lane, measurer, journal, tracer, mock.Mock(), basedir
+                )
+        return written
+
+    def test_restore_after_each_event(self):
+        basedir = self.dir / "run"
+        written = self.run_lane(basedir)
+        with open(basedir / controller.JOURNAL_FN, encoding="utf8") as fd:
+            lines = fd.readlines()
+        self.assertEqual(len(written), len(lines) - 1)
+        for count in range(2, len(lines) + 1):
+            resumed = self.dir / f"resumed{count}"
+            resumed.mkdir()
+            with open(resumed / controller.JOURNAL_FN, "w", encoding="utf8") as fd:
+                fd.writelines(lines[:count])
+            (lane,) = controller.make_lanes(self.manifest)
+            with controller.RunJournal(resumed, self.digest) as journal:
+                self.assertEqual(journal.restore([lane]), [lane])
+            entry = json.loads(lines[count - 1])
+            if lane.state in (controller.LaneState.MEASURE, controller.LaneState.HOLD):
+                # The round's files must not depend on lines a crash could lose
+                self.assertTrue(written[count - 2], entry["event"])
+                self.assertIsNotNone(lane.deployed)
+            if entry["event"] == "done":
+                self.assertEqual(lane.state, controller.LaneState.DONE)
+            elif entry["event"] == "held":
+                self.assertEqual(lane.state, controller.LaneState.WITHDRAW)
+                if lane.current is not None:
+                    self.assertGreater(lane.current[0], entry["index"])
+            else:
+                assert lane.current is not None
+                self.assertEqual(lane.current[0], entry["index"])
+
+
+class TestPingerBudget(unittest.TestCase):
+    def acquire_later(self, budget: "controller.PingerBudget") -> list[int]:
+        shares: list[int] = []
+        thread = threading.Thread(target=lambda: shares.append(budget.acquire()))
+        thread.start()
+        self.addCleanup(thread.join)
+        thread.join(timeout=1)
+        return shares
+
+    def test_staggered_pingers_run_concurrently(self):
+        budget = controller.PingerBudget(5000, 4)
+        # The first pinger starts alone but only takes its share
+        self.assertEqual(budget.acquire(), 1250)
+        self.assertEqual(self.acquire_later(budget), [1250])
+        budget.acquire()
+        budget.acquire()
+        self.assertEqual(budget.available, 0)
+        shares = self.acquire_later(budget)
+        self.assertEqual(shares, [])
+        budget.release(1250)
+        for _ in range(100):
+            if shares:
+                break
+            time.sleep(0.01)
+        self.assertEqual(shares, [1250])
+        budget.release(None)
+        self.assertEqual(budget.available, 0)
+
+
+class TestRunCatalog(unittest.TestCase):
+    PREFIX = "184.164.224.0/24"
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = pathlib.Path(tmpdir.name, catalog.CATALOG_FN)
+        self.catalog = catalog.RunCatalog(path)
+        self.addCleanup(self.catalog.close)
+        self.mux1, self.mux2 = list(peering.MuxName)[:2]
+
+    def entry(
+        self, rnd: int, start: float, *muxes: "peering.MuxName"
+    ) -> catalog.RoundEntry:
+        update = peering.Update([], [peering.Announcement(list(muxes))], f"r{rnd}")
+        return catalog.RoundEntry(
+            "phase1", rnd, self.PREFIX, update, None, start, start + 90, start + 10
+        )
+
+    def test_live(self):
+        entries = [self.entry(0, 0, self.mux1), self.entry(1, 100, self.mux2)]
+        self.assertEqual(self.catalog.add(entries), 2)
+        self.assertIsNone(self.catalog.live(self.PREFIX, 5))
+        found = self.catalog.live(self.PREFIX, 50)
+        assert found is not None
+        entry, key = found
+        self.assertEqual((entry.round, entry.update), (0, entries[0].update))
+        self.assertEqual(key, catalog.announcement_key(entries[0].update))
+        # Between the end of a hold and the next deploy nothing is live
+        self.assertIsNone(self.catalog.live(self.PREFIX, 95))
+        self.assertEqual(self.catalog.live(self.PREFIX, 110)[0].round, 1)
+        self.assertIsNone(self.catalog.live("184.164.225.0/24", 50))
+        self.assertEqual(self.catalog.duration(), (0, 190))
+
+    def test_withdrawn_and_replacement(self):
+        self.catalog.add([self.entry(0, 0, self.mux1), self.entry(1, 100, self.mux1)])
+        self.assertIn(("phase1", 0, self.PREFIX), self.catalog.withdrawn(self.mux2))
+        self.assertEqual(self.catalog.withdrawn(self.mux1), [])
+        # Adding a round again replaces it, along with its withdrawn muxes
+        self.catalog.add([self.entry(1, 100, self.mux2)])
+        replaced = [("phase1", 1, self.PREFIX)]
+        self.assertEqual(self.catalog.withdrawn(self.mux1), replaced)
+        self.assertEqual(len(self.catalog.withdrawn(self.mux2)), 1)
+        rows = self.catalog.db.execute("SELECT count(*) FROM rounds").fetchone()
+        self.assertEqual(rows, (2,))
+        self.assertEqual(
+            catalog.withdrawn_muxes(self.entry(0, 0, *peering.MuxName).update), []
+        )
+
+
+class TestPrefixPlan(unittest.TestCase):
+    def test_matches_inline_derivations(self):
+        prefixes = ["184.164.224.0/24", "184.164.251.0/24", "2804:269c:fe41::/48"]
+        plan = peering.PrefixPlan(prefixes, 14000)
+        self.assertEqual(plan.prios(), [14224, 14251, 14256])
+        self.assertEqual(plan.srcip("184.164.251.0/24"), "184.164.251.254")
+        self.assertEqual(plan.vpip("184.164.224.0/24"), "184.164.224.1")
+        last = "2804:269c:fe41:ffff:ffff:ffff:ffff:ffff"
+        self.assertEqual(plan.srcip("2804:269c:fe41::/48"), last)
+        self.assertEqual(plan.vpip("2804:269c:fe41:0::/48"), "2804:269c:fe41::1")
+        self.assertEqual(plan.keys, ("224", "251", "fe41"))
+        self.assertEqual(list(plan.families), [4, 4, 6])
+        for prefix in ("184.164.225.0/24", "10.0.0.0/31", "2001:db8::/126"):
+            hosts = list(ipaddress.ip_network(prefix).hosts())
+            single = peering.PrefixPlan([prefix])
+            self.assertEqual(single.vpip(prefix), str(hosts[0]))
+            self.assertEqual(single.srcip(prefix), str(hosts[-1]))
+
+    def test_sequential_ids_and_key_clashes(self):
+        plan = peering.PrefixPlan(["184.164.231.0/24", "184.164.224.0/24"], 44000, True)
+        self.assertEqual(plan.icmpid("184.164.224.0/24"), 44001)
+        with self.assertRaises(ValueError):
+            peering.PrefixPlan(["184.164.228.0/24", "138.185.228.0/24"])
+
+
+if __name__ == "__main__":
+    unittest.main()
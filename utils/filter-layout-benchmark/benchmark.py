@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import ipaddress
+import logging
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+from peering import (
+    Announcement,
+    AnnouncementController,
+    FilterLayout,
+    MuxName,
+    Update,
+    UpdateSet,
+)
+
+PEERING_DIR = pathlib.Path(__file__).absolute().parent / "../.."
+ANNOUNCEMENT_SCHEMA = PEERING_DIR / "configs/announcement_schema.json"
+BIRD4_SOCK_PATH = PEERING_DIR / "var/bird.ctl"
+MUX2TAP_FILE = PEERING_DIR / "var/mux2dev.txt"
+
+# Prefixes inside safe_announcement() in configs/bird/bird.conf
+PREFIX_POOL = list(ipaddress.ip_network("184.164.224.0/19").subnets(new_prefix=28))
+
+
+def measure_parse(bird_exec: str, bird_conf: pathlib.Path, repeat: int) -> float:
+    """Median time for `bird -p` to parse the configuration and exit"""
+    samples = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        subprocess.run(  # noqa: S603
+            [bird_exec, "-p", "-c", bird_conf.name],
+            cwd=bird_conf.parent,
+            check=True,
+            capture_output=True,
+        )
+        samples.append(time.monotonic() - start)
+    return statistics.median(samples)
+
+
+def measure_configure(controller: AnnouncementController, repeat: int) -> float:
+    """Median latency of `configure` over the BIRD control socket"""
+    samples = []
+    for _ in range(repeat):
+        replies = controller.reload_config((4,))
+        samples.append(replies[4].elapsed)
+    return statistics.median(samples)
+
+
+def withdraw_all(controller: AnnouncementController, count: int) -> None:
+    prefixes = [str(p) for p in PREFIX_POOL[:count]]
+    controller.deploy(UpdateSet({p: Update(["all"]) for p in prefixes}))
+
+
+def run(args: argparse.Namespace, writer) -> None:
+    bird_conf = args.bird_cfg_dir / "bird.conf"
+    for layout in FilterLayout:
+        controller = AnnouncementController(
+            [],
+            args.bird_cfg_dir,
+            args.bird_sock,
+            args.bird_sock,
+            schema_file=ANNOUNCEMENT_SCHEMA,
+            mux2tap_file=args.mux2tap_file,
+            filter_layout=layout,
+        )
+        for count in args.counts:
+            prefix2update = {}
+            for i, prefix in enumerate(PREFIX_POOL[:count]):
+                # Distinct communities so each prefix gets its own clause
+                ann = Announcement(list(MuxName), communities=[(47065, i + 1)])
+                prefix2update[str(prefix)] = Update([], [ann])
+            controller.deploy(UpdateSet(prefix2update))
+            nfiles = len(controller.deployed)
+            parse = measure_parse(args.bird_exec, bird_conf, args.repeat)
+            configure = measure_configure(controller, args.repeat)
+            logging.info(
+                "%s %d prefixes %d files: parse %.3fs configure %.3fs",
+                layout,
+                count,
+                nfiles,
+                parse,
+                configure,
+            )
+            writer.writerow([layout, count, nfiles, f"{parse:.6f}", f"{configure:.6f}"])
+        withdraw_all(controller, max(args.counts))
+        controller.close()
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Measure BIRD parse and configure time for each filter layout"
+    )
+    parser.add_argument(
+        "--bird-cfg-dir",
+        metavar="DIR",
+        type=pathlib.Path,
+        dest="bird_cfg_dir",
+        help="BIRD configuration directory of a scratch BIRD instance",
+        required=True,
+    )
+    parser.add_argument(
+        "--bird-sock",
+        metavar="SOCK",
+        type=pathlib.Path,
+        dest="bird_sock",
+        default=BIRD4_SOCK_PATH,
+        help="Control socket of the scratch BIRD instance [%(default)s]",
+    )
+    parser.add_argument(
+        "--bird-exec",
+        metavar="EXEC",
+        type=str,
+        dest="bird_exec",
+        default="bird",
+        help="BIRD executable used to measure parse time [%(default)s]",
+    )
+    parser.add_argument(
+        "--mux2tap",
+        metavar="FILE",
+        type=pathlib.Path,
+        dest="mux2tap_file",
+        default=MUX2TAP_FILE,
+        help="Mux to tap device mapping [%(default)s]",
+    )
+    parser.add_argument(
+        "--counts",
+        metavar="N,N,...",
+        type=lambda s: [int(n) for n in s.split(",")],
+        dest="counts",
+        default=[1, 2, 4, 8, 14, 28, 56, 112, 224],
+        help="Numbers of announced prefixes to measure",
+    )
+    parser.add_argument(
+        "--repeat",
+        metavar="N",
+        type=int,
+        dest="repeat",
+        default=5,
+        help="Measurements per data point, the median is reported [%(default)s]",
+    )
+    return parser
+
+
+def main() -> int:
+    parser = create_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    if max(args.counts) > len(PREFIX_POOL):
+        parser.error(f"at most {len(PREFIX_POOL)} prefixes are supported")
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["layout", "prefixes", "files", "parse_s", "configure_s"])
+    run(args, writer)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import dataclasses
+import datetime
+import hashlib
+import json
+import logging
+import pathlib
+import sqlite3
+import sys
+import time
+from collections.abc import Iterable
+from ipaddress import ip_network
+
+import peering
+from peering import MuxName, Update
+
+CATALOG_FN = "catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rounds (
+    id INTEGER PRIMARY KEY,
+    phase TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    prefix TEXT NOT NULL,
+    start REAL,
+    end REAL,
+    deployed REAL,
+    announcement TEXT NOT NULL REFERENCES announcements (key),
+    description TEXT,
+    egress TEXT,
+    UNIQUE (phase, round, prefix)
+);
+CREATE INDEX IF NOT EXISTS rounds_prefix_deployed ON rounds (prefix, deployed);
+CREATE INDEX IF NOT EXISTS rounds_start ON rounds (start);
+CREATE INDEX IF NOT EXISTS rounds_end ON rounds (end);
+CREATE INDEX IF NOT EXISTS rounds_announcement ON rounds (announcement);
+CREATE TABLE IF NOT EXISTS announcements (
+    key TEXT PRIMARY KEY,
+    update_json TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS withdrawn (
+    mux TEXT NOT NULL,
+    round_id INTEGER NOT NULL REFERENCES rounds (id) ON DELETE CASCADE,
+    PRIMARY KEY (mux, round_id)
+) WITHOUT ROWID;
+"""
+
+
+@dataclasses.dataclass
+class RoundEntry:
+    """One prefix's update in one round of a phase"""
+
+    phase: str
+    """Name of the phase's directory under the run directory"""
+    round: int
+    prefix: str
+    update: Update
+    egress: str | None
+    start: float | None
+    """Unix time the prefix was withdrawn for the round"""
+    end: float | None
+    """Unix time the round's hold ended, after which it is withdrawn again"""
+    deployed: float | None
+    """Unix time the update was deployed"""
+
+
+def announcement_key(update: Update) -> str:
+    """Digest of the update's per-mux export policy (see peering.update_key)
+
+    Updates exporting the same routes have the same key, whatever their
+    description or how their announcements are split.
+    """
+    policies = sorted(
+        (
+            mux,
+            list(policy.prepend),
+            sorted(policy.communities),
+            sorted(policy.large_communities),
+        )
+        for mux, policy in peering.update_key(update)
+    )
+    return hashlib.sha256(json.dumps(policies).encode("utf8")).hexdigest()[:24]
+
+
+def withdrawn_muxes(update: Update) -> list[str]:
+    """Muxes the update leaves the prefix withdrawn from"""
+    announced = {str(mux) for ann in update.announce for mux in ann.muxes}
+    return sorted(str(mux) for mux in MuxName if str(mux) not in announced)
+
+
+class RunCatalog:
+    """SQLite index of the rounds of a run's phases
+
+    A run directory holds one directory per phase (run_loop's basedir), each
+    with round directories.  The controller adds rounds as lanes finish them,
+    and build() indexes run directories written before the catalog existed.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self) -> "RunCatalog":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def add(self, entries: Iterable[RoundEntry]) -> int:
+        """Index entries, replacing earlier ones for the same round and prefix"""
+        count = 0
+        with self.db:
+            for entry in entries:
+                key = announcement_key(entry.update)
+                self.db.execute(
+                    "INSERT OR IGNORE INTO announcements VALUES (?, ?)",
+                    (key, entry.update.to_json()),
+                )
+                self.db.execute(
+                    "DELETE FROM rounds WHERE phase = ? AND round = ? AND prefix = ?",
+                    (entry.phase, entry.round, entry.prefix),
+                )
+                cursor = self.db.execute(
+                    "INSERT INTO rounds (phase, round, prefix, start, end, deployed, "
+                    "announcement, description, egress) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        entry.phase,
+                        entry.round,
+                        entry.prefix,
+                        entry.start,
+                        entry.end,
+                        entry.deployed,
+                        key,
+                        entry.update.description,
+                        entry.egress,
+                    ),
+                )
+                self.db.executemany(
+                    "INSERT INTO withdrawn VALUES (?, ?)",
+                    ((mux, cursor.lastrowid) for mux in withdrawn_muxes(entry.update)),
+                )
+                count += 1
+        return count
+
+    def build(self, rundir: pathlib.Path, workers: int | None = None) -> int:
+        """Index every round directory under rundir, reading them in parallel"""
+        jobs = [
+            (phasedir.name, rounddir)
+            for phasedir in sorted(rundir.iterdir())
+            if phasedir.is_dir()
+            for rounddir in sorted(phasedir.glob("round*"))
+            if rounddir.name[5:].isdigit()
+        ]
+        phases = [phase for phase, _rounddir in jobs]
+        rounddirs = [rounddir for _phase, rounddir in jobs]
+        count = 0
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for entries in executor.map(read_round, phases, rounddirs, chunksize=64):
+                count += self.add(entries)
+        return count
+
+    def duration(self, phase: str | None = None) -> tuple[float, float] | None:
+        """(start, end) Unix times of the run, or of one of its phases"""
+        where, params = ("WHERE phase = ?", (phase,)) if phase else ("", ())
+        start = self.db.execute(f"SELECT min(start) FROM rounds {where}", params)
+        end = self.db.execute(f"SELECT max(end) FROM rounds {where}", params)
+        row = (start.fetchone()[0], end.fetchone()[0])
+        return None if None in row else row
+
+    def live(self, prefix: str, when: float) -> tuple[RoundEntry, str] | None:
+        """Return the round whose update was live on prefix at when, with its key
+
+        An update is live from its deploy to the end of its round's hold.
+        """
+        row = self.db.execute(
+            "SELECT phase, round, prefix, update_json, egress, start, end, deployed, "
+            "announcement FROM rounds JOIN announcements ON announcement = key "
+            "WHERE prefix = ? AND deployed <= ? ORDER BY deployed DESC LIMIT 1",
+            (str(ip_network(prefix)), when),
+        ).fetchone()
+        if row is None or row[6] is None or row[6] < when:
+            return None
+        phase, rnd, pfx, update_json, egress, start, end, deployed, key = row
+        update = Update.from_json(update_json)
+        return RoundEntry(phase, rnd, pfx, update, egress, start, end, deployed), key
+
+    def withdrawn(self, mux: str) -> list[tuple[str, int, str]]:
+        """(phase, round, prefix) of the rounds where mux was withdrawn"""
+        return self.db.execute(
+            "SELECT phase, round, prefix FROM withdrawn JOIN rounds ON round_id = id "
+            "WHERE mux = ? ORDER BY phase, round, prefix",
+            (mux,),
+        ).fetchall()
+
+
+def read_round(phase: str, rounddir: pathlib.Path) -> list[RoundEntry]:
+    """Read the entries of a round directory written by run_loop
+
+    Lanes write per-prefix timestamps (suffixed with the prefix's key, see
+    peering.PrefixPlan); older runs only have round-wide ones, used as a
+    fallback.
+    """
+    try:
+        pfx2update = load_json(rounddir / "announcements.json")
+    except (OSError, json.JSONDecodeError) as e:
+        logging.warning("Skipping %s: %s", rounddir, e)
+        return []
+    src2mux = load_json(rounddir / "egresses.json", {})
+    tstamps = load_json(rounddir / "timestamps.json", {})
+    plan = peering.PrefixPlan(pfx2update)
+    entries = []
+    for i, (prefix, update) in enumerate(pfx2update.items()):
+        start, end, deployed = (
+            tstamps.get(f"{key}/{plan.keys[i]}", tstamps.get(key))
+            for key in ("round-start", "round-end", "deploy-pfx2ann")
+        )
+        entries.append(
+            RoundEntry(
+                phase,
+                int(rounddir.name[5:]),
+                plan.prefixes[i],
+                Update.from_dict(update),
+                src2mux.get(plan.srcips[i]),
+                start,
+                end,
+                deployed,
+            )
+        )
+    return entries
+
+
+def load_json(path: pathlib.Path, default: dict | None = None) -> dict:
+    try:
+        with open(path, encoding="utf8") as fd:
+            return json.load(fd)
+    except (OSError, json.JSONDecodeError):
+        if default is None:
+            raise
+        return default
+
+
+def parse_time(text: str) -> float:
+    """Parse Unix time or an ISO 8601 date and time (local if naive)"""
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Index and query measurement runs")
+    parser.add_argument(
+        "rundir", metavar="RUN", type=pathlib.Path, help="Run directory"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Index the run's existing rounds")
+    build.add_argument("--workers", type=int, help="Parallel readers [CPUs]")
+    duration = sub.add_parser("duration", help="Show when the run started and ended")
+    duration.add_argument("--phase", help="Only consider this phase")
+    live = sub.add_parser("live", help="Show the update live on a prefix at a time")
+    live.add_argument("prefix")
+    live.add_argument("time", type=parse_time, help="Unix or ISO 8601 time")
+    withdrawn = sub.add_parser("withdrawn", help="List rounds where a mux withdrew")
+    withdrawn.add_argument("mux")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    with RunCatalog(args.rundir / CATALOG_FN) as catalog:
+        start = time.perf_counter()
+        if args.command == "build":
+            count = catalog.build(args.rundir, args.workers)
+            logging.info("Indexed %d round entries", count)
+        elif args.command == "duration":
+            if (span := catalog.duration(args.phase)) is None:
+                logging.info("No rounds indexed")
+                return 1
+            t0, t1 = (datetime.datetime.fromtimestamp(t) for t in span)
+            logging.info("Start: %s (%s)", t0.isoformat(" ", "seconds"), span[0])
+            logging.info("End:   %s (%s)", t1.isoformat(" ", "seconds"), span[1])
+            logging.info("Total duration: %s", t1 - t0)
+        elif args.command == "live":
+            if (found := catalog.live(args.prefix, args.time)) is None:
+                logging.info("No update live on %s then", args.prefix)
+                return 1
+            entry, key = found
+            logging.info(
+                "%s round %d (%s, key %s, egress %s): %s",
+                entry.phase,
+                entry.round,
+                entry.update.description,
+                key,
+                entry.egress,
+                entry.update.to_json(),
+            )
+        elif args.command == "withdrawn":
+            for phase, rnd, prefix in catalog.withdrawn(args.mux):
+                print(f"{phase}/round{rnd} {prefix}")
+        logging.info("Query took %.1f ms", 1000 * (time.perf_counter() - start))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,155 +1,825 @@
 #!/usr/bin/env python3
 
-import itertools
+import concurrent.futures
+import dataclasses
+import enum
+import functools
+import hashlib
 import json
 import logging
+import os
 import pathlib
 import subprocess
+import threading
 import time
-from ipaddress import IPv4Network
+from collections.abc import Iterable, Iterator
+from ipaddress import ip_network
+from typing import Any
 
 import defs
+import tracing
+from catalog import CATALOG_FN, RoundEntry, RunCatalog
+from phases import Manifest, PhaseSequence
 
 import peering
 from peering import AnnouncementController, Update
 
 peering.AUTO_BASE_DIR = "/home/cunha/git/peering/client/"
 
+LANE_POLL_INTERVAL = 5.0
+JOURNAL_FN = "journal.jsonl"
+SPANS_FN = "spans.jsonl"
+METRICS_FN = "metrics.prom"
 
-def withdraw_round() -> None:
-    controller = AnnouncementController(
+
+def announcement_controller() -> AnnouncementController:
+    return AnnouncementController(
         defs.PREFIXES,
         defs.BIRD_CFG_DIR,
         defs.BIRD4_SOCK_PATH,
         schema_file=defs.ANNOUNCEMENT_SCHEMA,
         mux2tap_file=defs.MUX2TAP_FILE,
     )
+
+
+@functools.cache
+def _prefix_plan(prefixes: tuple[str, ...]) -> peering.PrefixPlan:
+    return peering.PrefixPlan(prefixes, defs.PREFIX_ID_BASE)
+
+
+def prefix_plan() -> peering.PrefixPlan:
+    """Source IPs, priorities, ICMP IDs and keys of defs.PREFIXES, built once"""
+    return _prefix_plan(tuple(defs.PREFIXES))
+
+
+def withdraw_round() -> None:
+    controller = announcement_controller()
     withdraw_prefixes(controller)
     time.sleep(defs.ANNOUNCEMENT_DURATION)
 
 
-def run_loop(updates: list[Update], first_round: int, basedir: pathlib.Path) -> None:
-    controller = AnnouncementController(
-        defs.PREFIXES,
-        defs.BIRD_CFG_DIR,
-        defs.BIRD4_SOCK_PATH,
-        schema_file=defs.ANNOUNCEMENT_SCHEMA,
-        mux2tap_file=defs.MUX2TAP_FILE,
+class LaneState(enum.Enum):
+    WITHDRAW = "withdraw"
+    ANNOUNCE = "announce"
+    MEASURE = "measure"
+    MEASURING = "measuring"
+    HOLD = "hold"
+    DONE = "done"
+
+
+@dataclasses.dataclass
+class Lane:
+    """One prefix stepping through its share of the updates independently
+
+    Each update goes through withdraw -> converge -> announce -> converge ->
+    measure -> hold.  Incremental lanes skip the withdrawal and its wait
+    when another update is deployed, and wait less after small transitions.
+    Deadlines are on the monotonic clock, so wall-clock adjustments do not
+    stretch or shrink the waits.
+    """
+
+    prefix: str
+    updates: Iterator[tuple[int, Update]]
+    """(index in the phase, update) pairs assigned to this lane, generated lazily"""
+    state: LaneState = LaneState.WITHDRAW
+    deadline: float = 0.0
+    current: tuple[int, Update] | None = None
+    """(index, update) being deployed, None once updates is exhausted"""
+    announced: float = 0.0
+    """Monotonic time the current update was deployed"""
+    measurement: concurrent.futures.Future | None = None
+    tstamps: dict[str, float] = dataclasses.field(default_factory=dict)
+    """Timestamps of the current update, derived from its spans"""
+    span: tracing.Span | None = None
+    """Span of the current update's round"""
+    step: tracing.Span | None = None
+    """Span of the measurement or hold in progress"""
+    incremental: bool = False
+    """Deploy each update over the previous one instead of withdrawing first"""
+    deployed: Update | None = None
+    """Update the prefix is announced with, None if withdrawn or unknown"""
+
+    @property
+    def key(self) -> str:
+        return prefix_plan().key(self.prefix)
+
+    @property
+    def srcip(self) -> str:
+        return prefix_plan().srcip(self.prefix)
+
+    @property
+    def prio(self) -> int:
+        return prefix_plan().prio(self.prefix)
+
+    def advance(self) -> None:
+        self.current = next(self.updates, None)
+
+    def seek(self, index: int) -> None:
+        """Advance to the update with the given phase index"""
+        while self.current is not None and self.current[0] < index:
+            self.advance()
+        if self.current is None or self.current[0] != index:
+            raise RuntimeError(f"Lane {self.prefix} has no update {index}")
+
+    @property
+    def round(self) -> int:
+        assert self.current is not None
+        return self.current[0] // len(defs.PREFIXES)
+
+    def round_outdir(self, basedir: pathlib.Path) -> pathlib.Path:
+        return basedir / f"round{self.round}"
+
+
+def run_loop(
+    updates: PhaseSequence | Manifest,
+    basedir: pathlib.Path,
+    controller: AnnouncementController | None = None,
+    measurer: "CatchmentExecutor | None" = None,
+) -> None:
+    """Deploy updates and measure catchments, with each prefix in its own lane
+
+    A PhaseSequence gives update i to prefix i % len(defs.PREFIXES), and a
+    Manifest (see plan_rounds) assigns updates to prefixes round by round;
+    either way update i's results go to round{i // len(defs.PREFIXES)}.
+    Lanes pull their updates as they go and move on as soon as their own
+    deadlines pass.  Lane starts are staggered by a fraction of the lane
+    cycle to spread measurement load; lanes measuring at the same time share
+    the pinger budget.
+
+    Lane transitions go to basedir's RunJournal; if one exists, lanes pick up
+    where it left off, keeping the deadlines they had.  Rounds and their steps
+    are traced to basedir/spans.jsonl, with metrics in METRICS_FN (or
+    defs.METRICS_TEXTFILE) for Prometheus' textfile collector.  Finished
+    rounds are indexed in the RunCatalog of basedir's parent directory.  controller and
+    measurer default to the ones in defs; simulate.py passes fake ones.
+    """
+    controller = controller or announcement_controller()
+    controller.validator.validate_updates(updates)
+
+    journal = RunJournal(basedir, updates_digest(updates))
+    metrics = tracing.Metrics(defs.METRICS_TEXTFILE or basedir / METRICS_FN)
+    tracer = tracing.Tracer(basedir / SPANS_FN, metrics)
+    catalog = RunCatalog(basedir.absolute().parent / CATALOG_FN)
+    lanes = make_lanes(updates)
+    resumed = journal.restore(lanes)
+    for lane in resumed:
+        resume_round(tracer, lane)
+    prio2egress = {
+        lane.prio: (lane.srcip, egress_mux(lane.current[1]), None)
+        for lane in lanes
+        if lane.current and lane.state in (LaneState.MEASURE, LaneState.HOLD)
+    }
+    controller.reconcile_egress(prio2egress, prefix_plan().prios())
+
+    stagger = lane_cycle() / len(lanes)
+    duration = campaign_duration(lanes, updates, stagger, controller.flap_ledger)
+    logging.info(
+        "%d lanes (%d resumed) will take about %.1f hours, finishing around %s",
+        len(lanes),
+        len(resumed),
+        duration / 3600,
+        time.strftime("%Y-%m-%d %H:%M", time.localtime(time.time() + duration)),
     )
-    unset_egresses(controller)
 
-    tstamps = {}
-    done = False
-    roundidx = first_round
-    updates_iter = itertools.islice(updates, first_round * len(defs.PREFIXES), None)
-    while not done:
-        logging.info("#####################################################")
-        logging.info("Starting round %d", roundidx)
-        tstamps["round-start"] = time.time()
-        withdraw_prefixes(controller)
-        unset_egresses(controller)
-
-        pfx2upd: dict[str, Update] = {}
-        for prefix in defs.PREFIXES:
-            try:
-                update = next(updates_iter)
-                pfx2upd[prefix] = update
-            except StopIteration:
-                done = True
-                break
+    start = time.monotonic()
+    for i, lane in enumerate(lanes):
+        if lane not in resumed:
+            lane.deadline = start + i * stagger
+    with journal, tracer, catalog, (measurer or CatchmentExecutor()) as measurer:
+        while active := [lane for lane in lanes if lane.state != LaneState.DONE]:
+            lane = min(active, key=lambda lane: lane.deadline)
+            delay = lane.deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            step_lane(controller, lane, measurer, journal, tracer, catalog, basedir)
+    logging.info("All lanes done after %.1f hours", (time.monotonic() - start) / 3600)
+
+
+def make_lanes(updates: PhaseSequence | Manifest) -> list[Lane]:
+    lanes = []
+    for prefix in defs.PREFIXES:
+        lane = Lane(prefix, updates.lane(prefix), incremental=updates.incremental)
+        lane.advance()
+        if lane.current is not None:
+            lanes.append(lane)
+    return lanes
 
-        if not pfx2upd:
+
+def updates_digest(updates: Iterable[Update]) -> str:
+    digest = hashlib.sha256()
+    for update in updates:
+        digest.update(json.dumps(update.to_dict(), sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def resuming(basedir: pathlib.Path) -> bool:
+    """Check whether basedir has a journal run_loop would resume from"""
+    return (basedir / JOURNAL_FN).exists()
+
+
+class RunJournal:
+    """Append-only record of lane transitions, used to resume interrupted runs
+
+    Each line is a JSON object with the wall-clock time, prefix, update
+    index, event, and the lane's timestamps.  Deadlines are stored as
+    wall-clock times, since the monotonic clock does not survive reboots.
+    Lines are fsynced before the lane acts on the transition.
+    """
+
+    def __init__(self, basedir: pathlib.Path, digest: str):
+        self.path = basedir / JOURNAL_FN
+        self.entries = self.read(self.path)
+        started = [e for e in self.entries if e["event"] == "start"]
+        if started and started[0]["digest"] != digest:
+            msg = f"{self.path} was written for a different list of updates"
+            raise RuntimeError(msg)
+        basedir.mkdir(parents=True, exist_ok=True)
+        self.fd = open(self.path, "a", encoding="utf8")  # noqa: SIM115
+        if not started:
+            self.append({"event": "start", "digest": digest})
+
+    def __enter__(self) -> "RunJournal":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.fd.close()
+
+    @staticmethod
+    def read(path: pathlib.Path) -> list[dict[str, Any]]:
+        """Load the journal, dropping a last line cut short by a crash"""
+        if not path.exists():
+            return []
+        with open(path, "r+", encoding="utf8") as fd:
+            data = fd.read()
+            complete = data[: data.rfind("\n") + 1]
+            if len(complete) != len(data):
+                logging.warning("Dropping truncated line at the end of %s", path)
+                fd.truncate(len(complete.encode()))
+        return [json.loads(line) for line in complete.splitlines()]
+
+    def append(self, entry: dict[str, Any]) -> None:
+        entry = {"time": time.time(), **entry}
+        self.fd.write(json.dumps(entry) + "\n")
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        self.entries.append(entry)
+
+    def record(self, lane: Lane, event: str, **fields: Any) -> None:
+        index = lane.current[0] if lane.current is not None else -1
+        deadline = time.time() + lane.deadline - time.monotonic()
+        entry = {"prefix": lane.prefix, "index": index, "event": event, **fields}
+        self.append({**entry, "deadline": deadline, "tstamps": lane.tstamps})
+
+    def restore(self, lanes: list[Lane]) -> list[Lane]:
+        """Put lanes back in the state of their last transition, returning them
+
+        Deadlines and the deploy time are converted back to the monotonic
+        clock.  Interrupted measurements are run again.
+        """
+        last: dict[str, dict[str, Any]] = {}
+        deployed: dict[str, float] = {}
+        for entry in self.entries:
+            if "prefix" in entry:
+                last[entry["prefix"]] = entry
+            if entry["event"] == "deployed":
+                deployed[entry["prefix"]] = entry["time"]
+        offset = time.monotonic() - time.time()
+        resumed = []
+        for lane in lanes:
+            if (entry := last.get(lane.prefix)) is None:
+                continue
+            resumed.append(lane)
+            event = entry["event"]
+            if event == "done":
+                lane.current = None
+                lane.state = LaneState.DONE
+                continue
+            lane.seek(entry["index"])
+            lane.tstamps = entry["tstamps"]
+            lane.deadline = entry["deadline"] + offset
+            lane.announced = deployed.get(lane.prefix, 0.0) + offset
+            if event in ("withdrawn", "transition"):
+                lane.state = LaneState.ANNOUNCE
+            elif event in ("deployed", "egress", "measure-start"):
+                lane.deployed = lane.current[1]
+                lane.state = LaneState.MEASURE
+            elif event == "measure-end":
+                lane.deployed = lane.current[1]
+                lane.state = LaneState.HOLD
+            elif event == "held":
+                lane.deployed = lane.current[1]
+                lane.advance()
+                lane.state = LaneState.WITHDRAW
+            logging.info(
+                "Lane %s resuming at update %d in state %s",
+                lane.prefix,
+                entry["index"],
+                lane.state.value,
+            )
+        return resumed
+
+
+def lane_cycle() -> float:
+    """Seconds between consecutive withdrawals in a lane, ignoring flap limits"""
+    hold = max(defs.LANE_HOLD_TIME, defs.PROPAGATION_TIME + measure_duration())
+    return defs.PROPAGATION_TIME + hold
+
+
+def measure_duration() -> float:
+    """Estimate the seconds measure_catchments() takes for one prefix"""
+    try:
+        with open(defs.TARGETS_FILE, "rb") as fd:
+            ntargets = sum(1 for _ in fd)
+    except OSError:
+        ntargets = 0
+    pps = max(1, defs.CATCHMENTS_PINGER_PPS // defs.CATCHMENTS_WORKERS)
+    per_round = ntargets / pps + defs.CATCHMENTS_OVERHEAD
+    return defs.MEASURE_CATCHMENTS_NUM_ROUNDS * per_round
+
+
+def campaign_duration(
+    lanes: list[Lane],
+    updates: PhaseSequence | Manifest,
+    stagger: float,
+    flap_ledger: peering.FlapLedger,
+) -> float:
+    """Simulate lane timelines under the flap budget and return their makespan"""
+    budget = peering.FlapLedger(
+        flap_ledger.path,
+        flap_ledger.max_events,
+        flap_ledger.window,
+        flap_ledger.max_penalty,
+    )
+    measure = measure_duration()
+    end = 0.0
+    for i, lane in enumerate(lanes):
+        now = i * stagger
+        if lane.current is None:
             continue
+        previous = lane.deployed if lane.incremental else None
+        for index, update in updates.lane(lane.prefix):
+            if index < lane.current[0]:
+                continue
+            waits = update_waits(previous, update, measure)
+            now = simulate_update(budget, lane.prefix, now, waits)
+            previous = update if lane.incremental else None
+        end = max(end, now)
+    return end
+
+
+def update_waits(
+    previous: Update | None, update: Update, measure: float
+) -> tuple[float, ...]:
+    """Waits after each route change a lane makes for update
+
+    Without a previous update, the lane withdraws and waits PROPAGATION_TIME
+    before announcing; the announcement is then held for lane_cycle() minus
+    that.  Incremental transitions announce right away and converge for
+    transition_wait().
+    """
+    if previous is None:
+        hold = max(defs.LANE_HOLD_TIME, defs.PROPAGATION_TIME + measure)
+        return (defs.PROPAGATION_TIME, hold)
+    return (max(defs.LANE_HOLD_TIME, transition_wait(previous, update) + measure),)
+
+
+def simulate_update(
+    budget: peering.FlapLedger, prefix: str, now: float, waits: Iterable[float]
+) -> float:
+    """Record simulated route changes in budget, returning when the update ends
+
+    Each wait follows one route change, which must fit in the flap budget.
+    """
+    for wait in waits:
+        now = budget.earliest(prefix, now)
+        budget.prefix2events.setdefault(prefix, []).append(now)
+        now += wait
+    return now
+
+
+def transition_size(previous: Update, update: Update) -> int:
+    """Count the muxes whose export policy differs between two updates"""
+    return _key_distance(peering.update_key(previous), peering.update_key(update))
+
+
+def _key_distance(key1: frozenset, key2: frozenset) -> int:
+    return len({mux for mux, _policy in key1 ^ key2})
+
+
+def transition_wait(previous: Update | None, update: Update) -> float:
+    """Convergence wait after deploying update over previous"""
+    if previous is None:
+        return defs.PROPAGATION_TIME
+    if transition_size(previous, update) <= defs.SMALL_TRANSITION_MUXES:
+        return defs.SMALL_TRANSITION_TIME
+    return defs.PROPAGATION_TIME
+
+
+def order_transitions(manifest: Manifest) -> Manifest:
+    """Reorder each prefix's updates so consecutive ones differ in few muxes
+
+    Starting from each prefix's first update, repeatedly take the remaining
+    update with the smallest transition_size() from the last one, the
+    earliest on ties (so phase1a's withdrawals still go in mux order).
+    Updates move between the prefix's rounds; no update changes prefix.
+    """
+    rounds: list[dict[str, tuple[str, Update]]] = [{} for _ in manifest.rounds]
+    for prefix in defs.PREFIXES:
+        slots = [r for r, entry in enumerate(manifest.rounds) if prefix in entry]
+        entries = [manifest.rounds[r][prefix] for r in slots]
+        keys = [peering.update_key(update) for _phase, update in entries]
+        order = [0] if entries else []
+        left = list(range(1, len(entries)))
+        while left:
+            last = keys[order[-1]]
+            best = min(left, key=lambda j: (_key_distance(last, keys[j]), j))
+            left.remove(best)
+            order.append(best)
+        for r, j in zip(slots, order, strict=True):
+            rounds[r][prefix] = entries[j]
+    return Manifest(rounds, manifest.duration, manifest.incremental)
+
+
+def transition_total(updates: PhaseSequence | Manifest) -> int:
+    """Sum transition_size() over consecutive updates of every lane"""
+    total = 0
+    for prefix in defs.PREFIXES:
+        previous = None
+        for _index, update in updates.lane(prefix):
+            if previous is not None:
+                total += transition_size(previous, update)
+            previous = update
+    return total
+
+
+def predicted_duration(updates: PhaseSequence | Manifest) -> float:
+    """Estimate how long run_loop takes to run updates from scratch"""
+    lanes = make_lanes(updates)
+    if not lanes:
+        return 0.0
+    ledger = peering.FlapLedger(defs.BIRD_CFG_DIR / peering.FLAP_LEDGER_FN)
+    return campaign_duration(lanes, updates, lane_cycle() / len(lanes), ledger)
+
+
+@dataclasses.dataclass
+class PrefixConstraint:
+    """Limits on the updates plan_rounds() may assign to a prefix"""
+
+    phases: set[str] | None = None
+    """Phases the prefix is reserved for, None for any"""
+    egress: set[str] | None = None
+    """Muxes the prefix can send egress traffic through, None for any"""
+    max_events: int = peering.FLAP_MAX_EVENTS
+    window: float = peering.FLAP_WINDOW
+    max_penalty: float = peering.FLAP_MAX_PENALTY
+    """Flap budget of the prefix, see peering.FlapLedger"""
+
+    def allows(self, phase: str, update: Update) -> bool:
+        if self.phases is not None and phase not in self.phases:
+            return False
+        return self.egress is None or egress_mux(update) in self.egress
 
-        tstamps["deploy-pfx2ann"] = time.time()
-        deploy_pfx2upd(controller, pfx2upd)
-        src2mux = set_egresses(controller, pfx2upd)
 
-        round_outdir = pathlib.Path(f"{basedir}/round{roundidx}")
-        round_outdir.mkdir(parents=True, exist_ok=True)
-        with open(round_outdir / "announcements.json", "w", encoding="utf8") as fd:
-            json.dump(pfx2upd, fd, indent=2, default=lambda x: x.to_dict())
-        with open(round_outdir / "egresses.json", "w", encoding="utf8") as fd:
-            json.dump(src2mux, fd, indent=2)
+def plan_rounds(
+    phases: dict[str, Iterable[Update]],
+    constraints: dict[str, PrefixConstraint] | None = None,
+    flap_ledger: peering.FlapLedger | None = None,
+) -> Manifest:
+    """Pack the updates of several phases into rounds across defs.PREFIXES
 
-        tstamps["measure-catchments-start"] = time.time()
-        measure_catchments(
-            round_outdir, tstamps, rounds=defs.MEASURE_CATCHMENTS_NUM_ROUNDS
+    Lanes are simulated as run_loop runs them: staggered starts, lane_cycle()
+    per update and each prefix's flap budget, seeded with the recent events
+    in flap_ledger.  Updates are taken in phase order, and each goes to the
+    allowed prefix that would finish it first.  A prefix's k-th update runs
+    in round k, so rounds stay full and small phases share rounds instead of
+    each leaving its last round partly empty.
+    """
+    constraints = constraints or {}
+    cycle = lane_cycle()
+    waits = (defs.PROPAGATION_TIME, cycle - defs.PROPAGATION_TIME)
+    stagger = cycle / len(defs.PREFIXES)
+    now = time.time()
+    prefix2budget = {}
+    prefix2end = {}
+    for i, prefix in enumerate(defs.PREFIXES):
+        constraint = constraints.setdefault(prefix, PrefixConstraint())
+        budget = peering.FlapLedger(
+            defs.BIRD_CFG_DIR / peering.FLAP_LEDGER_FN,
+            constraint.max_events,
+            constraint.window,
+            constraint.max_penalty,
         )
-        tstamps["measure-catchments-end"] = time.time()
-        logging.info(
-            "Took %f seconds to measure catchments",
-            tstamps["measure-catchments-end"] - tstamps["measure-catchments-start"],
+        if flap_ledger is not None:
+            events = flap_ledger.events(prefix, now)
+            budget.prefix2events[prefix] = [t - now for t in events]
+        prefix2budget[prefix] = budget
+        prefix2end[prefix] = i * stagger
+
+    def finish(prefix: str) -> float:
+        budget = prefix2budget[prefix]
+        trial = peering.FlapLedger(
+            budget.path, budget.max_events, budget.window, budget.max_penalty
         )
+        trial.prefix2events[prefix] = budget.events(prefix, prefix2end[prefix])
+        return simulate_update(trial, prefix, prefix2end[prefix], waits)
+
+    rounds: list[dict[str, tuple[str, Update]]] = []
+    prefix2count = dict.fromkeys(defs.PREFIXES, 0)
+    for phase, updates in phases.items():
+        for update in updates:
+            allowed = [p for p in defs.PREFIXES if constraints[p].allows(phase, update)]
+            if not allowed:
+                msg = f"no prefix may run {phase} update {update.description}"
+                raise ValueError(msg)
+            prefix = min(allowed, key=finish)
+            prefix2end[prefix] = simulate_update(
+                prefix2budget[prefix], prefix, prefix2end[prefix], waits
+            )
+            if prefix2count[prefix] == len(rounds):
+                rounds.append({})
+            rounds[prefix2count[prefix]][prefix] = (phase, update)
+            prefix2count[prefix] += 1
+    used = [end for p, end in prefix2end.items() if prefix2count[p]]
+    return Manifest(rounds, max(used, default=0.0))
 
-        spare_time = defs.ANNOUNCEMENT_DURATION - (
-            time.time() - tstamps["deploy-pfx2ann"]
+
+def step_lane(
+    controller: AnnouncementController,
+    lane: Lane,
+    measurer: "CatchmentExecutor",
+    journal: RunJournal,
+    tracer: tracing.Tracer,
+    catalog: RunCatalog,
+    basedir: pathlib.Path,
+) -> None:
+    now = time.monotonic()
+    if lane.state == LaneState.WITHDRAW and lane.incremental:
+        if lane.deployed is not None and lane.current is not None:
+            start_round(tracer, lane)
+            lane.state = LaneState.ANNOUNCE
+            lane.deadline = now
+            journal.record(lane, "transition")
+            return
+    if lane.state == LaneState.WITHDRAW:
+        withdraw = peering.UpdateSet({lane.prefix: Update(["all"])})
+        if not flap_ready(controller, lane, withdraw):
+            return
+        if lane.current is not None:
+            start_round(tracer, lane)
+        changed = bool(controller.diff(withdraw))
+        unconfirmed: dict[str, list[str]] = {}
+        if changed:
+            unconfirmed = traced_deploy(
+                controller, tracer, "withdraw", lane.span, withdraw
+            )
+        with tracer.span("egress", lane.span):
+            controller.reconcile_egress({}, [lane.prio])
+        lane.deployed = None
+        if lane.current is None:
+            logging.info("Lane %s done", lane.prefix)
+            lane.state = LaneState.DONE
+            journal.record(lane, "done")
+            return
+        lane.state = LaneState.ANNOUNCE
+        lane.deadline = now + (defs.PROPAGATION_TIME if changed else 0)
+        journal.record(lane, "withdrawn", **unconfirmed_fields(unconfirmed))
+    elif lane.state == LaneState.ANNOUNCE:
+        assert lane.current is not None
+        index, update = lane.current
+        wait = defs.PROPAGATION_TIME
+        updset = peering.UpdateSet({lane.prefix: update})
+        if lane.incremental:
+            # "all" withdraws muxes the previous update announced from, and
+            # diff() leaves out filters that stay the same
+            wait = transition_wait(lane.deployed, update)
+            delta = Update(["all"], update.announce, update.description)
+            updset = peering.UpdateSet({lane.prefix: delta})
+        if not flap_ready(controller, lane, updset):
+            return
+        logging.info("Lane %s deploying update %d", lane.prefix, index)
+        unconfirmed = traced_deploy(controller, tracer, "deploy", lane.span, updset)
+        logging.info("PEERING deploy %s %s", time.time(), updset.to_json())
+        lane.announced = now
+        lane.deployed = update
+        lane.deadline = now + wait
+        # Written before the journal moves on, since resuming skips this state
+        mux = egress_mux(update)
+        outdir = lane.round_outdir(basedir)
+        outdir.mkdir(parents=True, exist_ok=True)
+        update_json(outdir / "announcements.json", {lane.prefix: update.to_dict()})
+        update_json(outdir / "egresses.json", {lane.srcip: mux})
+        journal.record(lane, "deployed", **unconfirmed_fields(unconfirmed))
+        with tracer.span("egress", lane.span, mux=mux):
+            controller.reconcile_egress(
+                {lane.prio: (lane.srcip, mux, None)}, [lane.prio]
+            )
+        lane.state = LaneState.MEASURE
+        journal.record(lane, "egress", mux=mux)
+    elif lane.state == LaneState.MEASURE:
+        lane.step = tracer.start("measure", lane.span)
+        journal.record(lane, "measure-start")
+        lane.measurement = measurer.submit(
+            lane.round_outdir(basedir),
+            lane.tstamps,
+            defs.MEASURE_CATCHMENTS_NUM_ROUNDS,
+            lane.prefix,
+            tracer,
+            lane.step,
         )
-        logging.info("Catchment measurement finished with %d spare seconds", spare_time)
-        round_wait = max(300, spare_time)
-        logging.info("Sleeping %f seconds to complete round duration", round_wait)
-        time.sleep(round_wait)
-        tstamps["round-end"] = time.time()
+        lane.state = LaneState.MEASURING
+        lane.deadline = now + LANE_POLL_INTERVAL
+    elif lane.state == LaneState.MEASURING:
+        assert lane.measurement is not None and lane.step is not None
+        if not lane.measurement.done():
+            lane.deadline = now + LANE_POLL_INTERVAL
+            return
+        succeeded = lane.measurement.result()
+        if not succeeded:
+            logging.warning("Lane %s catchment measurement failed", lane.prefix)
+        tracer.end(lane.step, succeeded=succeeded)
+        logging.info(
+            "Lane %s took %f seconds to measure catchments",
+            lane.prefix,
+            lane.step.duration,
+        )
+        lane.state = LaneState.HOLD
+        lane.deadline = max(now, lane.announced + defs.LANE_HOLD_TIME)
+        lane.step = tracer.start("hold", lane.span)
+        journal.record(lane, "measure-end")
+    elif lane.state == LaneState.HOLD:
+        if lane.step is not None:
+            tracer.end(lane.step)
+        if lane.span is not None:
+            tracer.end(lane.span)
+        record_tstamps(lane.round_outdir(basedir), lane)
+        catalog.add([round_entry(lane, basedir)])
+        journal.record(lane, "held")
+        lane.span = lane.step = None
+        lane.advance()
+        lane.state = LaneState.WITHDRAW
+        lane.deadline = now
+
+
+def round_entry(lane: Lane, basedir: pathlib.Path) -> RoundEntry:
+    """Catalog entry of the lane's current update, once its round is done"""
+    assert lane.current is not None
+    _index, update = lane.current
+    return RoundEntry(
+        basedir.name,
+        lane.round,
+        lane.prefix,
+        update,
+        egress_mux(update),
+        lane.tstamps.get("round-start"),
+        lane.tstamps.get("round-end"),
+        lane.tstamps.get("deploy-pfx2ann"),
+    )
+
+
+def start_round(tracer: tracing.Tracer, lane: Lane) -> None:
+    """Start the round span of the lane's current update, resetting tstamps"""
+    assert lane.current is not None
+    lane.tstamps = {}
+    lane.step = None
+    lane.span = tracer.start(
+        "round", None, lane.tstamps, prefix=lane.prefix, index=lane.current[0]
+    )
+
+
+def resume_round(tracer: tracing.Tracer, lane: Lane) -> None:
+    """Reopen the round (and hold) span of a lane restored mid-round
+
+    The new spans keep filling the restored tstamps, but their start times
+    do not overwrite the ones recorded before the interruption.
+    """
+    if lane.current is None or lane.state in (LaneState.WITHDRAW, LaneState.DONE):
+        return
+    attrs = {"prefix": lane.prefix, "index": lane.current[0], "resumed": True}
+    lane.span = tracer.start("round", None, None, **attrs)
+    lane.span.tstamps = lane.tstamps
+    if lane.state == LaneState.HOLD:
+        lane.step = tracer.start("hold", lane.span, resumed=True)
+
+
+def traced_deploy(
+    controller: AnnouncementController,
+    tracer: tracing.Tracer,
+    name: str,
+    parent: tracing.Span | None,
+    updset: peering.UpdateSet,
+) -> dict[str, list[str]]:
+    """Deploy updset with confirmation in a span, returning unconfirmed muxes
+
+    BIRD reconfigures get child spans, placed right before the confirmation
+    (which starts as soon as they are done).  If BIRD's exports do not match
+    in time, the updates stay deployed and the differences per mux go to the
+    span's timestamps as <name>-unconfirmed and are returned, so one mux
+    does not stop the run.
+    """
+    configures = controller.reload_stats["configures"]
+    span = tracer.start(name, parent)
+    try:
+        latency = controller.deploy(updset, confirm=True)
+    except peering.ExportConfirmationError as e:
+        logging.warning("%s of %s not confirmed: %s", name, updset.to_json(), e)
+        span.derive(f"{name}-unconfirmed", e.mux2diff)
+        tracer.end(span, ok=False, unconfirmed=e.mux2diff)
+        return e.mux2diff
+    except BaseException:
+        tracer.end(span, ok=False)
+        raise
+    if controller.reload_stats["configures"] > configures:
+        end = time.monotonic() - (latency or 0.0)
+        versions = {ip_network(p).version for p in updset.prefix2update}
+        for version in sorted(versions & set(controller.reload_latency)):
+            elapsed = controller.reload_latency[version]
+            tracer.record("reconfigure", span, end - elapsed, end, version=version)
+    tracer.end(span, confirm_latency=latency or 0.0)
+    return {}
+
+
+def unconfirmed_fields(mux2diff: dict[str, list[str]]) -> dict[str, Any]:
+    """Journal fields marking a round whose deploy was not confirmed"""
+    return {"unconfirmed": mux2diff} if mux2diff else {}
+
+
+def flap_ready(
+    controller: AnnouncementController, lane: Lane, updset: peering.UpdateSet
+) -> bool:
+    """Check the flap budget allows updset now, else push the lane's deadline"""
+    wait = controller.earliest_safe_time(updset) - time.time()
+    if wait <= 0:
+        return True
+    logging.info("Lane %s waiting %.0fs for its flap budget", lane.prefix, wait)
+    lane.deadline = time.monotonic() + wait
+    return False
+
+
+def egress_mux(update: Update) -> peering.MuxName:
+    """Pick the mux for egress traffic, preferring undecorated announcements"""
+    announcing: list[peering.MuxName] = []
+    announcing_undecorated: list[peering.MuxName] = []
+    for ann in update.announce:
+        announcing.extend(ann.muxes)
+        if not ann.peer_ids and not ann.communities:
+            announcing_undecorated.extend(ann.muxes)
+    muxes = [
+        mux
+        for mux in defs.EGRESS_PREFS
+        if mux in announcing_undecorated and mux not in update.withdraw
+    ]
+    if not muxes:
+        muxes = announcing
+    assert muxes
+    return muxes[0]
+
 
-        with open(round_outdir / "timestamps.json", "w", encoding="utf8") as fd:
-            json.dump(tstamps, fd, indent=2)
+def update_json(path: pathlib.Path, entries: dict) -> None:
+    """Merge entries into the JSON object in path, shared by all lanes"""
+    data = {}
+    if path.exists():
+        with open(path, encoding="utf8") as fd:
+            data = json.load(fd)
+    data.update(entries)
+    with open(path, "w", encoding="utf8") as fd:
+        json.dump(data, fd, indent=2)
 
-        roundidx += 1
+
+def record_tstamps(outdir: pathlib.Path, lane: Lane) -> None:
+    """Add a lane's timestamps to its round's timestamps.json
+
+    Keys get the prefix's key (see peering.PrefixPlan) appended, and
+    round-start and round-end span all lanes in the round.
+    """
+    path = outdir / "timestamps.json"
+    tstamps = {}
+    if path.exists():
+        with open(path, encoding="utf8") as fd:
+            tstamps = json.load(fd)
+    for key, value in lane.tstamps.items():
+        if "/" in key:
+            tstamps[key] = value  # already per prefix (from measure_catchments)
+        else:
+            tstamps[f"{key}/{lane.key}"] = value
+    start, end = lane.tstamps["round-start"], lane.tstamps["round-end"]
+    tstamps["round-start"] = min(tstamps.get("round-start", start), start)
+    tstamps["round-end"] = max(tstamps.get("round-end", end), end)
+    with open(path, "w", encoding="utf8") as fd:
+        json.dump(tstamps, fd, indent=2)
 
 
 def withdraw_prefixes(controller: AnnouncementController) -> None:
     for prefix in defs.PREFIXES:
         controller.withdraw(prefix)
-    controller.reload_config()
+    controller.reload_pending()
     logging.info(
         "Waiting %d seconds for withdrawals to converge", defs.PROPAGATION_TIME
     )
     time.sleep(defs.PROPAGATION_TIME)
 
 
-def deploy_pfx2upd(
-    controller: AnnouncementController, pfx2upd: dict[str, Update]
-) -> None:
-    updset = peering.UpdateSet(pfx2upd)
-    controller.deploy(updset)
-    logging.info("PEERING deploy %s %s", time.time(), updset.to_json())
-    logging.info(
-        "Waiting %d seconds for announcements to propagate", defs.PROPAGATION_TIME
-    )
-    time.sleep(defs.PROPAGATION_TIME)
-
-
-def set_egresses(
-    controller: AnnouncementController, pfx2upd: dict[str, Update]
-) -> dict[str, peering.MuxName]:
-    src2mux = {}
-    for prefix, upd in pfx2upd.items():
-        octet = int(IPv4Network(prefix).network_address.packed[2])
-        srcip = str(list(IPv4Network(prefix).hosts())[-1])
-        announcing: list[peering.MuxName] = []
-        announcing_undecorated: list[peering.MuxName] = []
-        for ann in upd.announce:
-            announcing.extend(ann.muxes)
-            if not ann.peer_ids and not ann.communities:
-                announcing_undecorated.extend(ann.muxes)
-        muxes = [
-            mux
-            for mux in defs.EGRESS_PREFS
-            if mux in announcing_undecorated and mux not in upd.withdraw
-        ]
-        if not muxes:
-            muxes = announcing
-        assert muxes
-        logging.info("Setting egress for %s through %s", prefix, muxes[0])
-        src2mux[srcip] = muxes[0]
-        controller.set_egress(defs.PREFIX_ID_BASE + octet, srcip, muxes[0], None)
-    return src2mux
-
-
 def unset_egresses(controller: AnnouncementController) -> None:
-    for prefix in defs.PREFIXES:
-        octet = int(IPv4Network(prefix).network_address.packed[2])
-        controller.unset_egress(defs.PREFIX_ID_BASE + octet)
+    controller.reconcile_egress({}, prefix_plan().prios())
 
 
 def _run_check_log(params: list[str], check: bool, log_errors: bool = True) -> None:
@@ -163,55 +833,170 @@ def _run_check_log(params: list[str], check: bool, log_errors: bool = True) -> N
         raise
 
 
+class PingerBudget:
+    """Packets-per-second budget shared by the pingers running at one time
+
+    Each pinger gets pps // workers, so the total stays within pps and a
+    pinger starting while others run never waits for an earlier one to
+    finish.  A running pinger's rate cannot change, so shares are not
+    rebalanced when pingers start or finish.
+    """
+
+    def __init__(self, pps: int, workers: int):
+        self.pps = pps
+        self.share = max(1, pps // workers)
+        self.available = pps
+        self.cond = threading.Condition()
+
+    def acquire(self) -> int:
+        """Wait for and take a share of the budget"""
+        with self.cond:
+            while self.available < self.share:
+                self.cond.wait()
+            self.available -= self.share
+            return self.share
+
+    def release(self, share: int | None) -> None:
+        """Return a share taken by acquire(), if any"""
+        if share is None:
+            return
+        with self.cond:
+            self.available += share
+            self.cond.notify()
+
+
+class CatchmentExecutor:
+    """Worker pool measuring the catchments of several prefixes concurrently
+
+    Each prefix runs its own tcpdump -> pinger -> kill pipeline; pingers
+    draw their rate from one PingerBudget, and a failing prefix does not
+    stop the others.
+    """
+
+    def __init__(
+        self,
+        workers: int = defs.CATCHMENTS_WORKERS,
+        pps: int = defs.CATCHMENTS_PINGER_PPS,
+    ):
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="catchments"
+        )
+        self.budget = PingerBudget(pps, workers)
+
+    def __enter__(self) -> "CatchmentExecutor":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.pool.shutdown()
+
+    def submit(
+        self,
+        outdir: pathlib.Path,
+        tstamps: dict[str, float],
+        rounds: int,
+        prefix: str,
+        tracer: tracing.Tracer | None = None,
+        parent: tracing.Span | None = None,
+    ) -> concurrent.futures.Future[bool]:
+        return self.pool.submit(
+            measure_prefix,
+            outdir,
+            tstamps,
+            rounds,
+            prefix,
+            self.budget,
+            tracer or tracing.Tracer(None),
+            parent,
+        )
+
+
 def measure_catchments(
-    outdir: pathlib.Path, tstamps: dict[str, float], rounds: int = 1
-) -> None:
+    outdir: pathlib.Path,
+    tstamps: dict[str, float],
+    rounds: int = 1,
+    prefixes: list[str] = defs.PREFIXES,
+) -> list[str]:
+    """Measure the catchments of prefixes concurrently, returning failed ones"""
+    with CatchmentExecutor() as executor:
+        pfx2future = {
+            prefix: executor.submit(outdir, tstamps, rounds, prefix)
+            for prefix in prefixes
+        }
+        return [prefix for prefix, f in pfx2future.items() if not f.result()]
+
+
+def measure_prefix(
+    outdir: pathlib.Path,
+    tstamps: dict[str, float],
+    rounds: int,
+    prefix: str,
+    budget: PingerBudget,
+    tracer: tracing.Tracer,
+    parent: tracing.Span | None = None,
+) -> bool:
+    """Measure one prefix's catchment, returning whether every round succeeded
+
+    Each round's tcpdump, pinger and kill steps get spans under a catchment
+    span.  Timestamp keys derived from them carry the prefix's key (its
+    third octet for IPv4), so concurrent prefixes can share tstamps.
+    """
     muxes = [str(m) for m in peering.MuxName]
     tcpdumpcmd = defs.CATCHMENTS_DIR / "launch-tcpdump.sh"
     pingercmd = defs.CATCHMENTS_DIR / "launch-pinger.sh"
     killcmd = defs.CATCHMENTS_DIR / "kill-tcpdump.sh"
+    plan = prefix_plan()
+    key = plan.key(prefix)
+    pfxoutdir = outdir / f"catchment_{key}"
+    pfxoutdir.mkdir(parents=True, exist_ok=True)
+    srcip = plan.srcip(prefix)
+    succeeded = True
+    span = tracer.start("catchment", parent, tstamps, prefix=prefix, key=key)
     for i in range(rounds):
-        for prefix in defs.PREFIXES:
-            octet = int(IPv4Network(prefix).network_address.packed[2])
-            pfxoutdir = outdir / f"catchment_{octet}"
-            pfxoutdir.mkdir(parents=True, exist_ok=True)
-            srcip = str(list(IPv4Network(prefix).hosts())[-1])
-
-            try:
+        pps = None
+        attrs = {"key": key, "measure_round": i}
+        try:
+            with tracer.span("tcpdump", span, **attrs) as tcpdump:
                 params = [
                     str(tcpdumpcmd),
                     "-i",
-                    str(srcip),
+                    srcip,
                     "-o",
                     str(pfxoutdir),
                     *muxes,
                 ]
                 logging.debug(str(params))
-                tstamps[f"round-{i}/launch-tcpdump/{octet}"] = time.time()
                 _run_check_log(params, True)
                 logging.info("launch-tcpdump.sh succeeded for %s", srcip)
 
-                icmpid = defs.PREFIX_ID_BASE + octet
+                pps = budget.acquire()
                 params = [
                     str(pingercmd),
                     "-i",
-                    str(srcip),
+                    srcip,
                     "-t",
                     str(defs.TARGETS_FILE),
                     "-I",
-                    str(icmpid),
+                    str(plan.icmpid(prefix)),
                     "-r",
-                    str(defs.CATCHMENTS_PINGER_PPS),
+                    str(pps),
                 ]
                 logging.debug(str(params))
-                tstamps[f"round-{i}/launch-pinger/{octet}"] = time.time()
-                _run_check_log(params, True)
-                logging.info("launch-pinger.sh succeeded for %s", srcip)
-            except subprocess.CalledProcessError:
-                logging.exception("Error measuring catchments")
-            finally:
-                params = [str(killcmd), "-f", f"{pfxoutdir}/pids.txt"]
-                logging.debug(str(params))
-                tstamps[f"round-{i}/kill-tcpdump/{octet}"] = time.time()
-                _run_check_log(params, True)
+                with tracer.span("pinger", tcpdump, pps=pps, **attrs):
+                    _run_check_log(params, True)
+                logging.info("launch-pinger.sh succeeded for %s at %d pps", srcip, pps)
+        except (OSError, subprocess.CalledProcessError):
+            logging.exception("Error measuring catchments for %s", prefix)
+            succeeded = False
+        finally:
+            budget.release(pps)
+            params = [str(killcmd), "-f", f"{pfxoutdir}/pids.txt"]
+            logging.debug(str(params))
+            try:
+                with tracer.span("kill", span, **attrs):
+                    _run_check_log(params, True)
                 logging.info("kill-tcpdump.sh succeeded for %s", srcip)
+            except (OSError, subprocess.CalledProcessError):
+                logging.exception("Error killing tcpdump for %s", prefix)
+                succeeded = False
+    tracer.end(span, succeeded=succeeded)
+    return succeeded
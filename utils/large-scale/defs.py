@@ -4,6 +4,15 @@ import peering
 
 PROPAGATION_TIME = 600
 ANNOUNCEMENT_DURATION = 5400
+# Minimum time an announcement stays up in a lane, counted from its deploy:
+# convergence, catchment measurements and two 20-minute RIPE Atlas
+# traceroute rounds.  Lanes also wait for each prefix's flap budget.
+LANE_HOLD_TIME = 2400
+# Convergence wait after an incremental transition (deploying an update
+# over the previous one) that changes at most SMALL_TRANSITION_MUXES muxes;
+# larger transitions wait PROPAGATION_TIME.
+SMALL_TRANSITION_MUXES = 2
+SMALL_TRANSITION_TIME = 300
 
 BIRD_CFG_DIR = pathlib.Path("../../", "configs/bird")
 BIRD4_SOCK_PATH = pathlib.Path("../../", "var/bird.ctl")
@@ -13,7 +22,15 @@ MUX2TAP_FILE = pathlib.Path("../../", "var/mux2dev.txt")
 TARGETS_FILE = pathlib.Path("data/targets.txt")
 CATCHMENTS_DIR = pathlib.Path("../measure-catchments")
 MEASURE_CATCHMENTS_NUM_ROUNDS = 2
+# Packets per second shared by all pingers running concurrently; each of the
+# CATCHMENTS_WORKERS pipelines probes at CATCHMENTS_PINGER_PPS // CATCHMENTS_WORKERS
 CATCHMENTS_PINGER_PPS = 5000
+CATCHMENTS_WORKERS = 4
+# Seconds added to each catchment measurement round (tcpdump setup, pinger drain)
+CATCHMENTS_OVERHEAD = 15
+# Prometheus textfile-collector file for run metrics (e.g., in node_exporter's
+# --collector.textfile.directory); None writes metrics.prom in the run's basedir
+METRICS_TEXTFILE: pathlib.Path | None = None
 
 # used for iproute2 rule prio and verfploeter ICMP IDs
 # must be less than 30000 to come BEFORE the default rules
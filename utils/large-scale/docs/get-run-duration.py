@@ -1,21 +1,36 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
 import datetime
 import json
 import logging
 import pathlib
+import sqlite3
 
 
 def get_run_duration(run_path: pathlib.Path) -> None:
     """
     Calculates the start and end times of a PEERING large-scale measurement run
-    by scanning all phase and round directories for timestamps.json files.
+    from its catalog.sqlite (see catalog.py) or, for runs without one, by
+    scanning all phase and round directories for timestamps.json files.
     """
     if not run_path.is_dir():
         logging.error("%s is not a directory.", run_path)
         return
 
+    catalog = run_path / "catalog.sqlite"
+    if catalog.exists():
+        logging.debug("Querying %s", catalog)
+        with contextlib.closing(sqlite3.connect(catalog)) as db:
+            earliest_start = db.execute("SELECT min(start) FROM rounds").fetchone()[0]
+            latest_end = db.execute("SELECT max(end) FROM rounds").fetchone()[0]
+        if earliest_start is None or latest_end is None:
+            logging.info("No rounds in %s", catalog)
+            return
+        report(run_path, earliest_start, latest_end)
+        return
+
     earliest_start = float("inf")
     latest_end = float("-inf")
     found_data = False
@@ -52,7 +67,10 @@ def get_run_duration(run_path: pathlib.Path) -> None:
     if not found_data:
         logging.info("No timing information found in %s", run_path.absolute())
         return
+    report(run_path, earliest_start, latest_end)
+
 
+def report(run_path: pathlib.Path, earliest_start: float, latest_end: float) -> None:
     # Convert Unix timestamps to datetime objects
     start_dt = datetime.datetime.fromtimestamp(earliest_start)
     end_dt = datetime.datetime.fromtimestamp(latest_end)
@@ -6,10 +6,9 @@ import pathlib
 
 import controller
 import defs
-from phases import phase1_muxsets, phase1a, phase1b
-
-FIRST_ROUND = 0
+from phases import PhaseSequence, phase1_muxsets, phase1a, phase1b
 
+PHASES = (phase1a, phase1b, phase1_muxsets)
 BASEDIR = pathlib.Path("phase1_anycast_withdraw1")
 DESCRIPTION = "Anycast and Withdraw 1"
 
@@ -22,14 +21,17 @@ def main() -> None:
     handler = logging.getLogger()
     handler.addHandler(logging.FileHandler(BASEDIR / "log.txt"))
 
-    updates = phase1a() + phase1b() + phase1_muxsets()
+    updates = PhaseSequence(*PHASES)
     logging.info("Starting experiment %s", BASEDIR)
     nrounds = math.ceil(len(updates) / len(defs.PREFIXES))
     logging.info("Will deploy %d announcements in %d rounds", len(updates), nrounds)
-    logging.info("Starting at %d", FIRST_ROUND)
+    updates.report()
 
-    controller.withdraw_round()
-    controller.run_loop(updates, FIRST_ROUND, BASEDIR)
+    if controller.resuming(BASEDIR):
+        logging.info("Resuming from %s", BASEDIR / controller.JOURNAL_FN)
+    else:
+        controller.withdraw_round()
+    controller.run_loop(updates, BASEDIR)
 
 
 if __name__ == "__main__":
@@ -6,10 +6,9 @@ import pathlib
 
 import controller
 import defs
-from phases import phase10
-
-FIRST_ROUND = 0
+from phases import PhaseSequence, phase10
 
+PHASES = (phase10,)
 BASEDIR = pathlib.Path("phase10_vtr1")
 DESCRIPTION = "Unicast 1 Vultr Provider"
 
@@ -22,14 +21,17 @@ def main() -> None:
     handler = logging.getLogger()
     handler.addHandler(logging.FileHandler(BASEDIR / "log.txt"))
 
-    updates = phase10()
+    updates = PhaseSequence(*PHASES)
     logging.info("Starting experiment %s", BASEDIR)
     nrounds = math.ceil(len(updates) / len(defs.PREFIXES))
     logging.info("Will deploy %d announcements in %d rounds", len(updates), nrounds)
-    logging.info("Starting at %d", FIRST_ROUND)
+    updates.report()
 
-    controller.withdraw_round()
-    controller.run_loop(updates, FIRST_ROUND, BASEDIR)
+    if controller.resuming(BASEDIR):
+        logging.info("Resuming from %s", BASEDIR / controller.JOURNAL_FN)
+    else:
+        controller.withdraw_round()
+    controller.run_loop(updates, BASEDIR)
 
 
 if __name__ == "__main__":
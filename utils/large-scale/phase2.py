@@ -6,10 +6,9 @@ import pathlib
 
 import controller
 import defs
-from phases import phase2_muxsets, phase2a, phase2b
-
-FIRST_ROUND = 0
+from phases import PhaseSequence, phase2_muxsets, phase2a, phase2b
 
+PHASES = (phase2a, phase2b, phase2_muxsets)
 BASEDIR = pathlib.Path("phase2_anycast_prepend1")
 DESCRIPTION = "Anycast and Prepend 1"
 
@@ -22,14 +21,17 @@ def main() -> None:
     handler = logging.getLogger()
     handler.addHandler(logging.FileHandler(BASEDIR / "log.txt"))
 
-    updates = phase2a() + phase2b() + phase2_muxsets()
+    updates = PhaseSequence(*PHASES)
     logging.info("Starting experiment %s", BASEDIR)
     nrounds = math.ceil(len(updates) / len(defs.PREFIXES))
     logging.info("Will deploy %d announcements in %d rounds", len(updates), nrounds)
-    logging.info("Starting at %d", FIRST_ROUND)
+    updates.report()
 
-    controller.withdraw_round()
-    controller.run_loop(updates, FIRST_ROUND, BASEDIR)
+    if controller.resuming(BASEDIR):
+        logging.info("Resuming from %s", BASEDIR / controller.JOURNAL_FN)
+    else:
+        controller.withdraw_round()
+    controller.run_loop(updates, BASEDIR)
 
 if __name__ == "__main__":
     main()
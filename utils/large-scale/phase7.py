@@ -6,10 +6,15 @@ import pathlib
 
 import controller
 import defs
-from phases import phase7_muxsets, phase7_muxsets_unicast, phase7a, phase7b
-
-FIRST_ROUND = 0
-
+from phases import (
+    PhaseSequence,
+    phase7_muxsets,
+    phase7_muxsets_unicast,
+    phase7a,
+    phase7b,
+)
+
+PHASES = (phase7a, phase7b, phase7_muxsets, phase7_muxsets_unicast)
 BASEDIR = pathlib.Path("phase7_unicast2")
 DESCRIPTION = "Unicast announcements from 2 sites"
 
@@ -22,14 +27,17 @@ def main() -> None:
     handler = logging.getLogger()
     handler.addHandler(logging.FileHandler(BASEDIR / "log.txt"))
 
-    updates = phase7a() + phase7b() + phase7_muxsets() + phase7_muxsets_unicast()
+    updates = PhaseSequence(*PHASES)
     logging.info("Starting experiment %s", BASEDIR)
     nrounds = math.ceil(len(updates) / len(defs.PREFIXES))
     logging.info("Will deploy %d announcements in %d rounds", len(updates), nrounds)
-    logging.info("Starting at %d", FIRST_ROUND)
+    updates.report()
 
-    controller.withdraw_round()
-    controller.run_loop(updates, FIRST_ROUND, BASEDIR)
+    if controller.resuming(BASEDIR):
+        logging.info("Resuming from %s", BASEDIR / controller.JOURNAL_FN)
+    else:
+        controller.withdraw_round()
+    controller.run_loop(updates, BASEDIR)
 
 
 if __name__ == "__main__":
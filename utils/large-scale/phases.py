@@ -1,4 +1,9 @@
+import dataclasses
 import itertools
+import json
+import logging
+import pathlib
+from collections.abc import Callable, Hashable, Iterable, Iterator
 
 import defs
 
@@ -10,25 +15,148 @@ from peering import (
     PeeringCommunities,
     Update,
     Vultr,
+    update_key,
 )
 
 AS_PATH_PREPEND_LIST = [47065, 47065, 47065]
 
 
-def phase1a() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def baseline() -> Update:
+    """Anycast from all muxes, deployed before the variations of each phase"""
+    return Update([], [Announcement(list(MuxName))], "anycast")
+
+
+class PhaseSequence:
+    """Updates of one or more phases, generated anew on each iteration
+
+    Phases are functions returning iterables of updates.  Updates with the
+    same effect on every mux as an earlier one (see peering.update_key) are
+    dropped, such as the baseline each phase starts with.  Only the keys of
+    kept updates are stored while iterating, so len() and from_index()
+    regenerate the updates.
+    """
+
+    def __init__(self, *phases: Callable[[], Iterable[Update]]):
+        self.phases = phases
+        self.incremental = False
+        """Whether run_loop deploys updates over each other (see Manifest)"""
+        self.count: int | None = None
+        self.collapsed: dict[str, list[str]] = {}
+        """Maps descriptions of kept updates to those of updates dropped for them"""
+
+    def __iter__(self) -> Iterator[Update]:
+        key2desc: dict[Hashable, str] = {}
+        collapsed: dict[str, list[str]] = {}
+        for phase in self.phases:
+            for update in phase():
+                key = update_key(update)
+                description = update.description or ""
+                if key in key2desc:
+                    collapsed.setdefault(key2desc[key], []).append(description)
+                    continue
+                key2desc[key] = description
+                yield update
+        self.collapsed = collapsed
+
+    def __len__(self) -> int:
+        if self.count is None:
+            self.count = sum(1 for _ in self)
+        return self.count
+
+    def from_index(self, start: int, step: int = 1) -> Iterator[tuple[int, Update]]:
+        """Generate (index, update) pairs from index start, every step updates"""
+        return itertools.islice(enumerate(self), start, None, step)
+
+    def lane(self, prefix: str) -> Iterator[tuple[int, Update]]:
+        """Generate the (index, update) pairs run_loop assigns to prefix"""
+        return self.from_index(defs.PREFIXES.index(prefix), len(defs.PREFIXES))
+
+    def report(self) -> None:
+        """Log which descriptions collapsed together (call after a full pass)"""
+        ndropped = sum(len(dropped) for dropped in self.collapsed.values())
+        logging.info("Dropped %d updates equivalent to earlier ones", ndropped)
+        for kept, dropped in self.collapsed.items():
+            logging.info("%s covers %s", kept, ", ".join(dropped))
+
+
+@dataclasses.dataclass
+class Manifest:
+    """Updates packed into rounds of at most one update per prefix
+
+    The update of the prefix at position p of defs.PREFIXES in round r has
+    index r * len(defs.PREFIXES) + p, so run_loop stores its results in
+    round{r}, as for a PhaseSequence.
+    """
+
+    rounds: list[dict[str, tuple[str, Update]]]
+    """Per round, maps prefixes to (phase name, update)"""
+    duration: float = 0.0
+    """Predicted campaign duration in seconds"""
+    incremental: bool = False
+    """Whether run_loop deploys each update of a prefix over the previous one
+    instead of withdrawing the prefix first"""
+
+    def __iter__(self) -> Iterator[Update]:
+        for _index, (_phase, update) in self.entries():
+            yield update
+
+    def __len__(self) -> int:
+        return sum(len(prefix2entry) for prefix2entry in self.rounds)
+
+    def entries(self) -> Iterator[tuple[int, tuple[str, Update]]]:
+        """Generate (index, (phase name, update)) pairs in index order"""
+        for r, prefix2entry in enumerate(self.rounds):
+            for p, prefix in enumerate(defs.PREFIXES):
+                if prefix in prefix2entry:
+                    yield r * len(defs.PREFIXES) + p, prefix2entry[prefix]
+
+    def lane(self, prefix: str) -> Iterator[tuple[int, Update]]:
+        p = defs.PREFIXES.index(prefix)
+        for r, prefix2entry in enumerate(self.rounds):
+            if prefix in prefix2entry:
+                yield r * len(defs.PREFIXES) + p, prefix2entry[prefix][1]
+
+    def to_dict(self) -> dict:
+        return {
+            "duration": self.duration,
+            "incremental": self.incremental,
+            "rounds": [
+                {p: {"phase": n, "update": u.to_dict()} for p, (n, u) in r.items()}
+                for r in self.rounds
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Manifest":
+        rounds = [
+            {p: (e["phase"], Update.from_dict(e["update"])) for p, e in r.items()}
+            for r in d["rounds"]
+        ]
+        return cls(rounds, d.get("duration", 0.0), d.get("incremental", False))
+
+    def save(self, path: pathlib.Path) -> None:
+        with open(path, "w", encoding="utf8") as fd:
+            json.dump(self.to_dict(), fd, indent=2)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "Manifest":
+        with open(path, encoding="utf8") as fd:
+            return cls.from_dict(json.load(fd))
+
+
+def phase1a() -> Iterator[Update]:
+    yield baseline()
     for mux in MuxName:
         description = f"anycast+withdraw:{mux}"
         withdraw = [mux]
         muxes = set(MuxName)
         muxes.discard(mux)
         announce = [Announcement(list(muxes))]
-        updates.append(Update(withdraw, announce, description))
-    return updates
+        yield Update(withdraw, announce, description)
 
 
-def phase1b() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase1b() -> Iterator[Update]:
+    yield baseline()
     for mux, asn2peerids in IXP_SPECIAL_PEERS_V4.items():
         for peerids in asn2peerids.values():
             description = (
@@ -41,23 +169,21 @@ def phase1b() -> list[Update]:
             announce1 = Announcement([mux], communities=communities)
             announce2 = Announcement(list(muxes))
             announce = [announce1, announce2]
-            updates.append(Update(withdraw, announce, description))
-    return updates
+            yield Update(withdraw, announce, description)
 
 
-def phase1_muxsets() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase1_muxsets() -> Iterator[Update]:
+    yield baseline()
     for desc, withdrawn_muxes in MUX_SETS.items():
         description = f"anycast+withdraw:{desc}"
         normal_muxes = set(MuxName)
         normal_muxes.difference_update(withdrawn_muxes)
         announce = [Announcement(list(normal_muxes))]
-        updates.append(Update(withdrawn_muxes, announce, description))
-    return updates
+        yield Update(withdrawn_muxes, announce, description)
 
 
-def phase2a() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase2a() -> Iterator[Update]:
+    yield baseline()
     for mux in MuxName:
         description = f"anycast+prepend:{mux}"
         withdraw = []
@@ -66,12 +192,11 @@ def phase2a() -> list[Update]:
         announce1 = Announcement([mux], prepend=AS_PATH_PREPEND_LIST)
         announce2 = Announcement(list(muxes))
         announce = [announce1, announce2]
-        updates.append(Update(withdraw, announce, description))
-    return updates
+        yield Update(withdraw, announce, description)
 
 
-def phase2b() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase2b() -> Iterator[Update]:
+    yield baseline()
     for mux, asn2peerids in IXP_SPECIAL_PEERS_V4.items():
         for peerids in asn2peerids.values():
             description = (
@@ -86,12 +211,11 @@ def phase2b() -> list[Update]:
             )
             announce2 = Announcement(list(muxes))
             announce = [announce1, announce2]
-            updates.append(Update(withdraw, announce, description))
-    return updates
+            yield Update(withdraw, announce, description)
 
 
-def phase2_muxsets() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase2_muxsets() -> Iterator[Update]:
+    yield baseline()
     for desc, prepended_muxes in MUX_SETS.items():
         description = f"anycast+prepend:{desc}"
         normal_muxes = set(MuxName)
@@ -99,12 +223,11 @@ def phase2_muxsets() -> list[Update]:
         announce1 = Announcement(list(normal_muxes))
         announce2 = Announcement(list(prepended_muxes), prepend=AS_PATH_PREPEND_LIST)
         announce = [announce1, announce2]
-        updates.append(Update([], announce, description))
-    return updates
+        yield Update([], announce, description)
 
 
-def phase3() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase3() -> Iterator[Update]:
+    yield baseline()
     for provider in defs.VULTR_PROVIDERS:
         description = f"anycast+withdraw:vtr{provider}"
         muxes = set(MuxName)
@@ -113,12 +236,11 @@ def phase3() -> list[Update]:
         vtrcomm = Vultr.communities_do_not_announce([provider])
         announce2 = Announcement(vtrmuxes, communities=vtrcomm)
         announce = [announce1, announce2]
-        updates.append(Update([], announce, description))
-    return updates
+        yield Update([], announce, description)
 
 
-def phase4() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase4() -> Iterator[Update]:
+    yield baseline()
     for provider in defs.VULTR_PROVIDERS:
         description = f"anycast+prepend:vtr{provider}"
         muxes = set(MuxName)
@@ -127,12 +249,11 @@ def phase4() -> list[Update]:
         vtrcomm = Vultr.communities_prepend_thrice([provider])
         announce2 = Announcement(vtrmuxes, communities=vtrcomm)
         announce = [announce1, announce2]
-        updates.append(Update([], announce, description))
-    return updates
+        yield Update([], announce, description)
 
 
-def phase5a() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase5a() -> Iterator[Update]:
+    yield baseline()
     for (mux1, mux2) in itertools.combinations(MuxName, 2):
         description = f"anycast+withdraw:{mux1},{mux2}"
         withdraw = [mux1, mux2]
@@ -140,12 +261,11 @@ def phase5a() -> list[Update]:
         muxes.discard(mux1)
         muxes.discard(mux2)
         announce = [Announcement(list(muxes))]
-        updates.append(Update(withdraw, announce, description))
-    return updates
+        yield Update(withdraw, announce, description)
 
 
-def phase5b() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase5b() -> Iterator[Update]:
+    yield baseline()
     for mux1 in MuxName:
         for mux2, asn2peerids in IXP_SPECIAL_PEERS_V4.items():
             for peerids in asn2peerids.values():
@@ -158,12 +278,11 @@ def phase5b() -> list[Update]:
                 announce1 = Announcement([mux2], communities=communities)
                 announce2 = Announcement(list(muxes))
                 announce = [announce1, announce2]
-                updates.append(Update(withdraw, announce, description))
-    return updates
+                yield Update(withdraw, announce, description)
 
 
-def phase5_muxsets() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase5_muxsets() -> Iterator[Update]:
+    yield baseline()
     for mux1 in MuxName:
         for desc, muxes in MUX_SETS.items():
             if mux1 in muxes:
@@ -173,12 +292,11 @@ def phase5_muxsets() -> list[Update]:
             normal_muxes = set(MuxName)
             normal_muxes.difference_update(withdraw)
             announce = [Announcement(list(normal_muxes))]
-            updates.append(Update(withdraw, announce, description))
-    return updates
+            yield Update(withdraw, announce, description)
 
 
-def phase6a() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase6a() -> Iterator[Update]:
+    yield baseline()
     muxes = set(MuxName)
     nonvtr_muxes = [m for m in muxes if not m.startswith("vtr")]
     vtr_muxes = [m for m in muxes if m.startswith("vtr")]
@@ -191,12 +309,11 @@ def phase6a() -> list[Update]:
             nonvtr_active.discard(mux)
             nonvtr_ann = Announcement(list(nonvtr_active))
             announce = [nonvtr_ann, vtr_ann]
-            updates.append(Update([mux], announce, description))
-    return updates
+            yield Update([mux], announce, description)
 
 
-def phase6b() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase6b() -> Iterator[Update]:
+    yield baseline()
     muxes = set(MuxName)
     nonvtr_muxes = [m for m in muxes if not m.startswith("vtr")]
     vtr_muxes = [m for m in muxes if m.startswith("vtr")]
@@ -213,21 +330,19 @@ def phase6b() -> list[Update]:
                 nonvtr_sub_ann = Announcement([mux], communities=nonvtr_sub_comms)
                 announce = [vtr_ann, nonvtr_active_ann, nonvtr_sub_ann]
                 description = f"anycast+withdraw:{mux},vtr{provider}+announce:{pidsstr}"
-                updates.append(Update([], announce, description))
-    return updates
+                yield Update([], announce, description)
 
 
-def phase7a() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase7a() -> Iterator[Update]:
+    yield baseline()
     for (mux1, mux2) in itertools.combinations(MuxName, 2):
         description = f"unicast:{mux1},{mux2}"
         announce = [Announcement([mux1, mux2])]
-        updates.append(Update([], announce, description))
-    return updates
+        yield Update([], announce, description)
 
 
-def phase7b() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase7b() -> Iterator[Update]:
+    yield baseline()
     for mux1 in MuxName:
         for mux2, asn2peerids in IXP_SPECIAL_PEERS_V4.items():
             for peerids in asn2peerids.values():
@@ -238,20 +353,18 @@ def phase7b() -> list[Update]:
                 announce2 = Announcement([mux1])
                 announce1 = Announcement([mux2], communities=communities)
                 announce = [announce1, announce2]
-                updates.append(Update([], announce, description))
-    return updates
+                yield Update([], announce, description)
 
 
-def phase7_muxsets() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase7_muxsets() -> Iterator[Update]:
+    yield baseline()
     for desc, muxes in MUX_SETS.items():
         description = f"unicast:{desc}"
-        updates.append(Update([], [Announcement(muxes)], description))
-    return updates
+        yield Update([], [Announcement(muxes)], description)
 
 
-def phase7_muxsets_unicast() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase7_muxsets_unicast() -> Iterator[Update]:
+    yield baseline()
     for mux1 in MuxName:
         for desc, muxes in MUX_SETS.items():
             if mux1 in muxes:
@@ -260,12 +373,11 @@ def phase7_muxsets_unicast() -> list[Update]:
             announce1 = Announcement([mux1])
             announce2 = Announcement(muxes)
             announce = [announce1, announce2]
-            updates.append(Update([], announce, description))
-    return updates
+            yield Update([], announce, description)
 
 
-def phase8a() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase8a() -> Iterator[Update]:
+    yield baseline()
     muxes = set(MuxName)
     nonvtr_muxes = [m for m in muxes if not m.startswith("vtr")]
     vtr_muxes = [m for m in muxes if m.startswith("vtr")]
@@ -276,12 +388,11 @@ def phase8a() -> list[Update]:
             description = f"unicast:{mux}+vtr{provider}"
             nonvtr_ann = Announcement([mux])
             announce = [nonvtr_ann, vtr_ann]
-            updates.append(Update([], announce, description))
-    return updates
+            yield Update([], announce, description)
 
 
-def phase8b() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase8b() -> Iterator[Update]:
+    yield baseline()
     muxes = set(MuxName)
     vtr_muxes = [m for m in muxes if m.startswith("vtr")]
     for provider in defs.VULTR_PROVIDERS:
@@ -294,25 +405,22 @@ def phase8b() -> list[Update]:
                 nonvtr_sub_ann = Announcement([mux], communities=nonvtr_sub_comms)
                 announce = [vtr_ann, nonvtr_sub_ann]
                 description = f"unicast:{mux}+announce:{peerids_str}"
-                updates.append(Update([], announce, description))
-    return updates
+                yield Update([], announce, description)
 
 
-def phase9() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase9() -> Iterator[Update]:
+    yield baseline()
     for mux in MuxName:
         description = f"unicast:{mux}"
         announce = [Announcement([mux])]
-        updates.append(Update([], announce, description))
-    return updates
+        yield Update([], announce, description)
 
 
-def phase10() -> list[Update]:
-    updates = [Update([], [Announcement(list(MuxName))], "anycast")]
+def phase10() -> Iterator[Update]:
+    yield baseline()
     vtr_muxes = [m for m in MuxName if m.startswith("vtr")]
     for provider in defs.VULTR_PROVIDERS:
         vtr_comms = Vultr.communities_announce_to_upstreams([provider])
         vtr_ann = Announcement(vtr_muxes, communities=vtr_comms)
         description = f"unicast:vtr{provider}"
-        updates.append(Update([], [vtr_ann], description))
-    return updates
+        yield Update([], [vtr_ann], description)
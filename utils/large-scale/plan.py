@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib
+import logging
+import pathlib
+import sys
+
+import controller
+import defs
+from phases import Manifest, PhaseSequence
+
+import peering
+
+MANIFEST_FN = "manifest.json"
+
+
+def parse_constraints(
+    reserve: list[str], egress: list[str]
+) -> dict[str, controller.PrefixConstraint]:
+    """Parse PREFIX=NAME[,NAME...] options into per-prefix constraints"""
+    constraints: dict[str, controller.PrefixConstraint] = {}
+    for option, field in ((reserve, "phases"), (egress, "egress")):
+        for spec in option:
+            prefix, _, names = spec.partition("=")
+            if prefix not in defs.PREFIXES:
+                raise ValueError(f"{prefix} is not in defs.PREFIXES")
+            constraint = constraints.setdefault(prefix, controller.PrefixConstraint())
+            setattr(constraint, field, set(names.split(",")))
+    return constraints
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Pack phases into rounds across all prefixes, and run them"
+    )
+    parser.add_argument(
+        "--phases",
+        metavar="N",
+        type=int,
+        nargs="+",
+        default=list(range(1, 11)),
+        help="Phase scripts to plan, in order [%(default)s]",
+    )
+    parser.add_argument(
+        "--reserve",
+        metavar="PREFIX=PHASE,...",
+        action="append",
+        default=[],
+        help="Only give PREFIX updates of these phases (e.g., phase9)",
+    )
+    parser.add_argument(
+        "--egress",
+        metavar="PREFIX=MUX,...",
+        action="append",
+        default=[],
+        help="Only give PREFIX updates that egress through these muxes",
+    )
+    parser.add_argument(
+        "--order",
+        action="store_true",
+        help="Reorder each prefix's updates to change few muxes at a time",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Deploy each update over the previous one without withdrawing",
+    )
+    parser.add_argument(
+        "--basedir",
+        metavar="DIR",
+        type=pathlib.Path,
+        default=pathlib.Path("campaign"),
+        help="Directory for the manifest and results [%(default)s]",
+    )
+    parser.add_argument(
+        "--run",
+        action="store_true",
+        help="Run the manifest (resuming if DIR has a journal) after planning",
+    )
+    args = parser.parse_args()
+
+    args.basedir.mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(
+        level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    handler = logging.getLogger()
+    handler.addHandler(logging.FileHandler(args.basedir / "log.txt"))
+
+    manifest_file = args.basedir / MANIFEST_FN
+    if controller.resuming(args.basedir):
+        manifest = Manifest.load(manifest_file)
+        logging.info("Resuming %s with %d updates", manifest_file, len(manifest))
+    else:
+        phases = {}
+        for n in args.phases:
+            module = importlib.import_module(f"phase{n}")
+            phases[f"phase{n}"] = PhaseSequence(*module.PHASES)
+        constraints = parse_constraints(args.reserve, args.egress)
+        flap_ledger = peering.FlapLedger(defs.BIRD_CFG_DIR / peering.FLAP_LEDGER_FN)
+        flap_ledger.load()
+        manifest = controller.plan_rounds(phases, constraints, flap_ledger)
+        separate = sum(
+            controller.plan_rounds({name: updates}, constraints, flap_ledger).duration
+            for name, updates in phases.items()
+        )
+        logging.info(
+            "Packed %d updates into %d rounds, predicted to take %.1f hours "
+            "(%.1f hours running phases one after another)",
+            len(manifest),
+            len(manifest.rounds),
+            manifest.duration / 3600,
+            separate / 3600,
+        )
+        if args.order:
+            before = controller.transition_total(manifest)
+            manifest = controller.order_transitions(manifest)
+            logging.info(
+                "Reordered updates: %d mux changes between consecutive updates "
+                "(%d before)",
+                controller.transition_total(manifest),
+                before,
+            )
+        if args.incremental:
+            full = controller.predicted_duration(manifest)
+            manifest.incremental = True
+            manifest.duration = controller.predicted_duration(manifest)
+            logging.info(
+                "Incremental transitions predicted to take %.1f hours "
+                "(%.1f hours withdrawing between updates, %.1f hours saved)",
+                manifest.duration / 3600,
+                full / 3600,
+                (full - manifest.duration) / 3600,
+            )
+        manifest.save(manifest_file)
+        logging.info("Wrote %s", manifest_file)
+
+    if args.run:
+        if not controller.resuming(args.basedir):
+            controller.withdraw_round()
+        controller.run_loop(manifest, args.basedir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
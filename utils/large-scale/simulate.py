@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import heapq
+import importlib
+import itertools
+import logging
+import os
+import pathlib
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from types import ModuleType
+
+import controller
+import defs
+import tracing
+from phases import Manifest, PhaseSequence
+
+import peering
+
+FILTER_FN_REGEX = re.compile(r"export_(?P<mux>[^_]+)_.*\.conf$")
+CLAUSE_REGEX = re.compile(
+    r"if \( net = (?P<prefix>\S+) \) then \{(?P<body>.*?)accept;", re.DOTALL
+)
+COMMUNITY_REGEX = re.compile(r"bgp_community\.add\(\((\d+),(\d+)\)\)")
+LARGE_COMMUNITY_REGEX = re.compile(r"bgp_large_community\.add\(\((\d+),(\d+),(\d+)\)\)")
+
+
+class VirtualClock:
+    """Stand-in for the time module where sleeping advances a virtual clock
+
+    time() and monotonic() return the virtual time; other attributes come
+    from the time module, so perf_counter() still measures real time.
+    Callbacks scheduled with call_at() run once sleep() reaches them.
+    """
+
+    def __init__(self, epoch: float | None = None):
+        self.epoch = time.time() if epoch is None else epoch
+        self.now = 0.0
+        self.timers: list[tuple[float, int, Callable[[], None]]] = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        return getattr(time, name)
+
+    def time(self) -> float:
+        return self.epoch + self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        with self.lock:
+            target = self.now + max(0.0, seconds)
+        while True:
+            with self.lock:
+                if not self.timers or self.timers[0][0] > target:
+                    self.now = target
+                    return
+                when, _n, callback = heapq.heappop(self.timers)
+                self.now = max(self.now, when)
+            callback()
+
+    def call_at(self, when: float, callback: Callable[[], None]) -> None:
+        with self.lock:
+            heapq.heappush(self.timers, (when, next(self.counter), callback))
+
+
+@contextlib.contextmanager
+def virtual_time(clock: VirtualClock, *modules: ModuleType) -> Iterator[None]:
+    """Make modules use clock instead of the time module"""
+    saved = [module.time for module in modules]
+    for module in modules:
+        module.time = clock
+    try:
+        yield
+    finally:
+        for module, original in zip(modules, saved, strict=True):
+            module.time = original
+
+
+class FakeBird:
+    """BIRD control socket that exports what the filter files say
+
+    Each `configure` parses the export filters under filters_dir into the
+    routes every mux exports, which `show route export <mux> all` then
+    lists with their communities.  `show protocols` lists a BGP session per
+    mux, established unless the mux is in down.  Muxes in down or stale
+    export nothing, the latter as if their sessions were stuck.  Other
+    commands succeed without output.
+    """
+
+    def __init__(self, sockpath: pathlib.Path, filters_dir: pathlib.Path):
+        self.sockpath = sockpath
+        self.filters_dir = filters_dir
+        self.mux2routes: dict[str, dict[str, peering.ExportedRoute]] = {}
+        """Routes each mux exports as of the last configure"""
+        self.file2routes: dict[str, tuple[tuple, dict]] = {}
+        """Parsed filter files and the (inode, size, mtime) they were parsed at"""
+        self.mux2reply: dict[str, str] = {}
+        self.commands: collections.Counter[str] = collections.Counter()
+        self.down: set[str] = set()
+        """Muxes whose BGP session is down"""
+        self.stale: set[str] = set()
+        """Muxes whose session is up but whose exports never change"""
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(str(sockpath))
+        self.server.listen()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.close()
+        self.sockpath.unlink(missing_ok=True)
+
+    def accept(self) -> None:
+        while True:
+            try:
+                conn, _addr = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn: socket.socket) -> None:
+        with conn, conn.makefile("r", encoding="utf8") as rfile:
+            conn.sendall(b"0001 BIRD simulated ready.\n")
+            for line in rfile:
+                cmd = line.strip()
+                self.commands[cmd.split(" ", 1)[0]] += 1
+                conn.sendall(self.reply(cmd).encode("utf8"))
+
+    def reply(self, cmd: str) -> str:
+        if cmd == "configure":
+            self.load()
+            return "0002-Reading configuration\n0003 Reconfigured\n"
+        words = cmd.split()
+        if words[:3] == ["show", "route", "export"] and len(words) > 3:
+            return self.show_exports(words[3])
+        if words[:2] == ["show", "protocols"]:
+            return self.show_protocols()
+        return "0000 \n"
+
+    def show_protocols(self) -> str:
+        lines = ["2002-name     proto    table    state  since       info\n"]
+        for i, mux in enumerate(peering.MuxName):
+            state, info = ("up", "Established")
+            if mux in self.down:
+                state, info = ("start", "Active")
+            lines.append(
+                f"{'1002-' if i == 0 else ' '}{mux} BGP rtup {state} 00:00:00 {info}\n"
+            )
+        lines.append("0000 \n")
+        return "".join(lines)
+
+    def load(self) -> None:
+        mux2routes: dict[str, dict[str, peering.ExportedRoute]] = {}
+        file2routes = {}
+        with os.scandir(self.filters_dir) as it:
+            for entry in it:
+                if not (m := FILTER_FN_REGEX.match(entry.name)):
+                    continue
+                st = entry.stat()
+                key = (st.st_ino, st.st_size, st.st_mtime_ns)
+                cached = self.file2routes.get(entry.name)
+                routes = cached[1] if cached and cached[0] == key else parse(entry)
+                file2routes[entry.name] = (key, routes)
+                mux2routes.setdefault(m.group("mux"), {}).update(routes)
+        self.file2routes = file2routes
+        self.mux2routes = mux2routes
+        self.mux2reply.clear()
+
+    def export_diff(
+        self, mux: str, prefix2route: dict[str, peering.ExportedRoute | None]
+    ) -> list[str]:
+        """Differences between prefix2route and what mux exports
+
+        Checks the routes `show route export` would list, without formatting
+        and parsing the reply.
+        """
+        self.commands["export_diff"] += 1
+        routes = self.mux2routes.get(mux, {})
+        if mux in self.down or mux in self.stale:
+            routes = {}
+        diff = []
+        for prefix, want in prefix2route.items():
+            have = routes.get(prefix)
+            if want is None:
+                if have is not None:
+                    diff.append(f"{prefix} still exported")
+            elif have is None:
+                diff.append(f"{prefix} not exported")
+            elif not (
+                want.communities <= have.communities
+                and want.large_communities <= have.large_communities
+            ):
+                diff.append(f"{prefix} missing communities")
+        return diff
+
+    def show_exports(self, mux: str) -> str:
+        if mux in self.down or mux in self.stale:
+            return "0000 \n"
+        if (reply := self.mux2reply.get(mux)) is not None:
+            return reply
+        lines = []
+        for prefix, route in sorted(self.mux2routes.get(mux, {}).items()):
+            lines.append(f"1007-{prefix} unicast [static1] * (200)\n")
+            communities = " ".join(f"({a},{b})" for a, b in sorted(route.communities))
+            large = " ".join(
+                f"({a},{b},{c})" for a, b, c in sorted(route.large_communities)
+            )
+            lines.append(f"1012-\tBGP.community: {communities}\n")
+            lines.append(f" \tBGP.large_community: {large}\n")
+        lines.append("0000 \n")
+        self.mux2reply[mux] = "".join(lines)
+        return self.mux2reply[mux]
+
+
+def parse(entry: os.DirEntry) -> dict[str, peering.ExportedRoute]:
+    """Parse an export filter file into the routes it accepts"""
+    routes = {}
+    with open(entry.path, encoding="utf8") as fd:
+        text = fd.read()
+    for clause in CLAUSE_REGEX.finditer(text):
+        body = clause.group("body")
+        routes[clause.group("prefix")] = peering.ExportedRoute(
+            frozenset((int(a), int(b)) for a, b in COMMUNITY_REGEX.findall(body)),
+            frozenset(
+                (int(a), int(b), int(c))
+                for a, b, c in LARGE_COMMUNITY_REGEX.findall(body)
+            ),
+        )
+    return routes
+
+
+class SimulatedEgress:
+    """Egress backend that keeps the rules in a dict"""
+
+    def __init__(self) -> None:
+        self.prio2route: dict[int, tuple[str, str]] = {}
+        self.changes = 0
+
+    def close(self) -> None:
+        pass
+
+    def set(self, prio: int, srcip: str, gateway: str) -> None:
+        self.prio2route[prio] = (srcip, gateway)
+        self.changes += 1
+
+    def unset(self, prio: int) -> None:
+        if self.prio2route.pop(prio, None) is not None:
+            self.changes += 1
+
+    def reconcile(
+        self, prio2route: dict[int, tuple[str, str]], prios: Iterable[int]
+    ) -> None:
+        for prio in prios:
+            if prio not in prio2route:
+                self.unset(prio)
+            elif self.prio2route.get(prio) != prio2route[prio]:
+                self.set(prio, *prio2route[prio])
+
+
+class SimulatedMeasurer:
+    """Stand-in for CatchmentExecutor whose measurements take virtual time"""
+
+    def __init__(self, clock: VirtualClock, duration: float):
+        self.clock = clock
+        self.duration = duration
+        self.measurements = 0
+
+    def __enter__(self) -> "SimulatedMeasurer":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        pass
+
+    def submit(
+        self,
+        outdir: pathlib.Path,
+        tstamps: dict[str, float],
+        rounds: int,
+        prefix: str,
+        tracer: tracing.Tracer | None = None,
+        parent: tracing.Span | None = None,
+    ) -> concurrent.futures.Future[bool]:
+        tracer = tracer or tracing.Tracer(None)
+        key = controller.prefix_plan().key(prefix)
+        span = tracer.start("catchment", parent, tstamps, prefix=prefix, key=key)
+        future: concurrent.futures.Future[bool] = concurrent.futures.Future()
+
+        def finish() -> None:
+            tracer.end(span, succeeded=True)
+            future.set_result(True)
+
+        self.clock.call_at(self.clock.monotonic() + self.duration, finish)
+        self.measurements += 1
+        return future
+
+
+class SimulatedController(peering.AnnouncementController):
+    """AnnouncementController timing the work a real run would do per update
+
+    calls and seconds count deploy() and the steps in it: render(),
+    validate(), reload_pending() (which reconfigures BIRD) and
+    confirm_exports(), with seconds in real time.  Exports are confirmed
+    against bird directly, polling on clock.
+    """
+
+    def __init__(self, bird: FakeBird, clock: VirtualClock, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bird = bird
+        self.clock = clock
+        self.calls: collections.Counter[str] = collections.Counter()
+        self.seconds: collections.Counter[str] = collections.Counter()
+
+    @contextlib.contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.calls[stage] += 1
+            self.seconds[stage] += time.perf_counter() - start
+
+    def deploy(self, *args, **kwargs) -> float | None:
+        with self.timed("deploy"):
+            return super().deploy(*args, **kwargs)
+
+    def confirm_exports(
+        self,
+        expected: dict[tuple[int, str], dict[str, peering.ExportedRoute | None]],
+        timeout: float = peering.CONFIRM_TIMEOUT,
+    ) -> float:
+        """Compare expected with the fake BIRD's exports, like the real method
+
+        The fake BIRD has loaded the filters by the time configure returns,
+        so exports match right away unless muxes are stale, which are polled
+        every CONFIRM_INTERVAL seconds of virtual time.  Skipping the control
+        socket and its worker threads keeps confirmation from dominating
+        the replay.
+        """
+        with self.timed("confirm"):
+            start = self.clock.monotonic()
+            pending = {
+                key: prefix2route
+                for key, prefix2route in expected.items()
+                if self.has_socket(key[0]) and key[1] not in self.bird.down
+            }
+            while True:
+                mux2diff = {}
+                for key, prefix2route in list(pending.items()):
+                    if diff := self.bird.export_diff(key[1], prefix2route):
+                        mux2diff[f"{key[1]} (BIRD{key[0]})"] = diff
+                    else:
+                        del pending[key]
+                elapsed = self.clock.monotonic() - start
+                if not pending:
+                    break
+                if elapsed > timeout:
+                    raise peering.ExportConfirmationError(mux2diff, elapsed)
+                self.clock.sleep(peering.CONFIRM_INTERVAL)
+            self.confirm_latency = elapsed
+            return elapsed
+
+    def render(self, prefix: str, ann: peering.Announcement) -> str:
+        with self.timed("render"):
+            return super().render(prefix, ann)
+
+    def validate(self, updates: peering.UpdateSet) -> None:
+        with self.timed("validate"):
+            super().validate(updates)
+
+    def reload_pending(self) -> dict[int, peering.BirdReply]:
+        with self.timed("reconfigure"):
+            return super().reload_pending()
+
+
+def simulate(
+    updates: PhaseSequence | Manifest,
+    basedir: pathlib.Path,
+    down: Iterable[str] = (),
+    stale: Iterable[str] = (),
+) -> None:
+    """Run updates through run_loop on fake backends in virtual time
+
+    BIRD configurations go to basedir/bird and lane results to basedir.
+    BGP sessions to the down muxes are down, and the stale muxes never
+    confirm exports (see FakeBird).
+    """
+    cfgdir = basedir / "bird"
+    shutil.copytree(defs.BIRD_CFG_DIR / "templates", cfgdir / "templates")
+    mux2tap = basedir / "mux2dev.txt"
+    with open(mux2tap, "w", encoding="utf8") as fd:
+        fd.writelines(f"{mux} tap{i}\n" for i, mux in enumerate(peering.MuxName))
+    sockpath = basedir / "bird.ctl"
+    bird = FakeBird(sockpath, cfgdir / "prefix-filters")
+    bird.down.update(down)
+    bird.stale.update(stale)
+    clock = VirtualClock()
+    with virtual_time(clock, controller, peering, tracing):
+        ctrl = SimulatedController(
+            bird,
+            clock,
+            defs.PREFIXES,
+            cfgdir,
+            sockpath,
+            basedir / "bird6.ctl",
+            schema_file=defs.ANNOUNCEMENT_SCHEMA,
+            mux2tap_file=mux2tap,
+            use_iproute2=True,
+            template_cache_dir=basedir / "jinja2-cache",
+        )
+        egress = SimulatedEgress()
+        ctrl.egress = egress
+        measurer = SimulatedMeasurer(clock, controller.measure_duration())
+        start = time.perf_counter()
+        try:
+            controller.run_loop(updates, basedir / "results", ctrl, measurer)
+        finally:
+            elapsed = time.perf_counter() - start
+            ctrl.close()
+            bird.close()
+
+    if isinstance(updates, Manifest):
+        nrounds = len(updates.rounds)
+    else:
+        nrounds = -(-len(updates) // len(defs.PREFIXES))
+    nrounds = max(1, nrounds)
+    logging.warning(
+        "Replayed %d updates (%d rounds) in %.1fs; the run would take %.1f hours",
+        len(updates),
+        nrounds,
+        elapsed,
+        clock.monotonic() / 3600,
+    )
+    logging.warning(
+        "%d BIRD configures, %d export checks, %d egress changes, "
+        "%d measurements, %d/%d render cache hits",
+        bird.commands["configure"],
+        bird.commands["show"] + bird.commands["export_diff"],
+        egress.changes,
+        measurer.measurements,
+        ctrl.render_hits,
+        ctrl.render_hits + ctrl.render_misses,
+    )
+    for stage in ("deploy", "render", "validate", "reconfigure", "confirm"):
+        calls, seconds = ctrl.calls[stage], ctrl.seconds[stage]
+        logging.warning(
+            "%-11s %6d calls %8.3fs %10.1f calls/s %8.2f ms/round",
+            stage,
+            calls,
+            seconds,
+            calls / seconds if seconds else 0.0,
+            1000 * seconds / nrounds,
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Replay phases offline with fake BIRD, egress and measurements"
+    )
+    parser.add_argument(
+        "--phases",
+        metavar="N",
+        type=int,
+        nargs="+",
+        default=[5],
+        help="Phase scripts to replay, in order [%(default)s]",
+    )
+    parser.add_argument(
+        "--only",
+        metavar="NAME",
+        nargs="+",
+        default=[],
+        help="Only replay these phase functions (e.g., phase5a)",
+    )
+    parser.add_argument(
+        "--manifest",
+        metavar="FILE",
+        type=pathlib.Path,
+        help="Replay a manifest written by plan.py instead of phase scripts",
+    )
+    parser.add_argument(
+        "--basedir",
+        metavar="DIR",
+        type=pathlib.Path,
+        help="Directory for BIRD configurations and results [temporary]",
+    )
+    parser.add_argument(
+        "--down",
+        metavar="MUX",
+        nargs="+",
+        default=[],
+        help="Simulate these muxes' BGP sessions being down",
+    )
+    parser.add_argument(
+        "--stale",
+        metavar="MUX",
+        nargs="+",
+        default=[],
+        help="Simulate these muxes never confirming exports",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Log what the controller does, not just the summary",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+
+    updates: PhaseSequence | Manifest
+    if args.manifest:
+        updates = Manifest.load(args.manifest)
+    else:
+        functions = []
+        for n in args.phases:
+            module = importlib.import_module(f"phase{n}")
+            functions.extend(
+                f for f in module.PHASES if not args.only or f.__name__ in args.only
+            )
+        updates = PhaseSequence(*functions)
+
+    if args.basedir:
+        args.basedir.mkdir(parents=True)
+        simulate(updates, args.basedir.absolute(), args.down, args.stale)
+        return 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        simulate(updates, pathlib.Path(tmpdir), args.down, args.stale)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
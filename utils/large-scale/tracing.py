@@ -0,0 +1,295 @@
+import collections
+import contextlib
+import dataclasses
+import itertools
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any
+
+# (start, end) timestamps.json keys derived from each span; see Span.derive()
+SPAN_KEYS: dict[str, tuple[str | None, str | None]] = {
+    "round": ("round-start", "round-end"),
+    "deploy": ("deploy-pfx2ann", "deploy-confirmed"),
+    "measure": ("measure-catchments-start", "measure-catchments-end"),
+    "catchment": ("measure-start", "measure-end"),
+    "tcpdump": ("launch-tcpdump", None),
+    "pinger": ("launch-pinger", "pinger-done"),
+    "kill": ("kill-tcpdump", None),
+}
+# Span attributes copied into timestamps.json
+ATTR_KEYS = {"confirm_latency": "deploy-confirm-latency", "pps": "pinger-pps"}
+
+ROUND_BUCKETS = (600, 1200, 1800, 2400, 3000, 3600, 5400, 7200)
+RECONFIGURE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SPARE_BUCKETS = (0, 60, 300, 600, 1200, 1800, 2400)
+
+
+@dataclasses.dataclass
+class Span:
+    """A timed step of a run, possibly inside another one
+
+    start and end are on the monotonic clock; wall is the Unix time at start.
+    Spans failing (ok=False) count as failures in the metrics.
+    """
+
+    name: str
+    span_id: str
+    parent: "Span | None"
+    start: float
+    wall: float
+    attrs: dict[str, Any] = dataclasses.field(default_factory=dict)
+    tstamps: dict[str, Any] | None = None
+    """Timestamps dict (for timestamps.json) the span's times go into"""
+    end: float | None = None
+    ok: bool = True
+
+    @property
+    def duration(self) -> float:
+        assert self.end is not None
+        return self.end - self.start
+
+    def derive(self, key: str | None, value: Any) -> None:
+        """Set a timestamps.json key the way measure_prefix() used to name it
+
+        Spans of catchment measurement rounds prefix keys with round-<i>/, and
+        spans with a prefix key (see peering.PrefixPlan) suffix them with /<key>.
+        """
+        if key is None or self.tstamps is None:
+            return
+        if "measure_round" in self.attrs:
+            key = f"round-{self.attrs['measure_round']}/{key}"
+        if "key" in self.attrs:
+            key = f"{key}/{self.attrs['key']}"
+        self.tstamps[key] = value
+
+
+class Tracer:
+    """Write spans to a JSONL file as they start and end
+
+    Each span gets a start and an end line, flushed right away, so rounds
+    that never finish show up as unmatched starts.  Without a path spans
+    are only kept in memory (to fill timestamps).  Ended spans feed metrics.
+    """
+
+    def __init__(self, path: pathlib.Path | None, metrics: "Metrics | None" = None):
+        self.path = path
+        self.metrics = metrics
+        self.fd = open(path, "a", encoding="utf8") if path else None  # noqa: SIM115
+        self.ids = itertools.count()
+        self.prefix = os.urandom(4).hex()
+        """Span IDs are <prefix>.<n>, with a random prefix per tracer"""
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> "Tracer":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.metrics:
+            self.metrics.write()
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    def start(
+        self,
+        name: str,
+        parent: Span | None = None,
+        tstamps: dict[str, Any] | None = None,
+        **attrs: Any,
+    ) -> Span:
+        """Start a span; tstamps defaults to the parent's"""
+        if tstamps is None and parent is not None:
+            tstamps = parent.tstamps
+        span = Span(
+            name,
+            f"{self.prefix}.{next(self.ids)}",
+            parent,
+            time.monotonic(),
+            time.time(),
+            attrs,
+            tstamps,
+        )
+        span.derive(SPAN_KEYS.get(name, (None, None))[0], span.wall)
+        for attr, key in ATTR_KEYS.items():
+            if attr in attrs:
+                span.derive(key, attrs[attr])
+        self.write(span, "start", span.start, span.wall, attrs)
+        if self.metrics:
+            self.metrics.opened(span)
+        return span
+
+    def end(self, span: Span, ok: bool = True, **attrs: Any) -> None:
+        """End a span; its end key is only derived if it succeeded"""
+        span.end = time.monotonic()
+        span.ok = ok
+        span.attrs.update(attrs)
+        wall = span.wall + span.duration
+        if ok:
+            span.derive(SPAN_KEYS.get(span.name, (None, None))[1], wall)
+        for attr, key in ATTR_KEYS.items():
+            if attr in attrs:
+                span.derive(key, attrs[attr])
+        self.write(span, "end", span.end, wall, {"ok": ok, **attrs})
+        if self.metrics:
+            self.metrics.observe(span)
+
+    @contextlib.contextmanager
+    def span(
+        self,
+        name: str,
+        parent: Span | None = None,
+        tstamps: dict[str, Any] | None = None,
+        **attrs: Any,
+    ) -> Iterator[Span]:
+        """Run a block in a span, failed if the block raises"""
+        span = self.start(name, parent, tstamps, **attrs)
+        try:
+            yield span
+        except BaseException:
+            self.end(span, ok=False)
+            raise
+        self.end(span)
+
+    def record(
+        self, name: str, parent: Span | None, start: float, end: float, **attrs: Any
+    ) -> Span:
+        """Record a span that already ended (start and end are monotonic)"""
+        wall = time.time() - (time.monotonic() - start)
+        span = Span(name, f"{self.prefix}.{next(self.ids)}", parent, start, wall, attrs)
+        span.end = end
+        self.write(span, "start", start, wall, attrs)
+        self.write(span, "end", end, wall + span.duration, {"ok": True})
+        if self.metrics:
+            self.metrics.observe(span)
+        return span
+
+    def write(
+        self, span: Span, event: str, mono: float, wall: float, attrs: dict
+    ) -> None:
+        if self.fd is None:
+            return
+        entry = {
+            "span": span.span_id,
+            "parent": span.parent.span_id if span.parent else None,
+            "name": span.name,
+            "event": event,
+            "mono": mono,
+            "time": wall,
+            **attrs,
+        }
+        if event == "end":
+            entry["duration"] = mono - span.start
+        line = json.dumps(entry, default=str)
+        with self.lock:
+            self.fd.write(line + "\n")
+            self.fd.flush()
+
+
+@dataclasses.dataclass
+class Histogram:
+    buckets: tuple[float, ...]
+    counts: list[int] = dataclasses.field(init=False)
+    total: float = 0.0
+    count: int = 0
+
+    def __post_init__(self) -> None:
+        self.counts = [0] * len(self.buckets)
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+    def lines(self, name: str) -> list[str]:
+        lines = [
+            f'{name}_bucket{{le="{bound:g}"}} {count}'
+            for bound, count in zip(self.buckets, self.counts, strict=True)
+        ]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.total:.6f}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+    """Aggregate ended spans into a Prometheus textfile-collector file
+
+    The file is rewritten atomically when a round ends or fails and when
+    the tracer closes.  Values cover the current process, so they restart
+    from zero when an interrupted run is resumed.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.rounds = Histogram(ROUND_BUCKETS)
+        self.reconfigures = Histogram(RECONFIGURE_BUCKETS)
+        self.spare = Histogram(SPARE_BUCKETS)
+        self.failures: collections.Counter[str] = collections.Counter()
+        self.open: collections.Counter[str] = collections.Counter()
+        self.last_end = 0.0
+        self.lock = threading.Lock()
+
+    def opened(self, span: Span) -> None:
+        with self.lock:
+            self.open[span.name] += 1
+
+    def observe(self, span: Span) -> None:
+        with self.lock:
+            if span.name in self.open:
+                self.open[span.name] = max(0, self.open[span.name] - 1)
+            self.last_end = time.time()
+            if span.name == "round":
+                self.rounds.observe(span.duration)
+            elif span.name == "reconfigure":
+                self.reconfigures.observe(span.duration)
+            elif span.name == "hold":
+                self.spare.observe(span.duration)
+            if not span.ok:
+                self.failures[span.name] += 1
+        if span.name == "round" or not span.ok:
+            self.write()
+
+    def write(self) -> None:
+        with self.lock:
+            failures = sorted(self.failures.items())
+            opened = sorted(self.open.items())
+            lines = [
+                "# HELP peering_round_duration_seconds Time from withdrawal to the "
+                "end of the hold, per prefix and update",
+                "# TYPE peering_round_duration_seconds histogram",
+                *self.rounds.lines("peering_round_duration_seconds"),
+                "# HELP peering_reconfigure_seconds BIRD reconfigure latency",
+                "# TYPE peering_reconfigure_seconds histogram",
+                *self.reconfigures.lines("peering_reconfigure_seconds"),
+                "# HELP peering_measurement_spare_seconds Time announcements stayed "
+                "up after their catchment measurement",
+                "# TYPE peering_measurement_spare_seconds histogram",
+                *self.spare.lines("peering_measurement_spare_seconds"),
+                "# HELP peering_failures_total Failed spans",
+                "# TYPE peering_failures_total counter",
+                *(f'peering_failures_total{{span="{n}"}} {c}' for n, c in failures),
+                "# HELP peering_open_spans Spans started but not ended",
+                "# TYPE peering_open_spans gauge",
+                *(f'peering_open_spans{{span="{n}"}} {c}' for n, c in opened),
+                "# HELP peering_last_span_end_timestamp_seconds When a span last "
+                "ended",
+                "# TYPE peering_last_span_end_timestamp_seconds gauge",
+                f"peering_last_span_end_timestamp_seconds {self.last_end:.3f}",
+            ]
+        tmpfile = self.path.with_suffix(".tmp")
+        try:
+            with open(tmpfile, "w", encoding="utf8") as fd:
+                fd.write("\n".join(lines) + "\n")
+            tmpfile.replace(self.path)
+        except OSError as e:
+            logging.warning("Cannot write metrics to %s: %s", self.path, e)
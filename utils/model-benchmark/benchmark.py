@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import argparse
+import dataclasses
+import itertools
+import json
+import logging
+import sys
+import timeit
+
+from peering import (
+    IXP_SPECIAL_PEERS_V4,
+    Announcement,
+    MuxName,
+    PeeringCommunities,
+    Update,
+)
+
+
+def phase_updates(count: int) -> list[Update]:
+    """Build count updates shaped like the pairwise large-scale phases"""
+    pairs = itertools.cycle(itertools.combinations(MuxName, 2))
+    peerids = itertools.cycle(
+        pids for asn2pids in IXP_SPECIAL_PEERS_V4.values() for pids in asn2pids.values()
+    )
+    updates = []
+    for i in range(count):
+        mux1, mux2 = next(pairs)
+        if i % 2:
+            muxes = [m for m in MuxName if m not in (mux1, mux2)]
+            update = Update([mux1, mux2], [Announcement(muxes)], f"withdraw:{i}")
+        else:
+            comms = [PeeringCommunities.announce_to(p) for p in next(peerids)]
+            announce = [Announcement([mux1], communities=comms), Announcement([mux2])]
+            update = Update([], announce, f"unicast:{i}")
+        updates.append(update)
+    return updates
+
+
+def legacy_models():
+    """dataclasses_json versions of the models, as they were before"""
+    import dataclasses_json  # noqa: PLC0415
+
+    @dataclasses_json.dataclass_json
+    @dataclasses.dataclass
+    class LegacyAnnouncement:
+        muxes: list[MuxName]
+        peer_ids: list[int] = dataclasses.field(default_factory=list)
+        communities: list[tuple[int, int]] = dataclasses.field(default_factory=list)
+        large_communities: list[tuple[int, int, int]] = dataclasses.field(
+            default_factory=list
+        )
+        prepend: list[int] = dataclasses.field(default_factory=list)
+
+    @dataclasses_json.dataclass_json
+    @dataclasses.dataclass
+    class LegacyUpdate:
+        withdraw: list[MuxName] = dataclasses.field(default_factory=list)
+        announce: list[LegacyAnnouncement] = dataclasses.field(default_factory=list)
+        description: str | None = None
+
+    return LegacyUpdate
+
+
+def measure(name: str, updates: list, update_cls, repeat: int) -> dict[str, float]:
+    dicts = [u.to_dict() for u in updates]
+    data = json.dumps(dicts)
+    assert [update_cls.from_dict(d).to_dict() for d in dicts] == dicts
+    results = {
+        "to_dict": lambda: [u.to_dict() for u in updates],
+        "from_dict": lambda: [update_cls.from_dict(d) for d in dicts],
+        "to_json": lambda: json.dumps([u.to_dict() for u in updates]),
+        "from_json": lambda: [update_cls.from_dict(d) for d in json.loads(data)],
+    }
+    timings = {}
+    for op, func in results.items():
+        timings[op] = min(timeit.repeat(func, number=1, repeat=repeat))
+        logging.info("%s %s: %.2f ms", name, op, timings[op] * 1000)
+    return timings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Compare encoding/decoding of Update lists with dataclasses_json"
+    )
+    parser.add_argument(
+        "--updates",
+        metavar="N",
+        type=int,
+        dest="updates",
+        default=3000,
+        help="Number of updates in the phase list [%(default)s]",
+    )
+    parser.add_argument(
+        "--repeat",
+        metavar="N",
+        type=int,
+        dest="repeat",
+        default=5,
+        help="Repetitions per measurement, the minimum is reported [%(default)s]",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    updates = phase_updates(args.updates)
+    current = measure("slots", updates, Update, args.repeat)
+    try:
+        legacy_cls = legacy_models()
+    except ImportError:
+        logging.warning("dataclasses_json not installed, skipping comparison")
+        return 0
+    legacy_updates = [legacy_cls.from_dict(u.to_dict()) for u in updates]
+    legacy = measure("dataclasses_json", legacy_updates, legacy_cls, args.repeat)
+    for op, secs in current.items():
+        logging.info("%s speedup: %.1fx", op, legacy[op] / secs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
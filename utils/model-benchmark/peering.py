@@ -0,0 +1 @@
+../../peering.py
\ No newline at end of file
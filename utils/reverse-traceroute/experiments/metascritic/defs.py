@@ -1,9 +1,11 @@
+import concurrent.futures
+import json
 import logging
 import os
 import pathlib
 import subprocess
 import time
-from ipaddress import IPv4Address, IPv4Network
+from ipaddress import IPv4Address
 
 from revtr import RevTrApi
 from peering import AnnouncementController, Update, UpdateSet
@@ -18,7 +20,10 @@ PFX2MUX = {
     "184.164.235.0/24": "vtrtokyo",
 }
 MUX2PFX = {v: k for k, v in PFX2MUX.items()}
-PFX2VPIP = {p: str(next(IPv4Network(p).hosts())) for p in PFX2MUX}
+# Pinger ICMP IDs are CATCHMENTS_ICMPID_BASE plus the prefix's index in PFX2MUX
+CATCHMENTS_ICMPID_BASE = 44000
+PREFIX_PLAN = peering.PrefixPlan(PFX2MUX, CATCHMENTS_ICMPID_BASE, sequential_ids=True)
+PFX2VPIP = {p: PREFIX_PLAN.vpip(p) for p in PFX2MUX}
 MUX2VPIP = {v: PFX2VPIP[k] for k, v in PFX2MUX.items()}
 
 MUX2PROVS = {
@@ -42,7 +47,7 @@ REVTRKEY = open("/home/cunha/.config/revtr.apikey", encoding="utf8").read().stri
 TARGETS_FILE = pathlib.Path("targets.txt")
 
 CATCHMENTS_DIR = pathlib.Path("../measure-catchments")
-CATCHMENTS_ICMPID_BASE = 44000
+# Packets per second shared by the pingers of all prefixes, which run at once
 CATCHMENTS_PINGER_PPS = 600
 
 
@@ -77,35 +82,68 @@ def rebuild_revtr_atlas(revtr: RevTrApi, wait: bool = True):
         logging.info("Will build RevTr atlas in background")
 
 
-def measure_catchments(outdir: pathlib.Path):
+def measure_catchments(outdir: pathlib.Path) -> list[str]:
+    """Measure all prefixes' catchments concurrently, returning failed muxes
+
+    The pingers split CATCHMENTS_PINGER_PPS among themselves.  Per-prefix
+    start and stop times go to outdir/timestamps.json.
+    """
+    pps = max(1, CATCHMENTS_PINGER_PPS // len(MUX2PFX))
+    tstamps: dict[str, float] = {}
+    with concurrent.futures.ThreadPoolExecutor(len(MUX2PFX)) as executor:
+        mux2future = {
+            mux: executor.submit(measure_prefix, outdir, mux, pps, tstamps)
+            for mux in MUX2PFX
+        }
+        failed = []
+        for mux, future in mux2future.items():
+            try:
+                future.result()
+            except (OSError, subprocess.CalledProcessError):
+                logging.exception("Error measuring catchments for %s", mux)
+                failed.append(mux)
+    os.makedirs(outdir, exist_ok=True)
+    with open(outdir / "timestamps.json", "w", encoding="utf8") as fd:
+        json.dump(tstamps, fd, indent=2)
+    return failed
+
+
+def measure_prefix(
+    outdir: pathlib.Path, mux: str, pps: int, tstamps: dict[str, float]
+) -> None:
     tcpdumpcmd = CATCHMENTS_DIR / "launch-tcpdump.sh"
     pingercmd = CATCHMENTS_DIR / "launch-pinger.sh"
     killcmd = CATCHMENTS_DIR / "kill-tcpdump.sh"
     muxes = list(MUX2VPIP)
-    for mux, prefix in MUX2PFX.items():
-        octet = int(IPv4Network(prefix).network_address.packed[2])
-        pfxoutdir = f"{outdir}_{octet}"
-        os.makedirs(pfxoutdir, exist_ok=True)
-        srcip = str(list(IPv4Network(prefix).hosts())[-1])
-        params = [str(tcpdumpcmd), "-i", srcip, "-o", pfxoutdir] + muxes
-        proc = subprocess.run(params, check=True, text=True, capture_output=True)
-        logging.info("launch-tcpdump.sh succeeded for %s %s", mux, srcip)
-        logging.info("%s", proc.stdout)
-        icmpid = CATCHMENTS_ICMPID_BASE + muxes.index(mux)
+    prefix = MUX2PFX[mux]
+    key = PREFIX_PLAN.key(prefix)
+    pfxoutdir = f"{outdir}_{key}"
+    os.makedirs(pfxoutdir, exist_ok=True)
+    srcip = PREFIX_PLAN.srcip(prefix)
+    tstamps[f"measure-start/{key}"] = time.time()
+    params = [str(tcpdumpcmd), "-i", srcip, "-o", pfxoutdir] + muxes
+    proc = subprocess.run(params, check=True, text=True, capture_output=True)
+    logging.info("launch-tcpdump.sh succeeded for %s %s", mux, srcip)
+    logging.info("%s", proc.stdout)
+    try:
+        icmpid = PREFIX_PLAN.icmpid(prefix)
         params = [
             str(pingercmd),
             "-i",
-            str(srcip),
+            srcip,
             "-t",
             str(TARGETS_FILE),
             "-I",
             str(icmpid),
             "-r",
-            str(CATCHMENTS_PINGER_PPS),
+            str(pps),
         ]
+        tstamps[f"launch-pinger/{key}"] = time.time()
         proc = subprocess.run(params, check=True, text=True, capture_output=True)
         logging.info("launch-pinger.sh succeeded for %s %s", mux, srcip)
+    finally:
         params = [str(killcmd), "-f", f"{pfxoutdir}/pids.txt"]
         logging.info(str(params))
         proc = subprocess.run(params, check=True, text=True, capture_output=True)
         logging.info("kill-tcpdump.sh succeeded for %s %s", mux, srcip)
+        tstamps[f"measure-end/{key}"] = time.time()
@@ -6,7 +6,6 @@ import os
 import pathlib
 import sys
 import time
-from ipaddress import IPv4Network
 
 import defs
 from revtr import RevTrApi
@@ -104,7 +103,7 @@ def main():
             time.sleep(revtr_atlas_wait)
 
         for mux, vpip in defs.MUX2VPIP.items():
-            octet = int(IPv4Network(defs.MUX2PFX[mux]).network_address.packed[2])
+            octet = defs.PREFIX_PLAN.key(defs.MUX2PFX[mux])
             pairs = [(vpip, dst) for dst in targets]
             label = f"{pfx2label[defs.MUX2PFX[mux]]}_{octet}"
             logging.info("Running %s RevTrs with label %s", len(pairs), label)
@@ -3,7 +3,6 @@
 import logging
 import sys
 import time
-from ipaddress import IPv4Network
 
 import defs
 from revtr import RevTrApi
@@ -41,7 +40,7 @@ def main():
     defs.rebuild_revtr_atlas(revtr)
 
     for mux, vpip in defs.MUX2VPIP.items():
-        octet = int(IPv4Network(defs.MUX2PFX[mux]).network_address.packed[2])
+        octet = defs.PREFIX_PLAN.key(defs.MUX2PFX[mux])
         pairs = [(vpip, dst) for dst in targets]
         label = f"{LABEL_BASE}_{mux}_{octet}_anycast"
         revtr.multibatch(pairs, label)
@@ -63,7 +62,7 @@ def main():
         defs.rebuild_revtr_atlas(revtr)
 
         for mux, vpip in defs.MUX2VPIP.items():
-            octet = int(IPv4Network(defs.MUX2PFX[mux]).network_address.packed[2])
+            octet = defs.PREFIX_PLAN.key(defs.MUX2PFX[mux])
             pairs = [(vpip, dst) for dst in targets]
             provider = defs.MUX2PROVS[mux][i % len(defs.MUX2PROVS[mux])]
             label = f"{LABEL_BASE}_{mux}_{octet}_as{provider}_idx{i}"